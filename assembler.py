@@ -4,12 +4,17 @@ import re
 import os
 import sys
 import optparse
+import itertools
+import json
+import hashlib
+import functools
+import collections
+import time
+import concurrent.futures
+from array import array
 
-symbols = {}
-
-instructions = []
-
-relocations = []
+# typecode of an unsigned 32 bit word
+word_typecode = "I" if array("I").itemsize == 4 else "L"
 
 
 class AssemblerError(Exception):
@@ -34,37 +39,19 @@ class AssemblerRangeError(AssemblerError):
         return "Range error on line %d: %s" % (self.line, self.reason)
 
 
-label_re = re.compile(r"""^(?P<labels>.*:)?(?P<gunk>[^:]*)$""")
-comment_re = re.compile(r"""^(?P<important>[^#]*)(?P<comment>#.*)?$""")
 valid_label_re = re.compile(r"""^\w+$""")
-
-rtype_0_re = re.compile(r"""^(?P<instr>(nop|halt))""")
-rtype_1_re = re.compile(
-    r"""^(?P<instr>(pop|push|jr|mfhi|mflo|tty|rnd|kbd))\s+(?P<r>r([0-9]|[1-2][0-9]|30|31))$"""
-)
-rtype_2_re = re.compile(
-    r"""^(?P<instr>(mult|mulu|div|divu))\s+(?P<rs>r([0-9]|[1-2][0-9]|30|31))\s+(?P<rt>r([0-9]|[1-2][0-9]|30|31))$"""
-)
-rtype_3_re = re.compile(
-    r"""^(?P<instr>(add|sub|slt|sltu|and|or|nor|xor))\s+(?P<rd>r([0-9]|[1-2][0-9]|30|31))\s+(?P<rs>r([0-9]|[1-2][0-9]|30|31))\s+(?P<rt>r([0-9]|[1-2][0-9]|30|31))$"""
+immediate_re = re.compile(r"""^-?(0x)?[0-9a-f]+$""")
+mem_operand_re = re.compile(
+    r"""^(?P<immed>-?(0x)?[0-9a-f]+)\s*\(\s*(?P<rs>r\d+)\s*\)$"""
 )
 
-itype_1_re = re.compile(
-    r"""^(?P<instr>(blez|bgtz|bltz))\s+(?P<rs>r([0-9]|[1-2][0-9]|30|31))\s+(?P<label>\w+)$"""
-)
-itype_2_re = re.compile(
-    r"""^(?P<instr>(addi|slti|sltiu|andi|ori|xori))\s+(?P<rt>r([0-9]|[1-2][0-9]|30|31))\s+(?P<rs>r([0-9]|[1-2][0-9]|30|31))\s+(?P<immed>-?(0x)?[0-9a-fA-F]+)$"""
-)
-branch_re = re.compile(
-    r"""^(?P<instr>(beq|bne))\s+(?P<rs>r([0-9]|[1-2][0-9]|30|31))\s+(?P<rt>r([0-9]|[1-2][0-9]|30|31))\s+(?P<label>\w+)$"""
-)
+registers = {"r%d" % i: i for i in range(32)}
 
-mem_re = re.compile(
-    r"""^(?P<instr>(lw|sw))\s+(?P<rt>r([0-9]|[1-2][0-9]|30|31))\s+(?P<immed>-?(0x)?[0-9a-fA-F]+)\s*\(\s*(?P<rs>r([0-9]|[1-2][0-9]|30|31))\s*\)$"""
+# a parsed source line; ``text`` is the normalized instruction text
+Instruction = collections.namedtuple(
+    "Instruction", "lineNo text instr rs rt rd immediate label"
 )
 
-jtype_re = re.compile(r"""^(?P<instr>(j))\s+(?P<label>\w+)$""")
-
 opcodes = {
     "nop": int("000000", 2),
     "add": int("000000", 2),
@@ -130,48 +117,105 @@ functs = {
 }
 
 
-def validLabel(s):
-    return valid_label_re.match(s) != None
+# Operand shape of every mnemonic, in the order they are written in the
+# source.  ``rd``/``rs``/``rt`` are registers, ``immed`` a 16 bit immediate,
+# ``offset(rs)`` a memory operand and ``label`` a jump or branch target.
+formats = {
+    "nop": (),
+    "halt": (),
+    "pop": ("rd",),
+    "mfhi": ("rd",),
+    "mflo": ("rd",),
+    "rnd": ("rd",),
+    "kbd": ("rd",),
+    "push": ("rs",),
+    "jr": ("rs",),
+    "tty": ("rs",),
+    "mult": ("rs", "rt"),
+    "mulu": ("rs", "rt"),
+    "div": ("rs", "rt"),
+    "divu": ("rs", "rt"),
+    "add": ("rd", "rs", "rt"),
+    "sub": ("rd", "rs", "rt"),
+    "slt": ("rd", "rs", "rt"),
+    "sltu": ("rd", "rs", "rt"),
+    "and": ("rd", "rs", "rt"),
+    "or": ("rd", "rs", "rt"),
+    "nor": ("rd", "rs", "rt"),
+    "xor": ("rd", "rs", "rt"),
+    "blez": ("rs", "label"),
+    "bgtz": ("rs", "label"),
+    "bltz": ("rs", "label"),
+    "addi": ("rt", "rs", "immed"),
+    "slti": ("rt", "rs", "immed"),
+    "sltiu": ("rt", "rs", "immed"),
+    "andi": ("rt", "rs", "immed"),
+    "ori": ("rt", "rs", "immed"),
+    "xori": ("rt", "rs", "immed"),
+    "beq": ("rs", "rt", "label"),
+    "bne": ("rs", "rt", "label"),
+    "lw": ("rt", "offset(rs)"),
+    "sw": ("rt", "offset(rs)"),
+    "j": ("label",),
+}
 
+unsigned_immediates = ["sltiu", "andi", "ori", "xori"]
 
-def fill_symbol_table(inputFile):
-    lineNo = 1
-    instructionsSeen = 0
-    for line in inputFile:
-        # strip any comments
-        match = comment_re.match(line)
 
-        if not match:
-            raise AssemblerSyntaxError(lineNo, "Unable to parse line: %s" % line)
+def instruction_kind(instr, shape):
+    if instr == "j":
+        return "jump"
+    if "label" in shape:
+        return "branch"
+    if instr in functs:
+        return "rtype"
+    return "itype"
 
-        line = match.group("important")
 
-        line = line.strip()
+# mnemonic -> (operand shape, encoding kind, opcode, funct); a line is decoded
+# by looking its mnemonic up here and parsing only the operands it expects.
+decoders = {
+    instr: (shape, instruction_kind(instr, shape), opcodes[instr], functs.get(instr, 0))
+    for instr, shape in formats.items()
+}
 
-        match = label_re.match(line)
 
-        if not match:
-            raise AssemblerSyntaxError(lineNo, "Unable to parse line: %s" % line)
+def validLabel(s):
+    return valid_label_re.match(s) != None
 
-        labels_string = match.group("labels")
 
-        if labels_string:
-            labels = labels_string[:-1].split(":")
-        else:
-            labels = []
+def split_line(line, lineNo):
+    """Split a source line into its list of labels and its instruction text."""
+    # strip any comments
+    line = line.partition("#")[0].strip()
+    labels_string, colon, instruction = line.rpartition(":")
+    labels = labels_string.split(":") if colon else []
+    for label in labels:
+        if not validLabel(label):
+            raise AssemblerSyntaxError(lineNo, "Invalid label: '%s'" % label)
+    return labels, instruction.strip()
+
+
+def define_labels(labels, symbols, instructionsSeen, lineNo):
+    for label in labels:
+        if label in symbols:
+            raise AssemblerSyntaxError(lineNo, "Label %s already defined" % label)
+        symbols[label] = instructionsSeen
 
-        for label in labels:
-            if not validLabel(label):
-                raise AssemblerSyntaxError(lineNo, "Invalid label: '%s'" % label)
-            if label in symbols:
-                raise AssemblerSyntaxError(lineNo, "Label %s already defined" % label)
-            symbols[label] = instructionsSeen
 
-        instruction = match.group("gunk").replace(",", " ").strip()
-        if len(instruction) != 0:
+def fill_symbol_table(inputFile, symbols=None):
+    if symbols is None:
+        symbols = {}
+    lineNo = 1
+    instructionsSeen = 0
+    for line in inputFile:
+        labels, instruction = split_line(line, lineNo)
+        define_labels(labels, symbols, instructionsSeen, lineNo)
+        if len(instruction) != 0 and not instruction.startswith("."):
             # there's an instruction here, so increment the number of instructions
             instructionsSeen += 1
         lineNo += 1
+    return symbols
 
 
 def imm_check(signed, both_allowed, immediate, lineNo):
@@ -192,261 +236,551 @@ def pprintInstr(separators, num):
     return binary
 
 
-def assemble_instructions(inputFile):
-    lineNo = 1
-    instructionsSeen = 0
-    instructions = []
-    for line in inputFile:
-        # strip any comments
-        match = comment_re.match(line)
-        assert match
-        line = match.group("important")
-
-        line = line.strip()
-
-        match = label_re.match(line)
-
-        instruction = match.group("gunk").lower().replace(",", " ").strip()
-
-        rtype_0 = rtype_0_re.match(instruction)
-        rtype_1 = rtype_1_re.match(instruction)
-        rtype_2 = rtype_2_re.match(instruction)
-        rtype_3 = rtype_3_re.match(instruction)
-
-        itype_1 = itype_1_re.match(instruction)
-        itype_2 = itype_2_re.match(instruction)
-        branch = branch_re.match(instruction)
-
-        mem = mem_re.match(instruction)
-        jtype = jtype_re.match(instruction)
-
-        if len(instruction) != 0:
-            num = 0
-
-            if rtype_0:
-                instr = rtype_0.group("instr")
-                funct = functs[instr]
-                opcode = opcodes[instr]
-                rd, rs, rt = 0, 0, 0
-                num = opcode << 26 | rs << 21 | rt << 16 | rd << 11 | funct
-                debug(
-                    "{0:s} hex_code: {2:04x}\n{1:s}\n".format(
-                        instruction, pprintInstr([6, 11, 16, 21, 26], num), num
-                    )
-                )
-            elif rtype_1:
-                instr = rtype_1.group("instr")
-                funct = functs[instr]
-                opcode = opcodes[instr]
-                rd, rs, rt = 0, 0, 0
-                if instr in ["pop", "mfhi", "mflo", "rnd", "kbd"]:
-                    rd = int(rtype_1.group("r")[1:])
-                else:
-                    rs = int(rtype_1.group("r")[1:])
-                num = opcode << 26 | rs << 21 | rt << 16 | rd << 11 | funct
-                debug(
-                    "{0:s} rtype: rs: {1:d} rt: {2:d} rd: {3:d} funct: {4:d} hex_code: {6:04x}\n{5:s}\n".format(
-                        instruction,
-                        rs,
-                        rt,
-                        rd,
-                        funct,
-                        pprintInstr([6, 11, 16, 21, 26], num),
-                        num,
-                    )
-                )
-            elif rtype_2:
-                instr = rtype_2.group("instr")
-                funct = functs[instr]
-                opcode = opcodes[instr]
-                rd, rs, rt = 0, 0, 0
-                rs = int(rtype_2.group("rs")[1:])
-                rt = int(rtype_2.group("rt")[1:])
-                num = opcode << 26 | rs << 21 | rt << 16 | rd << 11 | funct
-                debug(
-                    "{0:s} rtype: rs: {1:d} rt: {2:d} rd: {3:d} funct: {4:d} hex_code: {6:04x}\n{5:s}\n".format(
-                        instruction,
-                        rs,
-                        rt,
-                        rd,
-                        funct,
-                        pprintInstr([6, 11, 16, 21, 26], num),
-                        num,
-                    )
-                )
-            elif rtype_3:
-                instr = rtype_3.group("instr")
-                funct = functs[instr]
-                opcode = opcodes[instr]
-                rd, rs, rt = 0, 0, 0
-                rs = int(rtype_3.group("rs")[1:])
-                rt = int(rtype_3.group("rt")[1:])
-                rd = int(rtype_3.group("rd")[1:])
-                num = opcode << 26 | rs << 21 | rt << 16 | rd << 11 | funct
-                debug(
-                    "{0:s} rtype: rs: {1:d} rt: {2:d} rd: {3:d} funct: {4:d} hex_code: {6:04x}\n{5:s}\n".format(
-                        instruction,
-                        rs,
-                        rt,
-                        rd,
-                        funct,
-                        pprintInstr([6, 11, 16, 21, 26], num),
-                        num,
-                    )
+def label_target(kind, label, instructionNo, instructionsSeen, lineNo):
+    """Return the bits encoding ``label`` for a jump or branch.
+
+    ``instructionNo`` is the position of the label and ``instructionsSeen`` the
+    position of the instruction referencing it.
+    """
+    if kind == "jump":
+        return instructionNo & 67108863
+    offset = instructionNo - (instructionsSeen + 1)
+    if offset > 2**15 - 1 or offset < -(2**15):
+        raise AssemblerRangeError(
+            lineNo,
+            "label %s is too far away: %d instructions from pc+1" % (label, offset),
+        )
+    return offset & 65535
+
+
+def patch_fixups(instructions, fixups, symbols, log=None):
+    """Resolve the forward references recorded by ``assemble_instructions``."""
+    for instructionsSeen, lineNo, kind, label in fixups:
+        if label not in symbols:
+            raise AssemblerSyntaxError(lineNo, "unknown label %s" % label)
+        instructions[instructionsSeen] |= label_target(
+            kind, label, symbols[label], instructionsSeen, lineNo
+        )
+        if log:
+            log(
+                "patched line {0:d}: {1:s} -> {2:d} hex_code: {3:08x}\n".format(
+                    lineNo, label, symbols[label], instructions[instructionsSeen]
                 )
+            )
 
-            elif itype_2:
-                instr = itype_2.group("instr")
-                immediate = int(itype_2.group("immed"), 0)
-                signed = instr in [
-                    "addi",
-                    "slti",
-                    "lw",
-                    "sw",
-                    "beq",
-                    "bne",
-                    "blez",
-                    "bgtz",
-                ]
-                unsigned = instr in ["sltiu", "andi", "ori", "xori"]
-                imm_check(signed, False, immediate, lineNo)
-                opcode = opcodes[instr]
-                rs, rt = 0, 0
-                rs = int(itype_2.group("rs")[1:])
-                rt = int(itype_2.group("rt")[1:])
-                num = opcode << 26 | rs << 21 | rt << 16 | (immediate & 65535)
-                debug(
-                    "{0:s} itype: rs: {1:d} rt: {2:d} hex_code: {4:04x}\n{3:s}\n".format(
-                        instruction, rs, rt, pprintInstr([6, 11, 16], num), num
-                    )
-                )
-            elif itype_1:
-                instr = itype_1.group("instr")
-                opcode = opcodes[instr]
-                rs, rt = 0, 0
-                rs = int(itype_1.group("rs")[1:])
-                label = itype_1.group("label")
-                # find label
-                if label not in symbols:
-                    raise AssemblerSyntaxError(lineNo, "unknown label %s" % label)
-                instructionNo = symbols[label]
-                offset = instructionNo - (instructionsSeen + 1)
-                if offset > 2**15 - 1 or offset < -(2**15):
-                    raise AssemblerRangeError(
-                        lineNo,
-                        "label %s is too far away: %d instructions from pc+1"
-                        % (label, offset),
-                    )
-                num = opcode << 26 | rs << 21 | rt << 16 | (offset & 65535)
-                debug(
-                    "{0:s} itype: rs: {1:d} offset: {4:d} hex_code: {3:04x}\n{2:s}\n".format(
-                        instruction, rs, pprintInstr([6, 11, 16], num), num, offset
-                    )
-                )
 
-            elif branch:
-                instr = branch.group("instr")
-                opcode = opcodes[instr]
-                rs = int(branch.group("rs")[1:])
-                rt = int(branch.group("rt")[1:])
-                label = branch.group("label")
-                # find label
-                if label not in symbols:
-                    raise AssemblerSyntaxError(lineNo, "unknown label %s" % label)
-                instructionNo = symbols[label]
-                offset = instructionNo - (instructionsSeen + 1)
-                if offset > 2**15 - 1 or offset < -(2**15):
-                    raise AssemblerRangeError(
-                        lineNo,
-                        "label %s is too far away: %d instructions from pc+1"
-                        % (label, offset),
-                    )
-                num = opcode << 26 | rs << 21 | rt << 16 | (offset & 65535)
-                debug(
-                    "{0:s} rs: {1:d} rt: {2:d} opcode: {3:d} offset: {4:d} hex_code: {5:04x}\n{6:s}\n".format(
-                        instruction,
-                        rs,
-                        rt,
-                        opcode,
-                        offset,
-                        num,
-                        pprintInstr([6, 11, 16], num),
-                    )
-                )
-
-            elif mem:
-                instr = mem.group("instr")
-                opcode = opcodes[instr]
-                rs = int(mem.group("rs")[1:])
-                rt = int(mem.group("rt")[1:])
-                offset = int(mem.group("immed"), 0)
-                imm_check(True, False, offset, lineNo)
-                num = opcode << 26 | rs << 21 | rt << 16 | (offset & 65535)
-                debug(
-                    "{0:s} itype: rs: {1:d} rt: {2:d} hex_code: {4:04x}\n{3:s}\n".format(
-                        instruction, rs, rt, pprintInstr([6, 11, 16], num), num
-                    )
+def parse_immediate(text, lineNo, instruction):
+    if not immediate_re.match(text):
+        raise AssemblerSyntaxError(lineNo, "Can't parse instruction '%s'" % instruction)
+    try:
+        return int(text, 0)
+    except ValueError:
+        raise AssemblerSyntaxError(lineNo, "invalid immediate %s" % text)
+
+
+def parse_operands(shape, tokens, lineNo, instruction):
+    """Parse ``tokens`` against ``shape``, returning rs, rt, rd, immed and label."""
+    if shape and shape[-1] == "offset(rs)":
+        # the memory operand may be split by spaces: "4 ( r1 )"
+        tokens = tokens[:1] + [" ".join(tokens[1:])] if len(tokens) > 1 else tokens
+    if len(tokens) != len(shape):
+        raise AssemblerSyntaxError(lineNo, "Can't parse instruction '%s'" % instruction)
+    rs, rt, rd, immediate, label = 0, 0, 0, 0, None
+    for operand, token in zip(shape, tokens):
+        if operand == "label":
+            if not validLabel(token):
+                raise AssemblerSyntaxError(
+                    lineNo, "Can't parse instruction '%s'" % instruction
                 )
-
-            elif jtype:
-                instr = jtype.group("instr")
-                opcode = opcodes[instr]
-                # find label
-                label = jtype.group("label")
-                if label not in symbols:
-                    raise AssemblerSyntaxError(lineNo, "unknown label %s" % label)
-                instructionNo = symbols[label]
-                num = opcode << 26 | (instructionNo & 67108863)
-                debug(
-                    "{0:s} addr: {1:d} hex_code: {2:04x}\n{3:s}\n".format(
-                        instruction, instructionNo, num, pprintInstr([6], num)
-                    )
+            label = token
+        elif operand == "immed":
+            immediate = parse_immediate(token, lineNo, instruction)
+        elif operand == "offset(rs)":
+            match = mem_operand_re.match(token)
+            if not match or match.group("rs") not in registers:
+                raise AssemblerSyntaxError(
+                    lineNo, "Can't parse instruction '%s'" % instruction
                 )
-
-            else:
+            immediate = parse_immediate(match.group("immed"), lineNo, instruction)
+            rs = registers[match.group("rs")]
+        elif token not in registers:
+            raise AssemblerSyntaxError(
+                lineNo, "Can't parse instruction '%s'" % instruction
+            )
+        elif operand == "rs":
+            rs = registers[token]
+        elif operand == "rt":
+            rt = registers[token]
+        else:
+            rd = registers[token]
+    return rs, rt, rd, immediate, label
+
+
+def parse_directive(instruction, lineNo, exports):
+    """Handle a ``.globl label...`` line, the only directive there is."""
+    tokens = instruction.replace(",", " ").split()
+    if tokens[0].lower() != ".globl" or len(tokens) == 1:
+        raise AssemblerSyntaxError(lineNo, "Can't parse directive '%s'" % instruction)
+    for label in tokens[1:]:
+        if not validLabel(label):
+            raise AssemblerSyntaxError(lineNo, "Invalid label: '%s'" % label)
+        if exports is not None:
+            exports.append((label, lineNo))
+
+
+def parse_instructions(inputFile, symbols, exports=None):
+    """Yield an ``Instruction`` for every line of ``inputFile`` holding one.
+
+    Labels are added to ``symbols`` as soon as they are seen, before the
+    instruction they name is yielded.  Each line is tokenized and decoded
+    through the ``decoders`` table, so only the operand shape of its mnemonic
+    is ever parsed.  Labels named by ``.globl`` directives are appended to
+    ``exports`` with their line number.
+    """
+    lineNo = 1
+    instructionsSeen = 0
+    for line in inputFile:
+        labels, instruction = split_line(line, lineNo)
+        define_labels(labels, symbols, instructionsSeen, lineNo)
+
+        if instruction.startswith("."):
+            parse_directive(instruction, lineNo, exports)
+        elif len(instruction) != 0:
+            instruction = instruction.lower().replace(",", " ")
+            tokens = instruction.split()
+            instr = tokens[0]
+            if instr not in decoders:
                 raise AssemblerSyntaxError(
                     lineNo, "Can't parse instruction '%s'" % instruction
                 )
+            shape, kind, opcode, funct = decoders[instr]
+            rs, rt, rd, immediate, label = parse_operands(
+                shape, tokens[1:], lineNo, instruction
+            )
+            if kind == "itype":
+                if shape[-1] == "offset(rs)":
+                    imm_check(True, False, immediate, lineNo)
+                else:
+                    signed = instr not in unsigned_immediates
+                    imm_check(signed, False, immediate, lineNo)
             # there's an instruction here, so increment the number of instructions
             instructionsSeen += 1
-            instructions.append(num)
+            yield Instruction(lineNo, instruction, instr, rs, rt, rd, immediate, label)
         lineNo += 1
-    return instructions
 
 
-def print_instructions(instructions, outputdir):
+def encode_instruction(instruction, instructionsSeen, symbols, fixups, log=None):
+    """Return the word of ``instruction``, the ``instructionsSeen``-th one.
+
+    References to labels not in ``symbols`` yet are left empty and recorded in
+    ``fixups`` to be patched later.
+    """
+    lineNo, text, instr, rs, rt, rd, immediate, label = instruction
+    shape, kind, opcode, funct = decoders[instr]
+    if kind == "rtype":
+        num = opcode << 26 | rs << 21 | rt << 16 | rd << 11 | funct
+        separators = [6, 11, 16, 21, 26]
+    elif kind == "itype":
+        num = opcode << 26 | rs << 21 | rt << 16 | (immediate & 65535)
+        separators = [6, 11, 16]
+    else:
+        # find label, or leave it to be patched once it is defined
+        if label in symbols:
+            target = label_target(kind, label, symbols[label], instructionsSeen, lineNo)
+        else:
+            target = 0
+            fixups.append((instructionsSeen, lineNo, kind, label))
+        if kind == "jump":
+            num = opcode << 26 | target
+            separators = [6]
+        else:
+            num = opcode << 26 | rs << 21 | rt << 16 | target
+            separators = [6, 11, 16]
+    if log:
+        log(
+            "{0:s} {1:s}: rs: {2:d} rt: {3:d} rd: {4:d} hex_code: {5:08x}\n{6:s}\n".format(
+                text, kind, rs, rt, rd, num, pprintInstr(separators, num)
+            )
+        )
+    return num
+
+
+def assemble_instructions(inputFile, symbols, log=None, optimizer=None):
+    """Assemble ``inputFile`` in a single pass.
+
+    Instructions are encoded as they are parsed, so backward references are
+    resolved right away.  Forward references (``j`` and the
+    ``beq``/``bne``/``blez``/``bgtz``/``bltz`` branches) are emitted with an
+    empty target and recorded in a fixup table that is patched once the whole
+    input has been read, so ``inputFile`` only needs to be iterable once.
+
+    When an ``optimizer`` is given, the parsed instructions are collected and
+    rewritten by ``optimizer.run(instructions, symbols)`` before encoding.
+    Debug messages are passed to ``log`` when it is given.
+    """
+    parsed = parse_instructions(inputFile, symbols)
+    if optimizer is not None:
+        parsed = optimizer.run(list(parsed), symbols)
+    instructions = []
+    fixups = []
+    for instructionsSeen, instruction in enumerate(parsed):
+        instructions.append(
+            encode_instruction(instruction, instructionsSeen, symbols, fixups, log)
+        )
+    patch_fixups(instructions, fixups, symbols, log)
+    return instructions
 
-    hex_instructions = [("%04x" % inst).zfill(8) for inst in instructions]
-    little_endian = [
-        inst[6:8] + inst[4:6] + inst[2:4] + inst[0:2] for inst in hex_instructions
-    ]
 
-    used = little_endian
-    bank0 = used[0::4]
-    bank1 = used[1::4]
-    bank2 = used[2::4]
-    bank3 = used[3::4]
+def assemble(source, log=None, optimizer=None):
+    """Assemble ``source`` and return ``(words, symbols)``.
+
+    ``source`` is the program text or any iterable of lines (an open file,
+    ``sys.stdin``...).  ``words`` is an ``array`` of 32 bit instruction words
+    and ``symbols`` maps every label to the index of its instruction.  No
+    module state is touched, so it can be called any number of times.  See
+    ``assemble_instructions`` for ``optimizer``.
+    """
+    if isinstance(source, str):
+        source = source.splitlines()
+    symbols = {}
+    words = array(word_typecode, assemble_instructions(source, symbols, log, optimizer))
+    return words, symbols
+
+
+# modules whose code decides the words a source assembles to
+build_modules = ["assembler.py", "optimizer.py"]
+
+
+@functools.lru_cache(maxsize=None)
+def build_version():
+    """Return a hash of ``build_modules``, which changes with the assembler.
+
+    Anything built from a source, such as an image or an object file, is
+    stale once this changes.
+    """
+    digest = hashlib.sha256()
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for name in build_modules:
+        with open(os.path.join(folder, name), "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+class ObjectFile:
+    """Relocatable code produced by ``assemble_object``.
+
+    ``words`` is the code assembled as if it started at instruction 0 and
+    ``symbols`` its labels.  ``exports`` maps the ``.globl`` labels to their
+    instruction, ``imports`` lists the labels defined by other objects and
+    ``relocations`` holds ``(instruction, kind, label)`` records, ``kind``
+    being ``"jump"`` or ``"branch"``, for the words whose target depends on
+    where the code ends up.  ``build`` is the ``build_version`` of the
+    assembler that wrote it, None when unknown.
+    """
+
+    magic = "s-mips-object"
+    version = 1
+
+    def __init__(self, words, symbols, exports, imports, relocations, build=None):
+        self.words = words
+        self.symbols = symbols
+        self.exports = exports
+        self.imports = imports
+        self.relocations = relocations
+        self.build = build
+
+    def write(self, path):
+        with open(path, "w") as file:
+            json.dump(
+                {
+                    "format": self.magic,
+                    "version": self.version,
+                    "words": pack_words(self.words).tobytes().hex(),
+                    "symbols": self.symbols,
+                    "exports": self.exports,
+                    "imports": self.imports,
+                    "relocations": self.relocations,
+                    "build": build_version(),
+                },
+                file,
+            )
+
+    @classmethod
+    def read(cls, path):
+        try:
+            with open(path, "r") as file:
+                data = json.load(file)
+            if data.get("format") != cls.magic or data.get("version") != cls.version:
+                raise IOError("%s is not a S-MIPS object file" % path)
+            words = array(word_typecode, bytes.fromhex(data["words"]))
+            if sys.byteorder != "little":
+                words.byteswap()
+            return cls(
+                words,
+                data["symbols"],
+                data["exports"],
+                data["imports"],
+                [tuple(relocation) for relocation in data["relocations"]],
+                data.get("build"),
+            )
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise IOError("%s is a damaged S-MIPS object file: %s" % (path, e))
+
+
+def assemble_object(source, log=None, optimizer=None):
+    """Assemble ``source`` into a relocatable ``ObjectFile``.
+
+    Labels that are not defined in ``source`` become imports instead of
+    errors, and every ``j`` and every branch to an import gets a relocation
+    record so the linker can place the code anywhere.  Labels named by
+    ``.globl`` are exported to the other objects.
+    """
+    if isinstance(source, str):
+        source = source.splitlines()
+    symbols = {}
+    exports = []
+    parsed = parse_instructions(source, symbols, exports)
+    if optimizer is not None:
+        parsed = optimizer.run(list(parsed), symbols, [name for name, _ in exports])
+    words = []
+    fixups = []
+    relocations = []
+    for instructionsSeen, instruction in enumerate(parsed):
+        words.append(
+            encode_instruction(instruction, instructionsSeen, symbols, fixups, log)
+        )
+        if decoders[instruction.instr][1] == "jump":
+            relocations.append((instructionsSeen, "jump", instruction.label))
+    patch_fixups(
+        words, [fixup for fixup in fixups if fixup[3] in symbols], symbols, log
+    )
+    for instructionsSeen, lineNo, kind, label in fixups:
+        if label not in symbols and kind == "branch":
+            relocations.append((instructionsSeen, kind, label))
+    for label, lineNo in exports:
+        if label not in symbols:
+            raise AssemblerSyntaxError(lineNo, "unknown label %s" % label)
+    imports = sorted({label for _, _, label in relocations if label not in symbols})
+    return ObjectFile(
+        array(word_typecode, words),
+        symbols,
+        {label: symbols[label] for label, _ in exports},
+        imports,
+        relocations,
+    )
 
-    for bank_name, bank in zip(
-        ["Bank0", "Bank1", "Bank2", "Bank3"], [bank0, bank1, bank2, bank3]
-    ):
-        bf = open(os.path.join(outputdir, bank_name), "w")
-        bf.write("v2.0 raw\n")
-        bf.write(" ".join(bank))
-        bf.close()
-    with open(os.path.join(outputdir, "Bank"), "w") as file:
-        file.write("v2.0 raw\n")
-        file.write("\n".join(used))
-        file.write("\nffffffff\n")
+
+bank_names = ["Bank0", "Bank1", "Bank2", "Bank3"]
+
+image_header = "v2.0 raw\n"
+
+# word marking the end of the program in the Bank image
+end_of_program = b"\xff\xff\xff\xff"
+
+
+def pack_words(instructions):
+    """Return ``instructions`` as an array of 32 bit words in little-endian."""
+    words = array(word_typecode, instructions)
+    if sys.byteorder != "little":
+        words.byteswap()
+    return words
+
+
+def rle_tokens(tokens):
+    """Collapse runs of equal tokens into Logisim ``count*value`` entries."""
+    for token, run in itertools.groupby(tokens):
+        count = sum(1 for _ in run)
+        yield token if count == 1 else "%d*%s" % (count, token)
+
+
+def image_text(data, separator, rle=False):
+    """Return ``data`` as ``v2.0 raw`` tokens, one per little-endian word."""
+    text = data.hex(separator, 4)
+    if rle and text:
+        text = separator.join(rle_tokens(text.split(separator)))
+    return text
+
+
+def print_instructions(instructions, outputdir, binary=False, rle=False):
+    """Write the memory images of ``instructions`` to ``outputdir``.
+
+    ``Bank0`` to ``Bank3`` hold every fourth word, one file per RAM bank, and
+    ``Bank`` the whole program followed by the ``ffffffff`` end mark the RAM
+    Dispatcher stops at.  The byte swap and the bank interleaving are done on
+    a packed buffer through ``memoryview`` strides.  With ``rle`` runs of equal
+    words are written as ``count*value``, and with ``binary`` the same images
+    are also written as raw little-endian bytes to ``<name>.bin``.
+    """
+    words = memoryview(pack_words(instructions))
+
+    for bank, bank_name in enumerate(bank_names):
+        data = words[bank::4].tobytes()
+        path = os.path.join(outputdir, bank_name)
+        if binary:
+            with open(path + ".bin", "wb") as file:
+                file.write(data)
+        with open(path, "w") as file:
+            file.write(image_header + image_text(data, " ", rle))
+
+    data = words.tobytes()
+    path = os.path.join(outputdir, "Bank")
+    if binary:
+        with open(path + ".bin", "wb") as file:
+            file.write(data + end_of_program)
+    with open(path, "w") as file:
+        file.write(
+            image_header
+            + image_text(data, "\n", rle)
+            + "\n"
+            + end_of_program.hex()
+            + "\n"
+        )
+
+
+def read_image(path):
+    """Read a ``v2.0 raw`` image, plain or run-length encoded, into words."""
+    with open(path, "r") as file:
+        header = file.readline()
+        if header.strip() != image_header.strip():
+            raise IOError("%s is not a v2.0 raw image" % path)
+        tokens = file.read().split()
+    hex_words = []
+    for token in tokens:
+        count, star, value = token.rpartition("*")
+        # Logisim also accepts values without their leading zeros
+        value = value.zfill(8)
+        hex_words.append(value * int(count) if star else value)
+    words = array(word_typecode, bytes.fromhex("".join(hex_words)))
+    if sys.byteorder != "little":
+        words.byteswap()
+    return words
+
+
+def read_banks(outputdir):
+    """Interleave the ``Bank0`` to ``Bank3`` images of ``outputdir`` back."""
+    banks = [read_image(os.path.join(outputdir, name)) for name in bank_names]
+    words = array(word_typecode, bytes(4 * sum(len(bank) for bank in banks)))
+    for bank, bank_words in enumerate(banks):
+        words[bank::4] = bank_words
+    return words
+
+
+def read_program(outputdir):
+    """Read back the program written by ``print_instructions`` to ``outputdir``.
+
+    The ``Bank`` image is used when present (up to its end mark), otherwise the
+    program is interleaved back from ``Bank0`` to ``Bank3``.
+    """
+    path = os.path.join(outputdir, "Bank")
+    if not os.path.exists(path):
+        return read_banks(outputdir)
+    words = read_image(path)
+    end = words.index(0xFFFFFFFF) if 0xFFFFFFFF in words else len(words)
+    return words[:end]
+
+
+def find_sources(paths):
+    """Expand ``paths`` into the .asm files they name or contain."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                if file.endswith(".asm"):
+                    yield os.path.join(root, file)
+
+
+def assemble_file(
+    path, outputdir, binary=False, rle=False, optimize=False, compile_only=False
+):
+    """Assemble ``path`` into the images of ``outputdir``.
+
+    With ``compile_only`` a relocatable object file is written to the
+    ``outputdir`` path instead.  Returns ``(path, error, seconds, report)``
+    where ``error`` is ``None`` on success or the error message, so a batch
+    can go on after a broken program, ``seconds`` the CPU time spent, which
+    adds up to the serial cost of a batch even when workers share a CPU, and
+    ``report`` the summary of the peephole optimizer when ``optimize`` is set.
+    """
+    start = time.process_time()
+    error = None
+    report = None
+    optimizer = None
+    if optimize:
+        from optimizer import PeepholeOptimizer
+
+        optimizer = PeepholeOptimizer()
+    try:
+        with open(path, "r") as source:
+            if compile_only:
+                module = assemble_object(source, optimizer=optimizer)
+                os.makedirs(os.path.dirname(outputdir) or ".", exist_ok=True)
+                module.write(outputdir)
+            else:
+                words, symbols = assemble(source, optimizer=optimizer)
+                os.makedirs(outputdir, exist_ok=True)
+                print_instructions(words, outputdir, binary, rle)
+        if optimizer:
+            report = optimizer.summary()
+    except (AssemblerError, IOError, UnicodeDecodeError) as e:
+        error = str(e)
+    return path, error, time.process_time() - start, report
+
+
+def assemble_batch(
+    jobs, processes=None, binary=False, rle=False, optimize=False, compile_only=False
+):
+    """Assemble ``jobs``, pairs of source path and output folder, in parallel.
+
+    The files are spread over a pool of ``processes`` worker processes (one per
+    CPU by default, none at all when it is 1).  Returns the results of
+    ``assemble_file`` in the order of ``jobs`` and the wall-clock time taken.
+    """
+    start = time.perf_counter()
+    paths = [path for path, outputdir in jobs]
+    outputdirs = [outputdir for path, outputdir in jobs]
+    worker = functools.partial(
+        assemble_file,
+        binary=binary,
+        rle=rle,
+        optimize=optimize,
+        compile_only=compile_only,
+    )
+    if processes == 1 or len(jobs) <= 1:
+        results = list(map(worker, paths, outputdirs))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            chunksize = max(1, len(jobs) // (4 * (processes or os.cpu_count())))
+            results = list(pool.map(worker, paths, outputdirs, chunksize=chunksize))
+    return results, time.perf_counter() - start
+
+
+def print_batch_summary(results, wall, processes, file=sys.stdout):
+    serial = sum(result[2] for result in results)
+    errors = sum(1 for result in results if result[1])
+    print(
+        "Assembled %d files (%d errors) in %.3fs on %s processes, "
+        "%.3fs serial (%.1fx)"
+        % (
+            len(results),
+            errors,
+            wall,
+            processes or os.cpu_count(),
+            serial,
+            serial / wall if wall else 1.0,
+        ),
+        file=file,
+    )
 
 
 def debug(*args):
-    if verbose:
-        sys.stdout.write(" ".join([str(arg) for arg in args]) + "\n")
+    sys.stdout.write(" ".join([str(arg) for arg in args]) + "\n")
 
 
 if __name__ == "__main__":
-    usage = "%prog infile [options]"
+    usage = "%prog [infile] [options]\n       %prog --batch file_or_folder... [options]"
     parser = optparse.OptionParser(usage=usage)
     parser.add_option(
         "-o",
@@ -456,6 +790,55 @@ if __name__ == "__main__":
         default=".",
         help="Specify output folder to write the 4 memory bank dumps.",
     )
+    parser.add_option(
+        "-b",
+        "--binary",
+        dest="binary",
+        action="store_true",
+        default=False,
+        help="Also write the memory images as raw little-endian binary files.",
+    )
+    parser.add_option(
+        "-r",
+        "--rle",
+        dest="rle",
+        action="store_true",
+        default=False,
+        help="Run-length encode repeated words in the memory images.",
+    )
+    parser.add_option(
+        "-O",
+        "--optimize",
+        dest="optimize",
+        action="store_true",
+        default=False,
+        help="Run the peephole optimizer and report the instructions removed.",
+    )
+    parser.add_option(
+        "-c",
+        "--compile",
+        dest="compile_only",
+        action="store_true",
+        default=False,
+        help="Write a relocatable object file <name>.o to the output folder "
+        "instead of the memory images, see linker.py.",
+    )
+    parser.add_option(
+        "--batch",
+        dest="batch",
+        action="store_true",
+        default=False,
+        help="Assemble every given .asm file, or every .asm file under the given "
+        "folders, into its own subfolder of the output folder.",
+    )
+    parser.add_option(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type="int",
+        default=None,
+        help="Number of processes used by --batch (default: one per CPU).",
+    )
     parser.add_option(
         "-v",
         "--verbose",
@@ -465,33 +848,76 @@ if __name__ == "__main__":
         help="Verbose debug mode",
     )
     options, args = parser.parse_args()
-    if len(args) != 1:
+    if len(args) > 1 and not options.batch or options.batch and not args:
         parser.error("Incorrect command line arguments")
         sys.exit(1)
 
-    verbose = options.verbose
-
     output_folder = options.output_folder
-    input_file = args[0]
+
+    if options.batch:
+        extension = ".o" if options.compile_only else ""
+        jobs = [
+            (
+                path,
+                os.path.join(
+                    output_folder,
+                    os.path.splitext(os.path.basename(path))[0] + extension,
+                ),
+            )
+            for path in find_sources(args)
+        ]
+        results, wall = assemble_batch(
+            jobs,
+            options.jobs,
+            options.binary,
+            options.rle,
+            options.optimize,
+            options.compile_only,
+        )
+        for path, error, seconds, report in results:
+            if error:
+                print("%s: %s" % (path, error), file=sys.stderr)
+            elif report:
+                print("%s: %s" % (path, report))
+        print_batch_summary(results, wall, options.jobs)
+        sys.exit(1 if any(result[1] for result in results) else 0)
+    # read the program from stdin when no file (or "-") is given
+    input_file = args[0] if args else "-"
     # if re.match(r""".*(?P<extension>\.s)$""",input_file,re.I) and output_file == 'a.hex':
     # output_file = input_file[:-1] + "hex"
 
     try:
-        infile = open(input_file)
+        infile = sys.stdin if input_file == "-" else open(input_file)
     except IOError as e:
-        print >> sys.stderr, "Unable to open input file %s" % input_file
+        print("Unable to open input file %s" % input_file, file=sys.stderr)
         sys.exit(1)
+    optimizer = None
+    if options.optimize:
+        from optimizer import PeepholeOptimizer
+
+        optimizer = PeepholeOptimizer()
+    log = debug if options.verbose else None
     try:
-        fill_symbol_table(infile)
-        infile.seek(0)
-        instructions = assemble_instructions(infile)
+        if options.compile_only:
+            name = "a" if input_file == "-" else os.path.basename(input_file)
+            object_file = os.path.join(output_folder, os.path.splitext(name)[0] + ".o")
+            assemble_object(infile, log, optimizer).write(object_file)
+        else:
+            instructions, symbols = assemble(infile, log, optimizer)
         infile.close()
     except AssemblerError as e:
-        print >> sys.stderr, str(e)
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+    except IOError as e:
+        print("Unable to write to output folder %s" % output_folder, file=sys.stderr)
         sys.exit(1)
+    if optimizer:
+        print("%s: %s" % (input_file, optimizer.summary()), file=sys.stderr)
+    if options.compile_only:
+        sys.exit(0)
     try:
-        print_instructions(instructions, output_folder)
+        print_instructions(instructions, output_folder, options.binary, options.rle)
     except IOError as e:
-        print >> sys.stderr, "Unable to write to output file %s" % output_file
+        print("Unable to write to output folder %s" % output_folder, file=sys.stderr)
         sys.exit(1)
     sys.exit(0)
@@ -0,0 +1,309 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import glob
+import random
+import time
+import tempfile
+import optparse
+
+import assembler
+import simulator
+
+
+def synthetic_operand(rng, operand, label):
+    if operand == "label":
+        return label
+    if operand == "immed":
+        return str(rng.randint(0, 2**15 - 1))
+    if operand == "offset(rs)":
+        return "%d(r%d)" % (rng.randint(-(2**15), 2**15 - 1), rng.randint(0, 31))
+    return "r%d" % rng.randint(0, 31)
+
+
+def synthetic_program(lines, seed=0):
+    """Generate a valid program of about ``lines`` lines using every mnemonic.
+
+    A label is placed every 10 lines and branches/jumps reference both the
+    previous (backward) and the next (forward) label.
+    """
+    rng = random.Random(seed)
+    mnemonics = [instr for instr in assembler.formats if instr != "halt"]
+    program = []
+    block = 0
+    for i in range(lines):
+        if i % 10 == 0:
+            program.append("l%d:" % block)
+            block += 1
+            continue
+        instr = rng.choice(mnemonics)
+        label = "l%d" % rng.choice([block - 1, block])
+        operands = [
+            synthetic_operand(rng, operand, label)
+            for operand in assembler.formats[instr]
+        ]
+        program.append(" ".join([instr] + operands))
+    program.append("l%d:" % block)
+    program.append("halt")
+    return [line + "\n" for line in program]
+
+
+def assemble_lines(lines):
+    return assembler.assemble(lines)[0]
+
+
+def best_of(repeat, function, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(name, lines, words, seconds):
+    print(
+        "%-20s %8d lines %8d words %9.4f s %12.0f lines/s %12.0f words/s"
+        % (name, lines, words, seconds, lines / seconds, words / seconds)
+    )
+
+
+def bench_corpus(tests_dir, repeat):
+    programs = []
+    for path in sorted(glob.glob(os.path.join(tests_dir, "*.asm"))):
+        with open(path) as file:
+            programs.append(file.readlines())
+
+    def run():
+        for lines in programs:
+            assemble_lines(lines)
+
+    seconds = best_of(repeat, run)
+    lines = sum(len(lines) for lines in programs)
+    words = sum(len(assemble_lines(lines)) for lines in programs)
+    report("%s (%d files)" % (tests_dir, len(programs)), lines, words, seconds)
+
+
+def bench_synthetic(size, repeat):
+    lines = synthetic_program(size)
+    seconds = best_of(repeat, assemble_lines, lines)
+    words = len(assemble_lines(lines))
+    report("synthetic", len(lines), words, seconds)
+
+
+def data_heavy_program(words, seed=0):
+    """Words of a program padded with ``nop`` runs and a zeroed data area."""
+    rng = random.Random(seed)
+    program = assembler.assemble(synthetic_program(words // 8, seed))[0]
+    padded = []
+    for word in program:
+        padded.append(word)
+        if rng.random() < 0.1:
+            padded.extend([0] * rng.randint(1, 32))
+    padded.extend([0] * (words - len(padded)))
+    return padded
+
+
+def image_size(outputdir):
+    return sum(
+        os.path.getsize(os.path.join(outputdir, name))
+        for name in ["Bank"] + assembler.bank_names
+    )
+
+
+def bench_image(name, words, repeat):
+    """Compare size and parse time of the plain and the RLE images."""
+    results = []
+    with tempfile.TemporaryDirectory() as plain, tempfile.TemporaryDirectory() as rle:
+        assembler.print_instructions(words, plain)
+        assembler.print_instructions(words, rle, rle=True)
+        for outputdir in [plain, rle]:
+            seconds = best_of(
+                repeat,
+                lambda: [
+                    assembler.read_image(os.path.join(outputdir, name))
+                    for name in ["Bank"] + assembler.bank_names
+                ],
+            )
+            results.append((image_size(outputdir), seconds))
+    (plain_size, plain_seconds), (rle_size, rle_seconds) = results
+    print(
+        "%-20s %8d words %9d -> %9d bytes (%5.1f%%) parse %8.4f -> %8.4f s"
+        % (
+            name,
+            len(words),
+            plain_size,
+            rle_size,
+            100.0 * rle_size / plain_size,
+            plain_seconds,
+            rle_seconds,
+        )
+    )
+
+
+def bench_images(tests_dir, size, repeat):
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(tests_dir, "*.asm"))):
+        with open(path) as file:
+            corpus.extend(assemble_lines(file))
+    bench_image("%s image" % tests_dir, corpus, repeat)
+    bench_image("synthetic image", assemble_lines(synthetic_program(size)), repeat)
+    bench_image("data-heavy image", data_heavy_program(size), repeat)
+
+
+def loop_kernel(iterations):
+    """Source of a nested loop running about ``8 * iterations`` instructions."""
+    return """
+addi r2 r0 %d
+outer:
+addi r3 r0 1000
+inner:
+add r4 r4 r3
+xor r5 r5 r4
+sw r5 4096(r0)
+lw r6 4096(r0)
+addi r3 r3 -1
+bgtz r3 inner
+addi r2 r2 -1
+bgtz r2 outer
+halt
+""" % max(1, iterations // 1000)
+
+
+def run_program(words, translate):
+    """Return the seconds ``words`` takes to run, leaving out the machine setup."""
+    machine = simulator.Machine(words)
+    start = time.perf_counter()
+    machine.run(translate=translate)
+    return time.perf_counter() - start, machine.steps
+
+
+def bench_program(name, words, repeat):
+    """Compare the instructions per second of both simulator engines.
+
+    Translated blocks are shared by every machine, so after the first run
+    this measures the translated code and not the translation.
+    """
+    results = []
+    for translate in [False, True]:
+        seconds, steps = min(run_program(words, translate) for _ in range(repeat))
+        results.append(steps / seconds / 1e6)
+    interpreted, translated = results
+    print(
+        "%-20s %8d instructions %8.2f MIPS interpreted %8.2f MIPS translated (%.1fx)"
+        % (name, steps, interpreted, translated, translated / interpreted)
+    )
+
+
+def bench_simulator(tests_dir, size, repeat):
+    with open(os.path.join(tests_dir, "liset.asm")) as file:
+        bench_program("liset", assemble_lines(file), repeat)
+    bench_program("loop kernel", assemble_lines(loop_kernel(size)), repeat)
+
+
+def seed_sweep_kernel(iterations):
+    """Source of a loop taking a different branch on every ``rnd`` number."""
+    return """
+addi r2 r0 %d
+loop:
+rnd r1
+andi r3 r1 1
+beq r3 r0 even
+addi r4 r4 1
+j next
+even:
+addi r5 r5 1
+next:
+addi r2 r2 -1
+bgtz r2 loop
+halt
+""" % min(iterations, 2**15 - 1)
+
+
+def bench_lockstep(size, instances, repeat):
+    """Compare instance-instructions per second of lockstep and scalar runs."""
+    try:
+        import lockstep
+    except ImportError:
+        print("lockstep: NumPy is not installed, skipped")
+        return
+    words = assemble_lines(seed_sweep_kernel(size // 100))
+
+    def run_lockstep():
+        machines = lockstep.Lockstep(
+            words, instances, range(instances), memory_words=4096
+        )
+        start = time.perf_counter()
+        machines.run()
+        return time.perf_counter() - start, int(machines.steps.sum())
+
+    def run_scalar():
+        # a sample of the instances, one after the other
+        seconds = steps = 0
+        for seed in range(min(instances, 20)):
+            machine = simulator.Machine(words, seed=seed)
+            start = time.perf_counter()
+            machine.run()
+            seconds += time.perf_counter() - start
+            steps += machine.steps
+        return seconds, steps
+
+    results = []
+    for run in [run_scalar, run_lockstep]:
+        seconds, steps = min(run() for _ in range(repeat))
+        results.append(steps / seconds / 1e6)
+    scalar, vectorized = results
+    print(
+        "%-20s %8d instances %8.2f M/s scalar %8.2f M/s lockstep (%.1fx)"
+        % ("seed sweep", instances, scalar, vectorized, vectorized / scalar)
+    )
+
+
+if __name__ == "__main__":
+    usage = "%prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option(
+        "-t",
+        "--tests",
+        dest="tests_dir",
+        type="string",
+        default="tests",
+        help="Folder with the .asm programs to benchmark",
+    )
+    parser.add_option(
+        "-n",
+        "--lines",
+        dest="lines",
+        type="int",
+        default=100000,
+        help="Size in lines of the synthetic program",
+    )
+    parser.add_option(
+        "-r",
+        "--repeat",
+        dest="repeat",
+        type="int",
+        default=5,
+        help="Number of runs, the best one is reported",
+    )
+    parser.add_option(
+        "-i",
+        "--instances",
+        dest="instances",
+        type="int",
+        default=1000,
+        help="Number of program instances run in lockstep",
+    )
+    options, args = parser.parse_args()
+    if len(args) != 0:
+        parser.error("Incorrect command line arguments")
+        sys.exit(1)
+
+    bench_corpus(options.tests_dir, options.repeat)
+    bench_synthetic(options.lines, options.repeat)
+    bench_images(options.tests_dir, options.lines, options.repeat)
+    bench_simulator(options.tests_dir, options.lines, options.repeat)
+    bench_lockstep(options.lines, options.instances, options.repeat)
@@ -0,0 +1,309 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import optparse
+
+import assembler
+import disassembler
+import simulator
+import linker
+import cache
+
+# instructions whose effect depends on where the program is or on the run
+unrelocatable = {"jr": "jumps to a register", "rnd": "uses rnd", "kbd": "uses kbd"}
+
+# the stubs clear memory with ``sw r0, offset(r0)``, a signed 16 bit offset
+reachable_words = 2**13
+
+# data below this word lives in the reserved window, above it on the stack
+low_words = simulator.memory_words // 2
+
+j_word = assembler.opcodes["j"] << 26
+
+# instructions a program may run while it is analysed
+default_max_steps = 10000000
+
+
+class BundleError(Exception):
+    pass
+
+
+def marker(index):
+    """Text the stub before program ``index`` prints on the tty."""
+    return "@@%d@@" % index
+
+
+class Program:
+    """A program checked to run the same wherever a ``Bundle`` places it.
+
+    ``words`` is the program as assembled to start at instruction 0 and
+    ``steps`` the instructions it runs until it halts.  ``reads`` holds the
+    words of data it reads before writing them, which must be 0 when it
+    starts, and ``writes`` those it writes.
+    """
+
+    def __init__(self, name, words, steps, reads, writes):
+        self.name = name
+        self.words = words
+        self.steps = steps
+        self.reads = reads
+        self.writes = writes
+
+    @classmethod
+    def analyse(cls, name, words, max_steps=None):
+        """Return the ``Program`` of ``words``, or raise ``BundleError``.
+
+        The program is run once on the simulator to find the memory it
+        uses.  It is rejected when it jumps to a register, uses rnd or kbd,
+        does not halt, runs or accesses data inside its own code, or
+        accesses low memory out of reach of the stubs.
+        """
+        size = len(words)
+        for word in words:
+            record = simulator.predecode(word)
+            if record is not None and record.instr in unrelocatable:
+                raise BundleError(unrelocatable[record.instr])
+            if record is not None and record.instr == "j" and word & 67108863 >= size:
+                raise BundleError("jumps out of its code")
+        try:
+            trace, halted = cache.record_trace(words, max_steps)
+        except simulator.SimulatorError as e:
+            raise BundleError(str(e))
+        if not halted:
+            raise BundleError("does not halt in %d instructions" % max_steps)
+        steps = 0
+        reads = set()
+        writes = set()
+        for entry in trace:
+            address, kind = entry >> 2, entry & 3
+            if kind == cache.FETCH:
+                if address >= size:
+                    raise BundleError("runs past its code at %d" % address)
+                steps += 1
+                continue
+            if address < size:
+                raise BundleError("accesses its own code at %d" % address)
+            if reachable_words <= address < low_words:
+                raise BundleError("accesses memory at %d" % address)
+            if kind == cache.WRITE:
+                writes.add(address)
+            elif address not in writes:
+                reads.add(address)
+        return cls(name, words, steps, reads, writes)
+
+
+def stub(index, clear=(), depth=0, final=False):
+    """Return the words of the stub starting program ``index``.
+
+    The stub prints the marker of the program, sets the ``clear`` words and
+    the ``depth`` words below the initial stack pointer back to 0, and then
+    every register, HI and LO, as they are when the processor starts.  The
+    ``final`` stub only prints its marker and halts.
+    """
+    lines = []
+    for character in "\n" + marker(index) + "\n":
+        lines += ["addi r1, r0, %d" % ord(character), "tty r1"]
+    if final:
+        lines.append("halt")
+        return assembler.assemble(lines)[0]
+    lines += ["sw r0, %d(r0)" % (4 * address) for address in sorted(clear)]
+    if depth:
+        lines.append("add r%d, r0, r0" % simulator.stack_pointer)
+        lines += ["push r0"] * depth
+    lines += ["add r%d, r0, r0" % register for register in range(1, 32)]
+    lines.append("mult r0, r0")
+    return assembler.assemble(lines)[0]
+
+
+class Bundle:
+    """``Program``s linked into one image that runs them one after the other.
+
+    The image starts with a jump over a reserved window of zeros holding the
+    low data of the programs, which keep their absolute addresses.  Every
+    program is relocated after a stub that prints its marker and resets the
+    machine, and its halts jump to the stub of the next one; the last stub
+    prints a final marker and halts.  ``split`` cuts the tty output back
+    into the output of every program.
+    """
+
+    def __init__(self, programs):
+        self.programs = programs
+        low = [
+            address
+            for program in programs
+            for address in program.reads | program.writes
+            if address < low_words
+        ]
+        self.window = max(low, default=0) + 1
+        window = assembler.ObjectFile(
+            [j_word] + [0] * (self.window - 1), {}, {}, [], [(0, "jump", "stub0")]
+        )
+        modules = [window]
+        names = ["window"]
+        dirty = set()
+        for index, program in enumerate(programs):
+            clear = program.reads & dirty
+            depth = max(
+                (
+                    simulator.memory_words - address
+                    for address in clear
+                    if address >= low_words
+                ),
+                default=0,
+            )
+            words = stub(
+                index, [address for address in clear if address < low_words], depth
+            )
+            modules.append(
+                assembler.ObjectFile(words, {}, {"stub%d" % index: 0}, [], [])
+            )
+            names.append("stub%d" % index)
+            modules.append(self.relocatable(program, "stub%d" % (index + 1)))
+            names.append(program.name)
+            dirty |= program.writes
+        words = stub(len(programs), final=True)
+        modules.append(
+            assembler.ObjectFile(words, {}, {"stub%d" % len(programs): 0}, [], [])
+        )
+        names.append("stub%d" % len(programs))
+        try:
+            self.words, exports = linker.link(modules, names)
+        except linker.LinkerError as e:
+            raise BundleError(str(e))
+        for program in programs:
+            for address in program.reads | program.writes:
+                if low_words <= address < len(self.words):
+                    raise BundleError(
+                        "%s accesses memory at %d, in the code"
+                        % (program.name, address)
+                    )
+
+    @staticmethod
+    def relocatable(program, following):
+        """Return ``program`` as an object whose halts jump to ``following``."""
+        words = list(program.words)
+        symbols = {}
+        relocations = []
+        for index, word in enumerate(words):
+            record = simulator.predecode(word)
+            if record is None:
+                continue
+            if record.instr == "j":
+                label = "@%d" % (word & 67108863)
+                symbols[label] = word & 67108863
+                relocations.append((index, "jump", label))
+            elif record.instr == "halt":
+                words[index] = j_word
+                relocations.append((index, "jump", following))
+        return assembler.ObjectFile(words, symbols, {}, [following], relocations)
+
+    def split(self, output):
+        """Return the output of every program, None for those that did not finish."""
+        results = [None] * len(self.programs)
+        position = 0
+        bounds = []
+        for index in range(len(self.programs) + 1):
+            start = output.find(marker(index), position)
+            if start < 0:
+                break
+            position = start + len(marker(index))
+            bounds.append((start, position))
+        for index in range(len(bounds) - 1):
+            results[index] = output[bounds[index][1] : bounds[index + 1][0]].strip()
+        return results
+
+    def steps(self):
+        """Upper bound of the instructions the whole image runs."""
+        return len(self.words) + sum(program.steps for program in self.programs)
+
+
+def solo_output(words, max_steps=None):
+    machine = simulator.Machine(words)
+    machine.run(max_steps)
+    return machine.tty().strip()
+
+
+if __name__ == "__main__":
+    usage = "%prog file_or_folder... [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option(
+        "-o",
+        "--out",
+        dest="output_folder",
+        type="string",
+        default=".",
+        help="Specify output folder",
+    )
+    parser.add_option(
+        "-r",
+        "--rle",
+        dest="rle",
+        action="store_true",
+        default=False,
+        help="Run-length encode repeated words in the Logisim images.",
+    )
+    parser.add_option(
+        "-m",
+        "--max-steps",
+        dest="max_steps",
+        type="int",
+        default=default_max_steps,
+        help="Leave out the programs not halting in this number of instructions",
+    )
+    parser.add_option(
+        "-c",
+        "--check",
+        dest="check",
+        action="store_true",
+        default=False,
+        help="Run the image on the simulator and compare it with every program",
+    )
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        parser.error("Incorrect command line arguments")
+        sys.exit(1)
+
+    programs = []
+    for path in assembler.find_sources(args):
+        try:
+            if path.endswith(".asm"):
+                with open(path, "r") as source:
+                    words, symbols = assembler.assemble(source)
+            else:
+                words = disassembler.read_words(path)
+            programs.append(Program.analyse(path, words, options.max_steps))
+        except (assembler.AssemblerError, IOError, ValueError, BundleError) as e:
+            print("%s: left out, %s" % (path, e), file=sys.stderr)
+    try:
+        bundle = Bundle(programs)
+        os.makedirs(options.output_folder, exist_ok=True)
+        assembler.print_instructions(
+            bundle.words, options.output_folder, rle=options.rle
+        )
+    except BundleError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+    except IOError as e:
+        print(
+            "Unable to write to output folder %s" % options.output_folder,
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    for index, program in enumerate(programs):
+        print("%s %s" % (marker(index), program.name))
+    print(
+        "%d programs, %d words, %d words of data window"
+        % (len(programs), len(bundle.words), bundle.window)
+    )
+
+    if options.check:
+        outputs = bundle.split(solo_output(bundle.words, bundle.steps()))
+        wrong = 0
+        for program, output in zip(programs, outputs):
+            if output != solo_output(program.words, options.max_steps):
+                wrong += 1
+                print("%s: different output in the bundle" % program.name)
+        print("%d programs with a different output" % wrong)
+        sys.exit(1 if wrong else 0)
+    sys.exit(0)
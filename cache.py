@@ -0,0 +1,341 @@
+#! /usr/bin/env python3
+
+import sys
+import optparse
+import itertools
+from array import array
+
+import assembler
+import disassembler
+import simulator
+import timing
+
+# kinds of memory access, kept in the two low bits of a trace entry
+FETCH = 0
+READ = 1
+WRITE = 2
+
+policies = ["lru", "fifo"]
+
+
+def record_trace(words, max_steps=None, keyboard="", seed=None):
+    """Run ``words`` and return the memory accesses it made, in order.
+
+    Every entry of the returned ``array`` is a word address shifted left
+    twice with the kind of access (``FETCH``, ``READ`` or ``WRITE``) in the
+    two low bits.  Also returns whether the program halted.
+    """
+    machine = simulator.Machine(words, keyboard, seed)
+    registers, memory = machine.registers, machine.memory
+    trace = array(assembler.word_typecode)
+    append = trace.append
+    words_mask = simulator.memory_words - 1
+    stack_pointer = simulator.stack_pointer
+    while not machine.halted:
+        if max_steps is not None and machine.steps >= max_steps:
+            return trace, False
+        pc = machine.pc
+        append(pc << 2 | FETCH)
+        record = simulator.predecode(memory[pc])
+        instr = record.instr if record else None
+        if instr == "lw":
+            append(machine.address(record.rs, record.immediate) << 2 | READ)
+        elif instr == "sw":
+            append(machine.address(record.rs, record.immediate) << 2 | WRITE)
+        elif instr == "pop":
+            append(machine.address(stack_pointer, 0) << 2 | READ)
+        elif instr == "push":
+            address = (registers[stack_pointer] - 4) >> 2 & words_mask
+            append(address << 2 | WRITE)
+        machine.step()
+    return trace, True
+
+
+class CacheStats:
+    """Outcome of replaying a trace through a ``CacheModel``.
+
+    ``hits`` and ``misses`` are indexed by kind of access; ``writebacks``
+    counts the dirty lines written back to memory when evicted.
+    """
+
+    def __init__(self):
+        self.hits = [0, 0, 0]
+        self.misses = [0, 0, 0]
+        self.writebacks = 0
+
+    def add(self, other):
+        for kind in range(3):
+            self.hits[kind] += other.hits[kind]
+            self.misses[kind] += other.misses[kind]
+        self.writebacks += other.writebacks
+
+    def accesses(self):
+        return sum(self.hits) + sum(self.misses)
+
+    def hit_rate(self):
+        accesses = self.accesses()
+        return sum(self.hits) / accesses if accesses else 1.0
+
+
+class CacheModel:
+    """A cache of ``lines`` lines of ``line_words`` words in sets of ``ways``.
+
+    With one way the cache is direct-mapped, as the ``Cache`` subcircuit of
+    s-mips.circ (8 lines of 4 words); with ``ways`` equal to ``lines`` it is
+    fully associative.  ``policy`` picks the line of a full set replaced on
+    a miss, the least recently used one (``lru``) or the oldest (``fifo``).
+    Writes allocate a line and mark it dirty, so it is written back to
+    memory when replaced.
+    """
+
+    def __init__(self, lines=8, line_words=4, ways=1, policy="lru"):
+        if lines < 1 or line_words < 1 or ways < 1 or lines % ways:
+            raise ValueError(
+                "a cache of %d lines cannot be split in sets of %d ways" % (lines, ways)
+            )
+        if policy not in policies:
+            raise ValueError("unknown replacement policy %s" % policy)
+        self.lines = lines
+        self.line_words = line_words
+        self.ways = ways
+        self.policy = policy
+
+    def describe(self):
+        if self.ways == 1:
+            shape = "direct"
+        elif self.ways == self.lines:
+            shape = "full"
+        else:
+            shape = "%d-way" % self.ways
+        return "%dx%d %s %s" % (self.lines, self.line_words, shape, self.policy)
+
+    def replay(self, trace):
+        """Return the ``CacheStats`` of the accesses of ``trace``."""
+        stats = CacheStats()
+        hits, misses = stats.hits, stats.misses
+        sets = self.lines // self.ways
+        ways = self.ways
+        line_words = self.line_words
+        lru = self.policy == "lru"
+        dirty = set()
+        if ways == 1:
+            # a single tag per set, nothing to order
+            tags = [None] * sets
+            for entry in trace:
+                kind = entry & 3
+                line = (entry >> 2) // line_words
+                index = line % sets
+                if tags[index] == line:
+                    hits[kind] += 1
+                else:
+                    misses[kind] += 1
+                    if tags[index] in dirty:
+                        dirty.discard(tags[index])
+                        stats.writebacks += 1
+                    tags[index] = line
+                if kind == WRITE:
+                    dirty.add(line)
+            return stats
+        # the lines of every set, the next to be replaced first
+        contents = [[] for _ in range(sets)]
+        for entry in trace:
+            kind = entry & 3
+            line = (entry >> 2) // line_words
+            ordered = contents[line % sets]
+            if line in ordered:
+                hits[kind] += 1
+                if lru and ordered[-1] != line:
+                    ordered.remove(line)
+                    ordered.append(line)
+            else:
+                misses[kind] += 1
+                if len(ordered) == ways:
+                    victim = ordered.pop(0)
+                    if victim in dirty:
+                        dirty.discard(victim)
+                        stats.writebacks += 1
+                ordered.append(line)
+            if kind == WRITE:
+                dirty.add(line)
+        return stats
+
+    def memory_cycles(self, stats, model=None):
+        """Estimate the cycles spent on memory accesses with this cache.
+
+        A hit takes a cycle, a miss also reads the whole line from the RAM
+        and a write-back writes it, waiting as ``model`` says for each word.
+        """
+        model = model or timing.TimingModel()
+        refill = self.line_words * (1 + model.read_wait)
+        flush = self.line_words * (1 + model.write_wait)
+        return stats.accesses() + sum(stats.misses) * refill + stats.writebacks * flush
+
+
+def uncached_cycles(stats, model=None):
+    """Cycles the accesses of ``stats`` take going straight to the RAM."""
+    model = model or timing.TimingModel()
+    reads = stats.hits[FETCH] + stats.misses[FETCH]
+    reads += stats.hits[READ] + stats.misses[READ]
+    writes = stats.hits[WRITE] + stats.misses[WRITE]
+    return reads * (1 + model.read_wait) + writes * (1 + model.write_wait)
+
+
+def configurations(lines, line_words, ways, replacement):
+    """Yield a ``CacheModel`` for every valid combination of the arguments."""
+    for count, size, way, policy in itertools.product(
+        lines, line_words, ways, replacement
+    ):
+        if way > count or count % way:
+            continue
+        if way == 1 and policy != replacement[0]:
+            # every policy replaces the only line of a direct-mapped set
+            continue
+        yield CacheModel(count, size, way, policy)
+
+
+def int_list(text):
+    return [int(value) for value in text.split(",") if value]
+
+
+if __name__ == "__main__":
+    usage = "%prog file_or_folder... [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option(
+        "-l",
+        "--lines",
+        dest="lines",
+        type="string",
+        default="4,8,16,32",
+        help="Comma separated numbers of lines to try",
+    )
+    parser.add_option(
+        "-w",
+        "--line-words",
+        dest="line_words",
+        type="string",
+        default="1,2,4,8",
+        help="Comma separated words per line to try",
+    )
+    parser.add_option(
+        "-a",
+        "--ways",
+        dest="ways",
+        type="string",
+        default="1,2,4",
+        help="Comma separated associativities to try (1: direct-mapped)",
+    )
+    parser.add_option(
+        "-p",
+        "--policies",
+        dest="policies",
+        type="string",
+        default="lru,fifo",
+        help="Comma separated replacement policies to try: lru, fifo",
+    )
+    parser.add_option(
+        "-d",
+        "--data-only",
+        dest="data_only",
+        action="store_true",
+        default=False,
+        help="Leave instruction fetches out of the cache",
+    )
+    parser.add_option(
+        "-m",
+        "--max-steps",
+        dest="max_steps",
+        type="int",
+        default=10000000,
+        help="Stop every program after this number of instructions (0: no limit)",
+    )
+    parser.add_option(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="store_true",
+        default=False,
+        help="Print the results of every program",
+    )
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        parser.error("Incorrect command line arguments")
+        sys.exit(1)
+
+    try:
+        models = list(
+            configurations(
+                int_list(options.lines),
+                int_list(options.line_words),
+                int_list(options.ways),
+                options.policies.split(","),
+            )
+        )
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+
+    traces = []
+    for path in assembler.find_sources(args):
+        try:
+            if path.endswith(".asm"):
+                with open(path, "r") as source:
+                    words, symbols = assembler.assemble(source)
+            else:
+                words = disassembler.read_words(path)
+            trace, halted = record_trace(words, options.max_steps or None)
+        except (
+            assembler.AssemblerError,
+            simulator.SimulatorError,
+            IOError,
+            ValueError,
+        ) as e:
+            print("%s: %s" % (path, e), file=sys.stderr)
+            continue
+        if options.data_only:
+            trace = array(trace.typecode, (entry for entry in trace if entry & 3))
+        traces.append((path, trace))
+    accesses = sum(len(trace) for path, trace in traces)
+    print("%d programs, %d memory accesses" % (len(traces), accesses))
+
+    results = []
+    for model in models:
+        total = CacheStats()
+        for path, trace in traces:
+            stats = model.replay(trace)
+            total.add(stats)
+            if options.verbose:
+                print(
+                    "%-22s %-40s %6.2f%% hits"
+                    % (model.describe(), path, 100 * stats.hit_rate())
+                )
+        results.append((model, total))
+
+    if results:
+        print("%d memory cycles without a cache" % uncached_cycles(results[0][1]))
+    print(
+        "%-22s %8s %10s %10s %10s %10s %12s"
+        % (
+            "cache",
+            "hits",
+            "fetch miss",
+            "read miss",
+            "write miss",
+            "writebacks",
+            "mem. cycles",
+        )
+    )
+    results.sort(key=lambda result: result[0].memory_cycles(result[1]))
+    for model, total in results:
+        print(
+            "%-22s %7.2f%% %10d %10d %10d %10d %12d"
+            % (
+                model.describe(),
+                100 * total.hit_rate(),
+                total.misses[FETCH],
+                total.misses[READ],
+                total.misses[WRITE],
+                total.writebacks,
+                model.memory_cycles(total),
+            )
+        )
+    sys.exit(0)
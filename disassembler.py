@@ -0,0 +1,232 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import optparse
+
+import assembler
+
+# (opcode, funct) -> mnemonic for the instructions told apart by their funct
+# field, opcode -> mnemonic for the rest.
+functions = {
+    (assembler.opcodes[instr], funct): instr
+    for instr, funct in assembler.functs.items()
+}
+operations = {
+    opcode: instr
+    for instr, opcode in assembler.opcodes.items()
+    if instr not in assembler.functs
+}
+function_opcodes = {opcode for opcode, funct in functions}
+
+signed_immediates = {
+    instr
+    for instr, shape in assembler.formats.items()
+    if instr not in assembler.unsigned_immediates
+}
+
+jump_opcodes = {
+    assembler.opcodes[instr]
+    for instr, (shape, kind, opcode, funct) in assembler.decoders.items()
+    if kind == "jump"
+}
+branch_opcodes = {
+    assembler.opcodes[instr]
+    for instr, (shape, kind, opcode, funct) in assembler.decoders.items()
+    if kind == "branch"
+}
+
+
+def decode(word):
+    """Return the mnemonic of ``word``, or None when it is not an instruction."""
+    opcode = word >> 26
+    if opcode in function_opcodes:
+        return functions.get((opcode, word & 63))
+    return operations.get(opcode)
+
+
+def signed(immediate):
+    return immediate - 65536 if immediate & 32768 else immediate
+
+
+def branch_target(index, word):
+    """Return the instruction ``word`` at ``index`` jumps to, or None."""
+    opcode = word >> 26
+    if opcode in jump_opcodes:
+        return word & 67108863
+    if opcode in branch_opcodes:
+        return index + 1 + signed(word & 65535)
+    return None
+
+
+def find_labels(words):
+    """Name every branch and jump target after its instruction number."""
+    labels = {}
+    for index, word in enumerate(words):
+        target = branch_target(index, word)
+        if target is not None and 0 <= target <= len(words):
+            labels[target] = "l%d" % target
+    return labels
+
+
+def make_formatter(instr):
+    """Build the function that prints an ``instr`` word for its operand shape.
+
+    The formatter takes ``(index, word, labels)`` and returns the source text,
+    or None when the word branches outside of the image.
+    """
+    shape = assembler.formats[instr]
+    shifts = [{"rs": 21, "rt": 16, "rd": 11}.get(operand) for operand in shape]
+    immediate = signed if instr in signed_immediates else int
+    text = " ".join([instr] + ["r%d"] * len(shape))
+
+    if shape == ():
+        return lambda index, word, labels: instr
+    if shape[-1] == "label":
+        text = text[:-3] + "%s"
+        a, b = (shifts[:-1] + [None, None])[:2]
+
+        def format_branch(index, word, labels):
+            label = labels.get(branch_target(index, word))
+            if label is None:
+                return None
+            if b is not None:
+                return text % (word >> a & 31, word >> b & 31, label)
+            if a is not None:
+                return text % (word >> a & 31, label)
+            return text % label
+
+        return format_branch
+    if shape[-1] == "immed":
+        text = text[:-3] + "%d"
+        a, b = shifts[:2]
+        return lambda index, word, labels: text % (
+            word >> a & 31,
+            word >> b & 31,
+            immediate(word & 65535),
+        )
+    if shape[-1] == "offset(rs)":
+        text = text[:-3] + "%d(r%d)"
+        a = shifts[0]
+        return lambda index, word, labels: text % (
+            word >> a & 31,
+            immediate(word & 65535),
+            word >> 21 & 31,
+        )
+    if len(shape) == 1:
+        a = shifts[0]
+        return lambda index, word, labels: text % (word >> a & 31)
+    if len(shape) == 2:
+        a, b = shifts
+        return lambda index, word, labels: text % (word >> a & 31, word >> b & 31)
+    a, b, c = shifts
+    return lambda index, word, labels: text % (
+        word >> a & 31,
+        word >> b & 31,
+        word >> c & 31,
+    )
+
+
+formatters = {instr: make_formatter(instr) for instr in assembler.formats}
+
+
+def encode(text, index, symbols):
+    """Return the word the assembler makes of ``text`` at ``index``, or None."""
+    try:
+        instruction = next(assembler.parse_instructions([text], symbols))
+        return assembler.encode_instruction(instruction, index, symbols, [])
+    except (assembler.AssemblerError, StopIteration):
+        return None
+
+
+def format_instruction(index, word, labels):
+    instr = decode(word)
+    if instr is None:
+        return "# .word 0x%08x" % word
+    text = formatters[instr](index, word, labels)
+    target = branch_target(index, word)
+    if text is None:
+        return "# %s 0x%08x (target %d out of the image)" % (instr, word, target)
+    # the text only shows the fields of its operands, a word with bits set
+    # anywhere else, such as a ``nop`` other than 0, would not assemble back
+    symbols = {labels[target]: target} if target in labels else {}
+    if encode(text, index, symbols) != word:
+        return "# .word 0x%08x" % word
+    return text
+
+
+def disassemble(words, addresses=False):
+    """Yield the source lines of ``words``, one instruction at a time.
+
+    Branch and jump targets get synthetic ``l<number>`` labels, so the output
+    can be fed back to the assembler.  With ``addresses`` every line is
+    followed by a comment with its instruction number and word.
+    """
+    labels = find_labels(words)
+    # words that do not branch always print the same, most programs repeat
+    # them a lot
+    lines = {}
+    for index, word in enumerate(words):
+        if index in labels:
+            yield labels[index] + ":\n"
+        line = lines.get(word)
+        if line is None:
+            line = "    " + format_instruction(index, word, labels)
+            if word >> 26 not in jump_opcodes and word >> 26 not in branch_opcodes:
+                lines[word] = line
+        if addresses:
+            line = "%-32s # %6d: %08x" % (line, index, word)
+        yield line + "\n"
+    if len(words) in labels:
+        yield labels[len(words)] + ":\n"
+
+
+def read_words(path):
+    """Read the program of a ``Bank`` image, a ``BankN`` image or a folder."""
+    if os.path.isdir(path):
+        return assembler.read_program(path)
+    folder, name = os.path.split(path)
+    if name in assembler.bank_names:
+        return assembler.read_banks(folder or ".")
+    words = assembler.read_image(path)
+    if 0xFFFFFFFF in words:
+        words = words[: words.index(0xFFFFFFFF)]
+    return words
+
+
+if __name__ == "__main__":
+    usage = "%prog image [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option(
+        "-o",
+        "--out",
+        dest="output_file",
+        type="string",
+        default="-",
+        help="Specify the file to write the source to (default: stdout).",
+    )
+    parser.add_option(
+        "-a",
+        "--addresses",
+        dest="addresses",
+        action="store_true",
+        default=False,
+        help="Comment every instruction with its number and hex word.",
+    )
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Incorrect command line arguments")
+        sys.exit(1)
+
+    try:
+        words = read_words(args[0])
+    except (IOError, ValueError) as e:
+        print("Unable to read image %s: %s" % (args[0], e), file=sys.stderr)
+        sys.exit(1)
+
+    outfile = sys.stdout
+    if options.output_file != "-":
+        outfile = open(options.output_file, "w")
+    outfile.writelines(disassemble(words, options.addresses))
+    outfile.close()
+    sys.exit(0)
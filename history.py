@@ -0,0 +1,196 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import time
+import sqlite3
+import optparse
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    revision TEXT NOT NULL,
+    tool TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    test TEXT NOT NULL,
+    passed INTEGER,
+    ticks INTEGER,
+    seconds REAL,
+    error INTEGER NOT NULL,
+    PRIMARY KEY (run, test)
+);
+"""
+
+
+class HistoryError(Exception):
+    pass
+
+
+class History:
+    """SQLite store of the results of every run of the test suite.
+
+    A run is labelled with the ``revision`` of the circuit it tested and the
+    ``tool`` running it (``logisim`` or ``simulator``); it holds whether each
+    test passed, its ticks and the seconds it took.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, revision, tool, results):
+        """Store a run, ``results`` being ``(test, passed, ticks, seconds,
+        error)`` tuples, and return its id."""
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (started, revision, tool) VALUES (?, ?, ?)",
+                (time.time(), revision, tool),
+            )
+            run = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                [(run,) + tuple(result) for result in results],
+            )
+        return run
+
+    def runs(self, limit=None):
+        """Return ``(id, started, revision, tool, tests)`` of the latest runs."""
+        query = (
+            "SELECT runs.id, started, revision, tool, COUNT(test) FROM runs "
+            "LEFT JOIN results ON results.run = runs.id "
+            "GROUP BY runs.id ORDER BY runs.id DESC"
+        )
+        if limit is not None:
+            query += " LIMIT %d" % limit
+        return self.connection.execute(query).fetchall()
+
+    def find_run(self, name):
+        """Return the id of run ``name``, or of the latest one of revision ``name``."""
+        row = None
+        if name.isdigit():
+            row = self.connection.execute(
+                "SELECT id FROM runs WHERE id = ?", (int(name),)
+            ).fetchone()
+        if row is None:
+            row = self.connection.execute(
+                "SELECT id FROM runs WHERE revision = ? ORDER BY id DESC LIMIT 1",
+                (name,),
+            ).fetchone()
+        if row is None:
+            raise HistoryError("no run or revision %s" % name)
+        return row[0]
+
+    def results(self, run):
+        """Return ``test -> (passed, ticks, seconds, error)`` of ``run``."""
+        rows = self.connection.execute(
+            "SELECT test, passed, ticks, seconds, error FROM results WHERE run = ?",
+            (run,),
+        )
+        return {row[0]: row[1:] for row in rows}
+
+
+def compare(base, new, threshold):
+    """Return ``(test, old ticks, new ticks, change)`` for the tests of both runs.
+
+    ``change`` is the growth of the ticks as a fraction, None when one of the
+    runs has no ticks for the test.  Only the rows whose change is above
+    ``threshold`` or unknown are returned, sorted by test.
+    """
+    rows = []
+    for test in sorted(set(base) & set(new)):
+        old, ticks = base[test][1], new[test][1]
+        if old is None or ticks is None:
+            change = None
+        else:
+            change = (ticks - old) / old if old else float(ticks > 0)
+        if change is None or change > threshold:
+            rows.append((test, old, ticks, change))
+    return rows
+
+
+if __name__ == "__main__":
+    usage = "%prog list [options]\n       %prog compare [base [new]] [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option(
+        "-d",
+        "--db",
+        dest="db",
+        type="string",
+        default="history.db",
+        help="History database written by test.py",
+    )
+    parser.add_option(
+        "-t",
+        "--threshold",
+        dest="threshold",
+        type="float",
+        default=5.0,
+        help="Percentage of ticks above which a test has regressed",
+    )
+    parser.add_option(
+        "-n",
+        "--runs",
+        dest="runs",
+        type="int",
+        default=20,
+        help="Number of runs listed",
+    )
+    options, args = parser.parse_args()
+    if not args or args[0] not in ("list", "compare") or len(args) > 3:
+        parser.error("Incorrect command line arguments")
+        sys.exit(1)
+
+    # both commands only read, so an absent database is not created
+    if not os.path.exists(options.db):
+        print("Unable to open %s: no such file" % options.db, file=sys.stderr)
+        sys.exit(1)
+    try:
+        history = History(options.db)
+    except sqlite3.Error as e:
+        print("Unable to open %s: %s" % (options.db, e), file=sys.stderr)
+        sys.exit(1)
+
+    if args[0] == "list":
+        for run, started, revision, tool, tests in history.runs(options.runs):
+            print(
+                "%6d  %s  %-14s %-10s %d tests"
+                % (
+                    run,
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started)),
+                    revision,
+                    tool,
+                    tests,
+                )
+            )
+        sys.exit(0)
+
+    try:
+        if len(args) == 1:
+            latest = history.runs(2)
+            if len(latest) < 2:
+                raise HistoryError("there are less than two runs to compare")
+            new, base = latest[0][0], latest[1][0]
+        else:
+            base = history.find_run(args[1])
+            new = history.find_run(args[2]) if len(args) == 3 else history.runs(1)[0][0]
+    except HistoryError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+
+    rows = compare(history.results(base), history.results(new), options.threshold / 100)
+    print("run %d -> run %d, threshold %g%%" % (base, new, options.threshold))
+    regressions = 0
+    for test, old, ticks, change in rows:
+        if change is None:
+            print("%-30s %12s -> %-12s no ticks" % (test, old, ticks))
+        else:
+            regressions += 1
+            print("%-30s %12d -> %-12d %+.1f%%" % (test, old, ticks, 100 * change))
+    print("%d tests regressed" % regressions)
+    sys.exit(1 if regressions else 0)
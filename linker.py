@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import hashlib
+import optparse
+from array import array
+
+import assembler
+
+
+class LinkerError(Exception):
+    pass
+
+
+def object_path(path, object_dir):
+    """Return where the object of the source ``path`` is kept in ``object_dir``."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    digest = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(object_dir, "%s-%s.o" % (name, digest[:12]))
+
+
+def load_module(path, object_dir=".", log=None):
+    """Return the ``ObjectFile`` of ``path``.
+
+    An ``.asm`` source is compiled into an ``.o`` of ``object_dir``, unless
+    that object is newer than the source and was written by the same
+    ``assembler.build_version``, so only the modules that changed are
+    assembled again.  A damaged object is assembled again too.
+    """
+    if os.path.splitext(path)[1] != ".asm":
+        return assembler.ObjectFile.read(path)
+    cached = object_path(path, object_dir)
+    try:
+        if os.path.getmtime(cached) >= os.path.getmtime(path):
+            module = assembler.ObjectFile.read(cached)
+            if module.build == assembler.build_version():
+                return module
+    except OSError:
+        pass
+    if log:
+        log("assembling %s" % path)
+    with open(path, "r") as source:
+        module = assembler.assemble_object(source)
+    os.makedirs(object_dir, exist_ok=True)
+    module.write(cached)
+    return module
+
+
+def relocate(words, address, kind, target):
+    """Point the jump or branch at ``address`` of ``words`` to ``target``."""
+    if kind == "jump":
+        words[address] = words[address] & ~67108863 | target & 67108863
+        return
+    offset = target - (address + 1)
+    if offset > 2**15 - 1 or offset < -(2**15):
+        raise LinkerError(
+            "branch at instruction %d is too far away from %d: %d instructions"
+            % (address, target, offset)
+        )
+    words[address] = words[address] & ~65535 | offset & 65535
+
+
+def link(modules, names=None, log=None):
+    """Lay ``modules`` out one after the other and resolve their relocations.
+
+    The first module starts at instruction 0, so it holds the entry point of
+    the program.  Returns the words of the program and the exported symbols
+    with their final instruction numbers.
+    """
+    names = names or ["module %d" % i for i in range(len(modules))]
+    bases = []
+    words = array(assembler.word_typecode)
+    exports = {}
+    defined_by = {}
+    for name, module in zip(names, modules):
+        base = len(words)
+        bases.append(base)
+        words.extend(module.words)
+        for label, index in module.exports.items():
+            if label in exports:
+                raise LinkerError(
+                    "symbol %s defined by both %s and %s"
+                    % (label, defined_by[label], name)
+                )
+            exports[label] = base + index
+            defined_by[label] = name
+    for name, module, base in zip(names, modules, bases):
+        for index, kind, label in module.relocations:
+            if label in module.symbols:
+                target = base + module.symbols[label]
+            elif label in exports:
+                target = exports[label]
+            else:
+                raise LinkerError("undefined symbol %s in %s" % (label, name))
+            relocate(words, base + index, kind, target)
+            if log:
+                log(
+                    "relocated {0:s}+{1:d}: {2:s} -> {3:d} hex_code: {4:08x}".format(
+                        name, index, label, target, words[base + index]
+                    )
+                )
+    return words, exports
+
+
+if __name__ == "__main__":
+    usage = "%prog module.o|module.asm [...] [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option(
+        "-o",
+        "--out",
+        dest="output_folder",
+        type="string",
+        default=".",
+        help="Specify output folder",
+    )
+    parser.add_option(
+        "-d",
+        "--objects",
+        dest="object_dir",
+        type="string",
+        default=None,
+        help="Folder keeping the objects of the .asm modules (default: the output folder)",
+    )
+    parser.add_option(
+        "-b",
+        "--binary",
+        dest="binary",
+        action="store_true",
+        default=False,
+        help="Also write raw little-endian .bin images of every bank.",
+    )
+    parser.add_option(
+        "-r",
+        "--rle",
+        dest="rle",
+        action="store_true",
+        default=False,
+        help="Run-length encode repeated words in the Logisim images.",
+    )
+    parser.add_option(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="store_true",
+        default=False,
+        help="Print the relocations applied",
+    )
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        parser.error("Incorrect command line arguments")
+        sys.exit(1)
+
+    log = assembler.debug if options.verbose else None
+    try:
+        object_dir = options.object_dir or options.output_folder
+        modules = [load_module(path, object_dir, log) for path in args]
+        words, exports = link(modules, args, log)
+    except (assembler.AssemblerError, LinkerError, IOError, ValueError) as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        os.makedirs(options.output_folder, exist_ok=True)
+        assembler.print_instructions(
+            words, options.output_folder, options.binary, options.rle
+        )
+    except IOError as e:
+        print(
+            "Unable to write to output folder %s" % options.output_folder,
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    sys.exit(0)
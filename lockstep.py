@@ -0,0 +1,384 @@
+#! /usr/bin/env python3
+
+import sys
+import random
+import optparse
+import collections
+
+import numpy
+
+import disassembler
+import simulator
+
+
+def as_signed(values):
+    return values.view(numpy.int32).astype(numpy.int64)
+
+
+class Lockstep:
+    """Runs many instances of the same program one instruction at a time.
+
+    Every instance has its own registers, HI/LO, program counter and memory,
+    held as NumPy arrays with the instances along the first axis.  On each
+    step the instances still running fetch their next instruction and every
+    instruction in use is executed at once on the instances that fetched it,
+    so instances that branched apart still advance together.
+
+    ``seeds`` gives each instance the seed of its ``rnd`` numbers, which are
+    the same as the ones ``simulator.Machine`` returns for that seed, and
+    ``registers`` an optional ``(instances, 32)`` array with the initial
+    register files.  A memory of ``memory_words`` words per instance takes
+    4 bytes a word, addresses wrap around it.
+    """
+
+    def __init__(
+        self,
+        words,
+        instances,
+        seeds=None,
+        registers=None,
+        keyboard="",
+        memory_words=simulator.memory_words,
+    ):
+        if memory_words & (memory_words - 1):
+            raise simulator.SimulatorError("memory_words must be a power of 2")
+        if len(words) > memory_words:
+            raise simulator.SimulatorError(
+                "program of %d words does not fit in memory" % len(words)
+            )
+        self.instances = instances
+        self.mask = memory_words - 1
+        self.memory = numpy.zeros((instances, memory_words), dtype=numpy.uint32)
+        self.memory[:, : len(words)] = numpy.asarray(words, dtype=numpy.uint32)
+        self.registers = numpy.zeros((instances, 32), dtype=numpy.uint32)
+        if registers is not None:
+            self.registers[:] = registers
+            self.registers[:, 0] = 0
+        self.hi = numpy.zeros(instances, dtype=numpy.uint32)
+        self.lo = numpy.zeros(instances, dtype=numpy.uint32)
+        self.pc = numpy.zeros(instances, dtype=numpy.int64)
+        self.steps = numpy.zeros(instances, dtype=numpy.int64)
+        self.halted = numpy.zeros(instances, dtype=bool)
+        self.errors = {}
+        self.output = [[] for _ in range(instances)]
+        self.keyboard = [list(keyboard) for _ in range(instances)]
+        seeds = seeds if seeds is not None else [None] * instances
+        self.random = [random.Random(seed) for seed in seeds]
+
+    def live(self, max_steps=None):
+        running = ~self.halted
+        if max_steps is not None:
+            running &= self.steps < max_steps
+        return numpy.flatnonzero(running)
+
+    def indices(self, lanes):
+        """Return the instance numbers selected by ``lanes``."""
+        return numpy.arange(self.instances)[lanes]
+
+    def step(self, lanes=None):
+        """Execute the next instruction of the running instances.
+
+        When the instances branched apart, only the ones at the lowest address
+        run, masking the others until they catch up; this brings them back
+        together where the paths of the branch meet again.  The instances at
+        that address run at once, in groups fetching the same word, which
+        they all do unless they wrote over their code.
+        """
+        if lanes is None:
+            lanes = self.live()
+        if len(lanes) == self.instances:
+            # a slice selects all of them much faster than an index array
+            lanes = slice(None)
+        pcs = self.pc[lanes]
+        pc = int(pcs.min())
+        if pcs[0] != pc or not (pcs == pc).all():
+            lanes = self.indices(lanes)[pcs == pc]
+        words = self.memory[lanes, pc]
+        if (words == words[0]).all():
+            self.execute(lanes, pc, int(words[0]))
+        else:
+            lanes = self.indices(lanes)
+            for word in numpy.unique(words).tolist():
+                self.execute(lanes[words == word], pc, word)
+        self.registers[:, 0] = 0
+
+    def execute(self, lanes, pc, word):
+        record = simulator.predecode(word)
+        if record is None:
+            for lane in self.indices(lanes).tolist():
+                self.errors[lane] = "invalid instruction 0x%08x at address %d" % (
+                    word,
+                    pc * 4,
+                )
+            self.halted[lanes] = True
+            return
+        self.pc[lanes] = (pc + 1) & self.mask
+        self.steps[lanes] += 1
+        getattr(self, "op_" + record.instr)(lanes, record, pc)
+
+    def run(self, max_steps=None):
+        """Run until every instance halts, return False if some did not halt
+        within ``max_steps`` instructions."""
+        while True:
+            lanes = self.live(max_steps)
+            if len(lanes) == 0:
+                return bool(self.halted.all())
+            self.step(lanes)
+
+    def tty(self):
+        """Return the tty output of every instance."""
+        return ["".join(output) for output in self.output]
+
+    # the instructions, run on the ``lanes`` that fetched the decoded word
+    # ``d`` from address ``pc``
+
+    def address(self, lanes, d):
+        offset = simulator.signed16(d.immediate)
+        return ((self.registers[lanes, d.rs].astype(numpy.int64) + offset) >> 2) & (
+            self.mask
+        )
+
+    def branch(self, lanes, taken, d, pc):
+        target = (pc + 1 + simulator.signed16(d.immediate)) & self.mask
+        self.pc[lanes] = numpy.where(taken, target, (pc + 1) & self.mask)
+
+    def op_nop(self, lanes, d, pc):
+        pass
+
+    def op_add(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rd] = r[lanes, d.rs] + r[lanes, d.rt]
+
+    def op_sub(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rd] = r[lanes, d.rs] - r[lanes, d.rt]
+
+    def op_and(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rd] = r[lanes, d.rs] & r[lanes, d.rt]
+
+    def op_or(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rd] = r[lanes, d.rs] | r[lanes, d.rt]
+
+    def op_nor(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rd] = ~(r[lanes, d.rs] | r[lanes, d.rt])
+
+    def op_xor(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rd] = r[lanes, d.rs] ^ r[lanes, d.rt]
+
+    def op_slt(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rd] = as_signed(r[lanes, d.rs]) < as_signed(r[lanes, d.rt])
+
+    def op_sltu(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rd] = r[lanes, d.rs] < r[lanes, d.rt]
+
+    def op_addi(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rt] = r[lanes, d.rs] + numpy.uint32(
+            simulator.signed16(d.immediate) & simulator.word_mask
+        )
+
+    def op_slti(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rt] = as_signed(r[lanes, d.rs]) < simulator.signed16(d.immediate)
+
+    def op_sltiu(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rt] = r[lanes, d.rs] < d.immediate
+
+    def op_andi(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rt] = r[lanes, d.rs] & numpy.uint32(d.immediate)
+
+    def op_ori(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rt] = r[lanes, d.rs] | numpy.uint32(d.immediate)
+
+    def op_xori(self, lanes, d, pc):
+        r = self.registers
+        r[lanes, d.rt] = r[lanes, d.rs] ^ numpy.uint32(d.immediate)
+
+    def op_mult(self, lanes, d, pc):
+        r = self.registers
+        product = as_signed(r[lanes, d.rs]) * as_signed(r[lanes, d.rt])
+        self.hi[lanes] = (product >> 32) & simulator.word_mask
+        self.lo[lanes] = product & simulator.word_mask
+
+    def op_mulu(self, lanes, d, pc):
+        r = self.registers
+        product = r[lanes, d.rs].astype(numpy.uint64) * r[lanes, d.rt]
+        self.hi[lanes] = product >> numpy.uint64(32)
+        self.lo[lanes] = product & numpy.uint64(simulator.word_mask)
+
+    def divide(self, lanes, dividend, divisor):
+        # same rounding as ``simulator.divide``, nothing changes on a zero
+        nonzero = divisor != 0
+        lanes = self.indices(lanes)[nonzero]
+        dividend, divisor = dividend[nonzero], divisor[nonzero]
+        quotient = numpy.abs(dividend) // numpy.abs(divisor)
+        quotient = numpy.where((dividend < 0) != (divisor < 0), -quotient, quotient)
+        self.lo[lanes] = quotient & simulator.word_mask
+        self.hi[lanes] = numpy.abs(dividend) % numpy.abs(divisor)
+
+    def op_div(self, lanes, d, pc):
+        r = self.registers
+        self.divide(lanes, as_signed(r[lanes, d.rs]), as_signed(r[lanes, d.rt]))
+
+    def op_divu(self, lanes, d, pc):
+        r = self.registers
+        self.divide(
+            lanes,
+            r[lanes, d.rs].astype(numpy.int64),
+            r[lanes, d.rt].astype(numpy.int64),
+        )
+
+    def op_mfhi(self, lanes, d, pc):
+        self.registers[lanes, d.rd] = self.hi[lanes]
+
+    def op_mflo(self, lanes, d, pc):
+        self.registers[lanes, d.rd] = self.lo[lanes]
+
+    def op_lw(self, lanes, d, pc):
+        lanes = self.indices(lanes)
+        self.registers[lanes, d.rt] = self.memory[lanes, self.address(lanes, d)]
+
+    def op_sw(self, lanes, d, pc):
+        lanes = self.indices(lanes)
+        self.memory[lanes, self.address(lanes, d)] = self.registers[lanes, d.rt]
+
+    def op_push(self, lanes, d, pc):
+        r = self.registers
+        lanes = self.indices(lanes)
+        value = r[lanes, d.rs]
+        pointer = r[lanes, simulator.stack_pointer] - numpy.uint32(4)
+        r[lanes, simulator.stack_pointer] = pointer
+        self.memory[lanes, (pointer >> 2) & self.mask] = value
+
+    def op_pop(self, lanes, d, pc):
+        r = self.registers
+        lanes = self.indices(lanes)
+        pointer = r[lanes, simulator.stack_pointer]
+        r[lanes, d.rd] = self.memory[lanes, (pointer >> 2) & self.mask]
+        r[lanes, simulator.stack_pointer] += numpy.uint32(4)
+
+    def op_beq(self, lanes, d, pc):
+        r = self.registers
+        self.branch(lanes, r[lanes, d.rs] == r[lanes, d.rt], d, pc)
+
+    def op_bne(self, lanes, d, pc):
+        r = self.registers
+        self.branch(lanes, r[lanes, d.rs] != r[lanes, d.rt], d, pc)
+
+    def op_blez(self, lanes, d, pc):
+        self.branch(lanes, as_signed(self.registers[lanes, d.rs]) <= 0, d, pc)
+
+    def op_bgtz(self, lanes, d, pc):
+        self.branch(lanes, as_signed(self.registers[lanes, d.rs]) > 0, d, pc)
+
+    def op_bltz(self, lanes, d, pc):
+        self.branch(lanes, as_signed(self.registers[lanes, d.rs]) < 0, d, pc)
+
+    def op_j(self, lanes, d, pc):
+        self.pc[lanes] = (d.rs << 21 | d.rt << 16 | d.immediate) & self.mask
+
+    def op_jr(self, lanes, d, pc):
+        self.pc[lanes] = (self.registers[lanes, d.rs] >> 2) & self.mask
+
+    def op_halt(self, lanes, d, pc):
+        self.halted[lanes] = True
+        self.pc[lanes] = pc
+
+    def op_tty(self, lanes, d, pc):
+        characters = (self.registers[lanes, d.rs] & 127).tolist()
+        for lane, character in zip(self.indices(lanes).tolist(), characters):
+            self.output[lane].append(chr(character))
+
+    def op_rnd(self, lanes, d, pc):
+        values = [
+            self.random[lane].getrandbits(32) for lane in self.indices(lanes).tolist()
+        ]
+        self.registers[lanes, d.rd] = values
+
+    def op_kbd(self, lanes, d, pc):
+        keyboard = self.keyboard
+        self.registers[lanes, d.rd] = [
+            ord(keyboard[lane].pop(0)) if keyboard[lane] else 0
+            for lane in self.indices(lanes).tolist()
+        ]
+
+
+if __name__ == "__main__":
+    usage = "%prog image [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option(
+        "-n",
+        "--instances",
+        dest="instances",
+        type="int",
+        default=64,
+        help="Number of instances of the program to run, each with a memory of "
+        "4 bytes per word (1 MiB with the default --memory-words)",
+    )
+    parser.add_option(
+        "-s",
+        "--seed",
+        dest="seed",
+        type="int",
+        default=0,
+        help="Seed of the rnd numbers of the first instance, the next ones "
+        "get the following seeds",
+    )
+    parser.add_option(
+        "-m",
+        "--max-steps",
+        dest="max_steps",
+        type="int",
+        default=10000000,
+        help="Stop after this number of instructions (0: no limit)",
+    )
+    parser.add_option(
+        "-w",
+        "--memory-words",
+        dest="memory_words",
+        type="int",
+        default=simulator.memory_words,
+        help="Words of memory of every instance, a power of 2",
+    )
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Incorrect command line arguments")
+        sys.exit(1)
+
+    try:
+        words = disassembler.read_words(args[0])
+    except (IOError, ValueError) as e:
+        print("Unable to read image %s: %s" % (args[0], e), file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        machines = Lockstep(
+            words,
+            options.instances,
+            range(options.seed, options.seed + options.instances),
+            memory_words=options.memory_words,
+        )
+    except simulator.SimulatorError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+    machines.run(options.max_steps or None)
+    # the distinct outputs with the number of instances printing them
+    outputs = collections.Counter(machines.tty())
+    for output, count in outputs.most_common():
+        print("%6d: %s" % (count, output))
+    for lane, error in sorted(machines.errors.items()):
+        print("instance %d: %s" % (lane, error), file=sys.stderr)
+    running = int((~machines.halted).sum())
+    if running:
+        print("%d instances did not halt" % running, file=sys.stderr)
+        sys.exit(2)
+    sys.exit(1 if machines.errors else 0)
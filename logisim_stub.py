@@ -0,0 +1,64 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import time
+import optparse
+
+import disassembler
+import simulator
+import timing
+
+# Stand-in for the logisim command line used by test.py, so the test suite
+# can run without Java:
+#
+#     logisim_stub.py template.circ -tty halt,tty,speed -load Bank -sub template.circ circuit.circ
+#
+# The program is run on the instruction-set simulator and reported the way
+# Logisim does, with the ticks the timing model estimates.  Those ticks are the
+# model's own, so the stub checks the plumbing of test.py, not the model or the
+# #limit of the tests.  LOGISIM_STUB_DELAY adds that many seconds to every run,
+# like the start of the JVM does.
+
+if __name__ == "__main__":
+    usage = "%prog circuit -tty halt,tty,speed -load image [-sub from to]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--tty", "-t", dest="tty", type="string", default="")
+    parser.add_option("--load", dest="load", type="string", default=None)
+    parser.add_option("--sub", dest="sub", type="string", nargs=2, default=None)
+    # logisim takes its options with a single dash
+    arguments = [
+        "-" + argument if argument in ("-tty", "-load", "-sub") else argument
+        for argument in sys.argv[1:]
+    ]
+    options, args = parser.parse_args(arguments)
+    if options.load is None or len(args) != 1:
+        parser.error("Incorrect command line arguments")
+        sys.exit(1)
+
+    time.sleep(float(os.environ.get("LOGISIM_STUB_DELAY", "0")))
+    start = time.perf_counter()
+    try:
+        words = disassembler.read_words(options.load)
+    except (IOError, ValueError) as e:
+        print("Unable to load image %s: %s" % (options.load, e), file=sys.stderr)
+        sys.exit(1)
+    machine = simulator.Machine(words, count=True)
+    try:
+        machine.run(10000000)
+    except simulator.SimulatorError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+    fields = options.tty.split(",")
+    if "tty" in fields:
+        print(machine.tty())
+    if "halt" in fields and machine.halted:
+        print("halted due to halt pin")
+    if "speed" in fields:
+        ticks = timing.TimingModel().ticks(machine, len(words))
+        milliseconds = max(1, int(1000 * (time.perf_counter() - start)))
+        print(
+            "%d Hz (%d ticks in %d milliseconds)"
+            % (1000 * ticks // milliseconds, ticks, milliseconds)
+        )
+    sys.exit(0)
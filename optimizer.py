@@ -0,0 +1,302 @@
+import collections
+
+import assembler
+
+# instructions that only write their destination register
+pure_writers = {
+    "add",
+    "sub",
+    "slt",
+    "sltu",
+    "and",
+    "or",
+    "nor",
+    "xor",
+    "addi",
+    "slti",
+    "sltiu",
+    "andi",
+    "ori",
+    "xori",
+    "mfhi",
+    "mflo",
+}
+
+# instructions after which execution never falls through
+unconditional = {"j", "halt"}
+
+# register 31 is the stack pointer moved by push and pop
+stack_pointer = 31
+
+
+def destination(instruction):
+    """Return the register written by ``instruction``, or None."""
+    shape = assembler.formats[instruction.instr]
+    if instruction.instr == "push" or not shape:
+        return None
+    if shape[0] == "rd":
+        return instruction.rd
+    if shape[0] == "rt" and instruction.instr != "sw":
+        return instruction.rt
+    return None
+
+
+def sources(instruction):
+    """Return the registers read by ``instruction``."""
+    read = set()
+    shape = assembler.formats[instruction.instr]
+    for position, operand in enumerate(shape):
+        if operand in ("rs", "offset(rs)"):
+            read.add(instruction.rs)
+        elif operand == "rt" and (position > 0 or instruction.instr == "sw"):
+            read.add(instruction.rt)
+    if instruction.instr in ("push", "pop"):
+        read.add(stack_pointer)
+    return read
+
+
+def is_redundant_move(instruction):
+    """True for instructions that leave every register as it was."""
+    instr, rs, rt, rd, immediate = instruction[2:7]
+    if instr in pure_writers and destination(instruction) == 0:
+        return True
+    if instr in ("and", "or") and rd == rs == rt:
+        return True
+    if instr in ("add", "sub", "or", "xor"):
+        return rd == rs and rt == 0 or instr != "sub" and rd == rt and rs == 0
+    if instr in ("addi", "ori", "xori"):
+        return rt == rs and immediate == 0
+    return False
+
+
+def constant(instruction):
+    """Return the 32 bit value loaded by ``instr rX r0 k``, or None."""
+    if instruction.rs != 0 or instruction.instr not in ("addi", "ori", "xori"):
+        return None
+    return instruction.immediate & 0xFFFFFFFF
+
+
+def fold(value, instruction):
+    """Apply ``instr rX rX k`` to the known 32 bit ``value``, or None."""
+    instr, immediate = instruction.instr, instruction.immediate
+    if instr == "addi":
+        return (value + immediate) & 0xFFFFFFFF
+    if instr == "ori":
+        return value | immediate
+    if instr == "xori":
+        return value ^ immediate
+    if instr == "andi":
+        return value & immediate
+    return None
+
+
+def load_constant(instruction, value):
+    """Rewrite ``instruction`` into an ``addi``/``ori`` loading ``value``."""
+    signed = value - 2**32 if value & 0x80000000 else value
+    if -(2**15) <= signed < 2**15:
+        return retext(instruction._replace(instr="addi", rs=0, immediate=signed))
+    if value < 2**16:
+        return retext(instruction._replace(instr="ori", rs=0, immediate=value))
+    return None
+
+
+def retext(instruction):
+    """Refresh the source text of a rewritten ``instruction``."""
+    operands = []
+    for operand in assembler.formats[instruction.instr]:
+        if operand == "label":
+            operands.append(instruction.label)
+        elif operand == "immed":
+            operands.append(str(instruction.immediate))
+        elif operand == "offset(rs)":
+            operands.append("%d(r%d)" % (instruction.immediate, instruction.rs))
+        else:
+            operands.append("r%d" % getattr(instruction, operand))
+    return instruction._replace(text=" ".join([instruction.instr] + operands))
+
+
+class PeepholeOptimizer:
+    """Rewrites parsed instructions into a shorter program doing the same.
+
+    The passes are run until none of them changes the program:
+
+    * dead code: instructions after a ``j``/``halt`` up to the next label some
+      jump or branch refers to;
+    * jump threading: jumps and branches to a ``j`` go straight to its
+      target, ``beq rX rX`` becomes a ``j`` and ``bne rX rX`` is dropped, as
+      are jumps and branches to the next instruction;
+    * redundant moves: ``nop``, writes to ``r0``, moves of a register into
+      itself and writes overwritten by the next instruction before being read;
+    * constant folding: ``addi rX r0 a`` followed by ``addi rX rX b`` (or
+      ``ori``/``xori``/``andi``) becomes a single load of the result.
+
+    ``tty``, ``halt``, ``push``/``pop``, ``rnd``, ``kbd``, memory and HI/LO
+    accesses are never removed unless they are unreachable.  Programs using
+    ``jr`` jump to computed addresses, so their instructions must not move
+    and only jump threading is applied to them.
+
+    ``removed`` counts the instructions removed by each pass and ``threaded``
+    the jumps and branches sent to a new target.
+    """
+
+    def __init__(self):
+        self.removed = collections.Counter()
+        self.threaded = 0
+        self.fixed_addresses = False
+        self.entry_points = set()
+
+    def run(self, instructions, symbols, entry_points=()):
+        """Return the optimized ``instructions``, updating ``symbols`` in place.
+
+        ``entry_points`` are labels reached from outside of the program, such
+        as the ones an object file exports, which must stay reachable.
+        """
+        self.entry_points = set(entry_points)
+        self.fixed_addresses = any(ins.instr == "jr" for ins in instructions)
+        changed = True
+        while changed:
+            changed = self.thread_jumps(instructions, symbols)
+            if self.fixed_addresses:
+                continue
+            for optimization in [
+                self.remove_dead_code,
+                self.remove_useless_jumps,
+                self.remove_redundant_moves,
+                self.fold_constants,
+            ]:
+                kept = optimization(instructions, symbols)
+                if kept is not None:
+                    instructions = self.compact(instructions, symbols, kept)
+                    changed = True
+        return instructions
+
+    def total(self):
+        return sum(self.removed.values())
+
+    def summary(self):
+        if self.fixed_addresses and not self.threaded:
+            return "not optimized, it uses jr"
+        details = ", ".join(
+            "%s %d" % (name, count) for name, count in sorted(self.removed.items())
+        )
+        return "%d instructions removed (%s), %d jumps threaded" % (
+            self.total(),
+            details or "none",
+            self.threaded,
+        )
+
+    @staticmethod
+    def compact(instructions, symbols, kept):
+        """Drop the instructions not ``kept`` and move the labels after them.
+
+        A label on a removed instruction moves to the next one that is kept.
+        """
+        position = [0]
+        for keep in kept:
+            position.append(position[-1] + keep)
+        for label, index in symbols.items():
+            symbols[label] = position[index]
+        return [ins for ins, keep in zip(instructions, kept) if keep]
+
+    def targets(self, instructions, symbols):
+        """Return the positions some jump or branch can go to."""
+        targets = {symbols[ins.label] for ins in instructions if ins.label in symbols}
+        targets.update(symbols[label] for label in self.entry_points)
+        return targets
+
+    def thread_jumps(self, instructions, symbols):
+        changed = False
+        for i, ins in enumerate(instructions):
+            if ins.label is None or ins.label not in symbols:
+                continue
+            if ins.instr == "beq" and ins.rs == ins.rt:
+                # always taken
+                ins = instructions[i] = retext(
+                    ins._replace(instr="j", rs=0, rt=0, rd=0, immediate=0)
+                )
+                changed = True
+            label = ins.label
+            seen = {i}
+            index = symbols[label]
+            while (
+                index < len(instructions)
+                and index not in seen
+                and instructions[index].instr == "j"
+                and instructions[index].label in symbols
+            ):
+                seen.add(index)
+                label = instructions[index].label
+                index = symbols[label]
+            if label != ins.label:
+                instructions[i] = retext(ins._replace(label=label))
+                self.threaded += 1
+                changed = True
+        return changed
+
+    def remove_dead_code(self, instructions, symbols):
+        targets = self.targets(instructions, symbols)
+        kept = [True] * len(instructions)
+        reachable = True
+        for i, ins in enumerate(instructions):
+            if i in targets:
+                reachable = True
+            if not reachable:
+                kept[i] = False
+                self.removed["dead code"] += 1
+            elif ins.instr in unconditional:
+                reachable = False
+        return None if all(kept) else kept
+
+    def remove_useless_jumps(self, instructions, symbols):
+        kept = [True] * len(instructions)
+        for i, ins in enumerate(instructions):
+            if ins.label is None or ins.label not in symbols:
+                continue
+            never_taken = ins.instr == "bne" and ins.rs == ins.rt
+            if never_taken or symbols[ins.label] == i + 1:
+                kept[i] = False
+                self.removed["useless jumps"] += 1
+        return None if all(kept) else kept
+
+    def remove_redundant_moves(self, instructions, symbols):
+        kept = [True] * len(instructions)
+        for i, ins in enumerate(instructions):
+            if ins.instr == "nop":
+                kept[i] = False
+                self.removed["nops"] += 1
+            elif is_redundant_move(ins):
+                kept[i] = False
+                self.removed["redundant moves"] += 1
+            elif ins.instr in pure_writers and i + 1 < len(instructions):
+                # overwritten by the next instruction before anyone reads it
+                following = instructions[i + 1]
+                register = destination(ins)
+                if destination(following) == register and register not in sources(
+                    following
+                ):
+                    kept[i] = False
+                    self.removed["redundant moves"] += 1
+        return None if all(kept) else kept
+
+    def fold_constants(self, instructions, symbols):
+        targets = self.targets(instructions, symbols)
+        kept = [True] * len(instructions)
+        i = 0
+        while i + 1 < len(instructions):
+            ins, following = instructions[i], instructions[i + 1]
+            value = constant(ins)
+            if (
+                value is not None
+                and ins.rt != 0
+                and i + 1 not in targets
+                and following.rt == following.rs == ins.rt
+                and following.instr in ("addi", "ori", "xori", "andi")
+            ):
+                folded = load_constant(following, fold(value, following))
+                if folded is not None:
+                    instructions[i + 1] = folded
+                    kept[i] = False
+                    self.removed["constants folded"] += 1
+                    i += 1
+            i += 1
+        return None if all(kept) else kept
@@ -0,0 +1,343 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import optparse
+from array import array
+
+import assembler
+import disassembler
+import simulator
+import timing
+
+# mnemonics in the order of the histogram of a profile
+mnemonics = sorted(simulator.execute)
+
+
+class SourceMap:
+    """Where the instructions of a program come from.
+
+    ``lines`` maps an instruction number to its source line number and
+    text, ``labels`` to the first label naming it.
+    """
+
+    def __init__(self, lines, symbols):
+        self.lines = lines
+        self.labels = {}
+        for label, index in sorted(symbols.items(), key=lambda item: item[1]):
+            self.labels.setdefault(index, label)
+
+    @classmethod
+    def from_source(cls, source):
+        """Map the instructions of the assembly ``source`` lines."""
+        source = list(source)
+        symbols = assembler.fill_symbol_table(source)
+        lines = {
+            index: (instruction.lineNo, instruction.text)
+            for index, instruction in enumerate(
+                assembler.parse_instructions(source, {})
+            )
+        }
+        return cls(lines, symbols)
+
+    @classmethod
+    def from_words(cls, words):
+        """Map a program without its source, as the disassembler prints it."""
+        labels = disassembler.find_labels(words)
+        lines = {
+            index: (None, disassembler.format_instruction(index, word, labels))
+            for index, word in enumerate(words)
+        }
+        return cls(lines, {label: index for index, label in labels.items()})
+
+    def describe(self, index):
+        """Return ``line N: text`` for the instruction at ``index``."""
+        line, text = self.lines.get(index, (None, "?"))
+        if line is None:
+            return "%d: %s" % (index, text)
+        return "line %d: %s" % (line, text)
+
+    def name(self, index):
+        return self.labels.get(index, "@%d" % index)
+
+    def function(self, index):
+        """Return the closest label at or before ``index``."""
+        best = None
+        for position, label in self.labels.items():
+            if position <= index and (best is None or position > best[0]):
+                best = (position, label)
+        return best[1] if best else "start"
+
+
+class Loop:
+    """A backward branch or jump taken at least once.
+
+    The loop runs from the ``head`` the branch goes to up to the ``tail``
+    holding the branch; ``iterations`` is the number of times the branch
+    ran and ``instructions`` the runs of the instructions between both.
+    """
+
+    def __init__(self, head, tail, iterations, instructions):
+        self.head = head
+        self.tail = tail
+        self.iterations = iterations
+        self.instructions = instructions
+
+    def contains(self, index):
+        return self.head <= index <= self.tail
+
+
+class Profile:
+    """Execution counts of a program run on a ``count`` machine.
+
+    Every counter is an ``array`` indexed by instruction number (``runs``,
+    ``taken`` and ``cycles``) or by the position of the mnemonic in
+    ``mnemonics`` (``histogram``), so building and reading them stays cheap
+    even for long runs.
+    """
+
+    def __init__(self, machine, words, model=None):
+        model = model or timing.TimingModel()
+        executions = machine.executions()
+        size = max([len(words)] + [pc + 1 for pc in executions])
+        self.size = size
+        self.steps = machine.steps
+        self.runs = array("Q", bytes(8 * size))
+        self.taken = array("Q", machine.taken[:size])
+        self.cycles = array("Q", bytes(8 * size))
+        self.histogram = array("Q", bytes(8 * len(mnemonics)))
+        self.records = [simulator.predecode(word) for word in machine.memory[:size]]
+        position = {instr: i for i, instr in enumerate(mnemonics)}
+        for pc, times in executions.items():
+            record = self.records[pc]
+            self.runs[pc] = times
+            self.cycles[pc] = times * model.instruction_cycles(record.instr)
+            self.histogram[position[record.instr]] += times
+        self.load_cycles = model.load_cycles(len(words))
+        self.ticks_per_cycle = model.ticks_per_cycle
+
+    def total_cycles(self):
+        return self.load_cycles + sum(self.cycles)
+
+    def branches(self):
+        """Yield ``(pc, runs, taken)`` for every branch or jump that ran."""
+        for pc, record in enumerate(self.records):
+            if record and record.instr in simulator.conditions and self.runs[pc]:
+                yield pc, self.runs[pc], self.taken[pc]
+
+    def loops(self):
+        """Return the ``Loop`` of every backward branch, outermost first."""
+        loops = []
+        for pc, runs, taken in self.branches():
+            head = simulator.target(pc, self.records[pc])
+            if head <= pc and taken:
+                body = sum(self.runs[head : pc + 1])
+                loops.append(Loop(head, pc, runs, body))
+        loops.sort(key=lambda loop: (loop.head, -loop.tail))
+        return loops
+
+    def hot(self, limit):
+        """Return the ``limit`` instruction numbers taking the most cycles."""
+        ran = [pc for pc in range(self.size) if self.runs[pc]]
+        ran.sort(key=lambda pc: -self.cycles[pc])
+        return ran[:limit]
+
+
+def percent(part, whole):
+    return 100.0 * part / whole if whole else 0.0
+
+
+def report(profile, source_map, name, limit=20, file=sys.stdout):
+    """Write the text report of ``profile``."""
+    cycles = profile.total_cycles()
+    print(
+        "%s: %d instructions, %d cycles (%d loading), %d ticks"
+        % (
+            name,
+            profile.steps,
+            cycles,
+            profile.load_cycles,
+            cycles * profile.ticks_per_cycle,
+        ),
+        file=file,
+    )
+
+    print("\nHot instructions", file=file)
+    print("%12s %12s %6s  %s" % ("runs", "cycles", "%", "instruction"), file=file)
+    for pc in profile.hot(limit):
+        print(
+            "%12d %12d %5.1f%%  %-12s %s"
+            % (
+                profile.runs[pc],
+                profile.cycles[pc],
+                percent(profile.cycles[pc], cycles),
+                source_map.function(pc),
+                source_map.describe(pc),
+            ),
+            file=file,
+        )
+
+    print("\nInstruction mix", file=file)
+    mix = sorted(
+        (count, instr) for instr, count in zip(mnemonics, profile.histogram) if count
+    )
+    for count, instr in reversed(mix):
+        print(
+            "%12d %5.1f%%  %s" % (count, percent(count, profile.steps), instr),
+            file=file,
+        )
+
+    print("\nBranches", file=file)
+    print("%12s %12s %6s  %s" % ("runs", "taken", "%", "instruction"), file=file)
+    for pc, runs, taken in profile.branches():
+        print(
+            "%12d %12d %5.1f%%  %s"
+            % (runs, taken, percent(taken, runs), source_map.describe(pc)),
+            file=file,
+        )
+
+    print("\nLoops", file=file)
+    print(
+        "%12s %12s %12s  %s" % ("iterations", "runs", "per iter.", "loop"),
+        file=file,
+    )
+    for loop in profile.loops():
+        print(
+            "%12d %12d %12.1f  %s .. %s"
+            % (
+                loop.iterations,
+                loop.instructions,
+                loop.instructions / loop.iterations,
+                source_map.name(loop.head),
+                source_map.describe(loop.tail),
+            ),
+            file=file,
+        )
+
+
+def folded_stacks(profile, source_map, name):
+    """Yield the lines of a folded-stack file weighted by cycles.
+
+    Each instruction is nested under the loops holding it, outermost first,
+    as flamegraph.pl and speedscope expect: ``frame;frame;... cycles``.
+    """
+    loops = profile.loops()
+    if profile.load_cycles:
+        yield "%s;load %d\n" % (name, profile.load_cycles)
+    for pc in range(profile.size):
+        if not profile.cycles[pc]:
+            continue
+        frames = [name]
+        frames += [
+            "loop %s" % source_map.name(loop.head)
+            for loop in loops
+            if loop.contains(pc)
+        ]
+        frames.append(source_map.describe(pc))
+        frames = [frame.replace(";", ",") for frame in frames]
+        yield "%s %d\n" % (";".join(frames), profile.cycles[pc])
+
+
+def load_program(path):
+    """Return the words and ``SourceMap`` of a .asm source or an image."""
+    if path.endswith(".asm"):
+        with open(path, "r") as source:
+            lines = source.readlines()
+        words, symbols = assembler.assemble(lines)
+        return words, SourceMap.from_source(lines)
+    words = disassembler.read_words(path)
+    return words, SourceMap.from_words(words)
+
+
+if __name__ == "__main__":
+    usage = "%prog program.asm|image [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option(
+        "-f",
+        "--folded",
+        dest="folded",
+        type="string",
+        default=None,
+        help="Also write the cycles as folded stacks to this file, for flame graphs",
+    )
+    parser.add_option(
+        "-n",
+        "--top",
+        dest="top",
+        type="int",
+        default=20,
+        help="Number of hot instructions to list",
+    )
+    parser.add_option(
+        "-c",
+        "--costs",
+        dest="costs",
+        type="string",
+        default=None,
+        help="JSON cost table changing the default timing model",
+    )
+    parser.add_option(
+        "-m",
+        "--max-steps",
+        dest="max_steps",
+        type="int",
+        default=10000000,
+        help="Stop after this number of instructions (0: no limit)",
+    )
+    parser.add_option(
+        "-k",
+        "--keyboard",
+        dest="keyboard",
+        type="string",
+        default="",
+        help="Characters read by kbd, 0 is read once they run out",
+    )
+    parser.add_option(
+        "-s",
+        "--seed",
+        dest="seed",
+        type="int",
+        default=None,
+        help="Seed of the numbers returned by rnd",
+    )
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Incorrect command line arguments")
+        sys.exit(1)
+
+    try:
+        model = (
+            timing.TimingModel.read(options.costs)
+            if options.costs
+            else timing.TimingModel()
+        )
+        words, source_map = load_program(args[0])
+    except (assembler.AssemblerError, IOError, ValueError, TypeError) as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+
+    machine = simulator.Machine(words, options.keyboard, options.seed, count=True)
+    try:
+        halted = machine.run(options.max_steps or None)
+    except simulator.SimulatorError as e:
+        print(str(e), file=sys.stderr)
+        halted = False
+    path = os.path.normpath(args[0])
+    if os.path.basename(path) in ["Bank"] + assembler.bank_names:
+        path = os.path.dirname(path)
+    name = os.path.splitext(os.path.basename(os.path.abspath(path)))[0]
+    profile = Profile(machine, words, model)
+    report(profile, source_map, name, options.top)
+    if not halted:
+        print(
+            "\nstopped after %d instructions without halting" % machine.steps,
+            file=sys.stderr,
+        )
+    if options.folded:
+        try:
+            with open(options.folded, "w") as file:
+                file.writelines(folded_stacks(profile, source_map, name))
+        except IOError as e:
+            print("Unable to write %s: %s" % (options.folded, e), file=sys.stderr)
+            sys.exit(1)
+    sys.exit(0 if halted else 2)
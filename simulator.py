@@ -0,0 +1,831 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import json
+import mmap
+import random
+import optparse
+import functools
+import collections
+from array import array
+
+import assembler
+import disassembler
+
+# the RAM of the board is made of four banks of 2**16 words
+memory_words = 2**18
+
+word_mask = 0xFFFFFFFF
+
+# register 31 is the stack pointer moved by push and pop
+stack_pointer = 31
+
+# instructions ending a basic block
+terminators = {"j", "jr", "beq", "bne", "blez", "bgtz", "bltz", "halt"}
+
+# longest run of instructions translated into a single block
+max_block = 256
+
+# snapshots hold the memory in pages of this many words, a power of 2
+page_words = 1024
+page_shift = page_words.bit_length() - 1
+
+
+class SimulatorError(Exception):
+    pass
+
+
+def signed(value):
+    """Return the 32 bit ``value`` as a signed integer."""
+    return value - 2**32 if value & 0x80000000 else value
+
+
+def signed16(immediate):
+    return immediate - 65536 if immediate & 32768 else immediate
+
+
+class Machine:
+    """Instruction-set simulator of a S-MIPS processor.
+
+    The program is loaded at address 0 of a single word-addressed memory, as
+    the RAM Dispatcher does, and runs from there until ``halt``.  The program
+    counter is kept as an instruction number; ``jr`` and memory operands use
+    byte addresses like the real processor, ignoring their two low bits.
+
+    ``output`` collects the characters sent to the tty, ``keyboard`` holds the
+    characters ``kbd`` reads (0 once it is empty) and ``seed`` seeds ``rnd``.
+    ``steps`` counts the instructions executed.  With ``count`` the machine
+    also counts how many times each instruction runs, see ``executions``, and
+    in ``taken`` how many times each branch or jump went somewhere else than
+    the next instruction.
+
+    The memory is a list, or a file mapped into memory when ``memory_file``
+    is given, which keeps its image on disk for other tools to look at.
+    ``dirty`` marks the pages of ``page_words`` words the program was loaded
+    into or stored to, the only ones that may hold something other than 0.
+    """
+
+    def __init__(self, words, keyboard="", seed=None, count=False, memory_file=None):
+        if len(words) > memory_words:
+            raise SimulatorError(
+                "program of %d words does not fit in memory" % len(words)
+            )
+        self.mapping = None
+        if memory_file is None:
+            self.memory = list(words) + [0] * (memory_words - len(words))
+        else:
+            self.memory = self.map_memory(memory_file)
+            self.memory[: len(words)] = array(assembler.word_typecode, words)
+        self.dirty = bytearray(memory_words // page_words)
+        for start in range(0, len(words), page_words):
+            self.dirty[start >> page_shift] = 1
+        self.registers = [0] * 32
+        self.hi = 0
+        self.lo = 0
+        self.pc = 0
+        self.steps = 0
+        self.halted = False
+        self.output = []
+        self.keyboard = list(keyboard)
+        self.random = random.Random(seed)
+        # translated blocks by their first instruction, and the words of
+        # memory some block was translated from
+        self.blocks = {}
+        self.code = bytearray(memory_words)
+        # (first instruction, length) -> times a run of instructions ran
+        self.counts = collections.Counter() if count else None
+        self.taken = array("Q", bytes(8 * memory_words)) if count else None
+
+    def map_memory(self, path):
+        """Return the words of a file of the size of the memory, all 0."""
+        size = memory_words * array(assembler.word_typecode).itemsize
+        with open(path, "w+b") as file:
+            file.truncate(size)
+            self.mapping = mmap.mmap(file.fileno(), size)
+        return memoryview(self.mapping).cast(assembler.word_typecode)
+
+    def close(self):
+        """Release the file mapped as memory, if any."""
+        if self.mapping is not None:
+            self.memory.release()
+            self.mapping.close()
+            self.mapping = None
+
+    def address(self, register, immediate):
+        """Word of memory at ``offset(register)``."""
+        byte = (self.registers[register] + signed16(immediate)) & word_mask
+        return (byte >> 2) & (memory_words - 1)
+
+    def store(self, address, value):
+        self.memory[address] = value
+        self.dirty[address >> page_shift] = 1
+        if self.code[address]:
+            self.invalidate()
+
+    def invalidate(self):
+        """Forget the translated blocks, the program wrote into its code."""
+        self.blocks.clear()
+        self.code = bytearray(memory_words)
+
+    def step(self):
+        """Execute the instruction at ``pc``."""
+        record = predecode(self.memory[self.pc])
+        if record is None:
+            raise SimulatorError(
+                "invalid instruction 0x%08x at address %d"
+                % (self.memory[self.pc], self.pc * 4)
+            )
+        pc = self.pc
+        following = self.pc = (pc + 1) & (memory_words - 1)
+        self.steps += 1
+        execute[record.instr](self, record.rs, record.rt, record.rd, record.immediate)
+        self.registers[0] = 0
+        if self.counts is not None:
+            self.counts[pc, 1] += 1
+            if record.instr in conditions and self.pc != following:
+                self.taken[pc] += 1
+
+    def translate(self, pc):
+        """Return the block starting at ``pc`` and its length, translating it."""
+        records = []
+        index = pc
+        while len(records) < max_block:
+            record = predecode(self.memory[index])
+            if record is None:
+                break
+            records.append(record)
+            index = (index + 1) & (memory_words - 1)
+            if record.instr in terminators:
+                break
+        if not records:
+            raise SimulatorError(
+                "invalid instruction 0x%08x at address %d" % (self.memory[pc], pc * 4)
+            )
+        words = []
+        for offset in range(len(records)):
+            index = (pc + offset) & (memory_words - 1)
+            self.code[index] = 1
+            words.append(self.memory[index])
+        function = compile_block(pc, tuple(words), self.counts is not None)
+        block = self.blocks[pc] = (function, len(records))
+        return block
+
+    def run(self, max_steps=None, translate=True):
+        """Run until ``halt`` or ``max_steps`` instructions, return if halted.
+
+        Straight-line runs of instructions are translated into Python
+        functions the first time they run, unless ``translate`` is False, in
+        which case the instructions are executed one at a time.
+        """
+        step = self.step
+        if not translate:
+            while not self.halted:
+                if max_steps is not None and self.steps >= max_steps:
+                    return False
+                step()
+            return True
+        registers, memory, output = self.registers, self.memory, self.output
+        blocks = self.blocks
+        limit = 2**63 if max_steps is None else max_steps
+        while not self.halted:
+            pc = self.pc
+            function, length = blocks.get(pc) or self.translate(pc)
+            steps = self.steps + length
+            if steps > limit:
+                # finish the last instructions one at a time
+                if self.steps >= limit:
+                    return False
+                step()
+                continue
+            self.steps = steps
+            self.pc = function(
+                self, registers, memory, self.code, output, limit - steps
+            )
+        return True
+
+    def tty(self):
+        return "".join(self.output)
+
+    def snapshot(self):
+        """Return a ``Snapshot`` of the state of the machine.
+
+        Only the ``dirty`` pages are looked at and those holding something
+        other than 0 kept, so it takes time and space in proportion to the
+        program and the data it touched rather than to the memory.
+        """
+        pages = {}
+        memory = self.memory
+        for index, dirty in enumerate(self.dirty):
+            if dirty:
+                page = memory[index * page_words : (index + 1) * page_words]
+                if any(page):
+                    pages[index] = array(assembler.word_typecode, page)
+        return Snapshot(
+            self.pc,
+            list(self.registers),
+            self.hi,
+            self.lo,
+            self.steps,
+            self.halted,
+            self.tty(),
+            "".join(self.keyboard),
+            self.random.getstate(),
+            pages,
+        )
+
+    def restore(self, snapshot):
+        """Put the machine back in the state of ``snapshot``."""
+        memory = self.memory
+        zeros = array(assembler.word_typecode, [0] * page_words)
+        for index, dirty in enumerate(self.dirty):
+            if dirty and index not in snapshot.pages:
+                memory[index * page_words : (index + 1) * page_words] = zeros
+        self.dirty = bytearray(memory_words // page_words)
+        for index, page in snapshot.pages.items():
+            memory[index * page_words : (index + 1) * page_words] = page
+            self.dirty[index] = 1
+        self.registers[:] = snapshot.registers
+        self.hi = snapshot.hi
+        self.lo = snapshot.lo
+        self.pc = snapshot.pc
+        self.steps = snapshot.steps
+        self.halted = snapshot.halted
+        self.output[:] = list(snapshot.output)
+        self.keyboard[:] = list(snapshot.keyboard)
+        self.random.setstate(snapshot.random_state)
+        self.invalidate()
+
+    def executions(self):
+        """Return how many times the instruction at each address ran.
+
+        Only available on machines created with ``count``.
+        """
+        executions = collections.Counter()
+        for (pc, length), times in self.counts.items():
+            for offset in range(length):
+                executions[(pc + offset) & (memory_words - 1)] += times
+        return executions
+
+
+class Snapshot:
+    """The state of a ``Machine``: registers, memory, tty, keyboard and rnd.
+
+    ``pages`` maps the number of every page of memory not all 0 to its
+    words.  Snapshots are written as a line of JSON with everything else
+    followed by the words of the pages, in the byte order of the machine
+    writing them.
+    """
+
+    def __init__(
+        self,
+        pc,
+        registers,
+        hi,
+        lo,
+        steps,
+        halted,
+        output,
+        keyboard,
+        random_state,
+        pages,
+    ):
+        self.pc = pc
+        self.registers = registers
+        self.hi = hi
+        self.lo = lo
+        self.steps = steps
+        self.halted = halted
+        self.output = output
+        self.keyboard = keyboard
+        self.random_state = random_state
+        self.pages = pages
+
+    def write(self, path):
+        version, internal, gauss = self.random_state
+        indices = sorted(self.pages)
+        header = {
+            "pc": self.pc,
+            "registers": self.registers,
+            "hi": self.hi,
+            "lo": self.lo,
+            "steps": self.steps,
+            "halted": self.halted,
+            "output": self.output,
+            "keyboard": self.keyboard,
+            "random": [version, list(internal), gauss],
+            "page_words": page_words,
+            "pages": indices,
+        }
+        with open(path, "wb") as file:
+            file.write(json.dumps(header).encode() + b"\n")
+            for index in indices:
+                file.write(self.pages[index].tobytes())
+
+    @classmethod
+    def read(cls, path):
+        with open(path, "rb") as file:
+            header = json.loads(file.readline())
+            data = array(assembler.word_typecode)
+            data.frombytes(file.read())
+        if header["page_words"] != page_words:
+            raise ValueError("snapshot with pages of %d words" % header["page_words"])
+        if len(data) != len(header["pages"]) * page_words:
+            raise ValueError("truncated snapshot")
+        pages = {
+            index: data[i * page_words : (i + 1) * page_words]
+            for i, index in enumerate(header["pages"])
+        }
+        version, internal, gauss = header["random"]
+        return cls(
+            header["pc"],
+            header["registers"],
+            header["hi"],
+            header["lo"],
+            header["steps"],
+            header["halted"],
+            header["output"],
+            header["keyboard"],
+            (version, tuple(internal), gauss),
+            pages,
+        )
+
+
+def set_register(machine, register, value):
+    machine.registers[register] = value & word_mask
+
+
+def branch(machine, taken, immediate):
+    if taken:
+        machine.pc = (machine.pc + signed16(immediate)) & (memory_words - 1)
+
+
+def multiply(machine, product):
+    machine.hi = product >> 32 & word_mask
+    machine.lo = product & word_mask
+
+
+def divide(machine, dividend, divisor):
+    # the quotient is rounded towards zero and the remainder is always
+    # positive, as the SignDivider does (see tests/div-mult-bne.asm); HI/LO are
+    # left as they were when dividing by zero
+    if divisor == 0:
+        return
+    quotient = abs(dividend) // abs(divisor)
+    if (dividend < 0) != (divisor < 0):
+        quotient = -quotient
+    machine.lo = quotient & word_mask
+    machine.hi = abs(dividend) % abs(divisor)
+
+
+def push(machine, rs):
+    registers = machine.registers
+    value = registers[rs]
+    registers[stack_pointer] = (registers[stack_pointer] - 4) & word_mask
+    machine.store(machine.address(stack_pointer, 0), value)
+
+
+def pop(machine, rd):
+    registers = machine.registers
+    registers[rd] = machine.memory[machine.address(stack_pointer, 0)]
+    registers[stack_pointer] = (registers[stack_pointer] + 4) & word_mask
+
+
+def halt(machine):
+    machine.halted = True
+    # halt stops the processor without moving past it
+    machine.pc = (machine.pc - 1) & (memory_words - 1)
+
+
+def kbd(machine, rd):
+    keyboard = machine.keyboard
+    machine.registers[rd] = ord(keyboard.pop(0)) if keyboard else 0
+
+
+# mnemonic -> function(machine, rs, rt, rd, immediate) executing it
+execute = {
+    "nop": lambda m, rs, rt, rd, imm: None,
+    "add": lambda m, rs, rt, rd, imm: set_register(
+        m, rd, m.registers[rs] + m.registers[rt]
+    ),
+    "sub": lambda m, rs, rt, rd, imm: set_register(
+        m, rd, m.registers[rs] - m.registers[rt]
+    ),
+    "mult": lambda m, rs, rt, rd, imm: multiply(
+        m, signed(m.registers[rs]) * signed(m.registers[rt])
+    ),
+    "mulu": lambda m, rs, rt, rd, imm: multiply(m, m.registers[rs] * m.registers[rt]),
+    "div": lambda m, rs, rt, rd, imm: divide(
+        m, signed(m.registers[rs]), signed(m.registers[rt])
+    ),
+    "divu": lambda m, rs, rt, rd, imm: divide(m, m.registers[rs], m.registers[rt]),
+    "slt": lambda m, rs, rt, rd, imm: set_register(
+        m, rd, signed(m.registers[rs]) < signed(m.registers[rt])
+    ),
+    "sltu": lambda m, rs, rt, rd, imm: set_register(
+        m, rd, m.registers[rs] < m.registers[rt]
+    ),
+    "and": lambda m, rs, rt, rd, imm: set_register(
+        m, rd, m.registers[rs] & m.registers[rt]
+    ),
+    "or": lambda m, rs, rt, rd, imm: set_register(
+        m, rd, m.registers[rs] | m.registers[rt]
+    ),
+    "nor": lambda m, rs, rt, rd, imm: set_register(
+        m, rd, ~(m.registers[rs] | m.registers[rt])
+    ),
+    "xor": lambda m, rs, rt, rd, imm: set_register(
+        m, rd, m.registers[rs] ^ m.registers[rt]
+    ),
+    "addi": lambda m, rs, rt, rd, imm: set_register(
+        m, rt, m.registers[rs] + signed16(imm)
+    ),
+    "slti": lambda m, rs, rt, rd, imm: set_register(
+        m, rt, signed(m.registers[rs]) < signed16(imm)
+    ),
+    "sltiu": lambda m, rs, rt, rd, imm: set_register(m, rt, m.registers[rs] < imm),
+    "andi": lambda m, rs, rt, rd, imm: set_register(m, rt, m.registers[rs] & imm),
+    "ori": lambda m, rs, rt, rd, imm: set_register(m, rt, m.registers[rs] | imm),
+    "xori": lambda m, rs, rt, rd, imm: set_register(m, rt, m.registers[rs] ^ imm),
+    "lw": lambda m, rs, rt, rd, imm: set_register(m, rt, m.memory[m.address(rs, imm)]),
+    "sw": lambda m, rs, rt, rd, imm: m.store(m.address(rs, imm), m.registers[rt]),
+    "push": lambda m, rs, rt, rd, imm: push(m, rs),
+    "pop": lambda m, rs, rt, rd, imm: pop(m, rd),
+    "beq": lambda m, rs, rt, rd, imm: branch(
+        m, m.registers[rs] == m.registers[rt], imm
+    ),
+    "bne": lambda m, rs, rt, rd, imm: branch(
+        m, m.registers[rs] != m.registers[rt], imm
+    ),
+    "blez": lambda m, rs, rt, rd, imm: branch(m, signed(m.registers[rs]) <= 0, imm),
+    "bgtz": lambda m, rs, rt, rd, imm: branch(m, signed(m.registers[rs]) > 0, imm),
+    "bltz": lambda m, rs, rt, rd, imm: branch(m, signed(m.registers[rs]) < 0, imm),
+    # the 26 bit target is split over the rs, rt and immediate fields
+    "j": lambda m, rs, rt, rd, imm: setattr(
+        m, "pc", (rs << 21 | rt << 16 | imm) & (memory_words - 1)
+    ),
+    "jr": lambda m, rs, rt, rd, imm: setattr(
+        m, "pc", (m.registers[rs] >> 2) & (memory_words - 1)
+    ),
+    "mfhi": lambda m, rs, rt, rd, imm: set_register(m, rd, m.hi),
+    "mflo": lambda m, rs, rt, rd, imm: set_register(m, rd, m.lo),
+    "halt": lambda m, rs, rt, rd, imm: halt(m),
+    "tty": lambda m, rs, rt, rd, imm: m.output.append(chr(m.registers[rs] & 127)),
+    "rnd": lambda m, rs, rt, rd, imm: set_register(m, rd, m.random.getrandbits(32)),
+    "kbd": lambda m, rs, rt, rd, imm: kbd(m, rd),
+}
+
+
+class Decoded:
+    """The fields of an instruction word, decoded once for every word."""
+
+    __slots__ = ("instr", "rs", "rt", "rd", "immediate")
+
+    def __init__(self, instr, rs, rt, rd, immediate):
+        self.instr = instr
+        self.rs = rs
+        self.rt = rt
+        self.rd = rd
+        self.immediate = immediate
+
+
+@functools.lru_cache(maxsize=65536)
+def predecode(word):
+    """Return the ``Decoded`` record of ``word``, or None if it is no instruction."""
+    instr = disassembler.decode(word)
+    if instr is None:
+        return None
+    return Decoded(
+        instr, word >> 21 & 31, word >> 16 & 31, word >> 11 & 31, word & 65535
+    )
+
+
+def signed_source(expression):
+    return "((%s) ^ 2147483648) - 2147483648" % expression
+
+
+# mnemonic -> source of the statements executing it in a block, formatted
+# with the fields of the instruction (``simm`` is the sign-extended immediate,
+# ``RS``/``RT`` the value read from a register, a literal 0 for r0) and the
+# registers ``r``, the memory ``mem`` and the tty ``out`` of the block.
+# Flipping the sign bit of two words compares them as signed numbers.
+statements = {
+    "nop": [],
+    "add": ["r[{rd}] = ({RS} + {RT}) & 4294967295"],
+    "sub": ["r[{rd}] = ({RS} - {RT}) & 4294967295"],
+    "mult": [
+        "p = (%s) * (%s)" % (signed_source("{RS}"), signed_source("{RT}")),
+        "m.hi = p >> 32 & 4294967295",
+        "m.lo = p & 4294967295",
+    ],
+    "mulu": [
+        "p = {RS} * {RT}",
+        "m.hi = p >> 32 & 4294967295",
+        "m.lo = p & 4294967295",
+    ],
+    "div": ["divide(m, %s, %s)" % (signed_source("{RS}"), signed_source("{RT}"))],
+    "divu": ["divide(m, {RS}, {RT})"],
+    "slt": ["r[{rd}] = 1 if {RS} ^ 2147483648 < {RT} ^ 2147483648 else 0"],
+    "sltu": ["r[{rd}] = 1 if {RS} < {RT} else 0"],
+    "and": ["r[{rd}] = {RS} & {RT}"],
+    "or": ["r[{rd}] = {RS} | {RT}"],
+    "nor": ["r[{rd}] = ~({RS} | {RT}) & 4294967295"],
+    "xor": ["r[{rd}] = {RS} ^ {RT}"],
+    "addi": ["r[{rt}] = ({RS} + {simm}) & 4294967295"],
+    "slti": ["r[{rt}] = 1 if {RS} ^ 2147483648 < {simm} + 2147483648 else 0"],
+    "sltiu": ["r[{rt}] = 1 if {RS} < {imm} else 0"],
+    "andi": ["r[{rt}] = {RS} & {imm}"],
+    "ori": ["r[{rt}] = {RS} | {imm}"],
+    "xori": ["r[{rt}] = {RS} ^ {imm}"],
+    "lw": ["r[{rt}] = mem[({RS} + {simm}) >> 2 & {words}]"],
+    "sw": ["a = ({RS} + {simm}) >> 2 & {words}", "mem[a] = {RT}"],
+    "push": [
+        "v = {RS}",
+        "sp = r[31] = (r[31] - 4) & 4294967295",
+        "a = sp >> 2 & {words}",
+        "mem[a] = v",
+    ],
+    "pop": [
+        "r[{rd}] = mem[r[31] >> 2 & {words}]",
+        "r[31] = (r[31] + 4) & 4294967295",
+        "r[0] = 0",
+    ],
+    "mfhi": ["r[{rd}] = m.hi"],
+    "mflo": ["r[{rd}] = m.lo"],
+    "tty": ["out.append(chr({RS} & 127))"],
+    "rnd": ["r[{rd}] = m.random.getrandbits(32)", "r[0] = 0"],
+    "kbd": ["kbd(m, {rd})", "r[0] = 0"],
+    "jr": ["return {RS} >> 2 & {words}"],
+    "halt": ["m.halted = True", "return {pc}"],
+}
+
+# mnemonic -> condition under which a branch or jump is taken
+conditions = {
+    "beq": "{RS} == {RT}",
+    "bne": "{RS} != {RT}",
+    "blez": "{RS} == 0 or {RS} > 2147483647",
+    "bgtz": "0 < {RS} < 2147483648",
+    "bltz": "{RS} > 2147483647",
+    "j": "True",
+}
+
+# instructions with nothing but a register write to do, skipped when they
+# write r0
+register_writers = {
+    instr
+    for instr, lines in statements.items()
+    if len(lines) == 1 and lines[0].startswith(("r[{rd}] =", "r[{rt}] ="))
+}
+
+
+def target(pc, record):
+    """Return the instruction the jump or branch ``record`` at ``pc`` goes to."""
+    if record.instr == "j":
+        return (record.rs << 21 | record.rt << 16 | record.immediate) & (
+            memory_words - 1
+        )
+    return (pc + 1 + signed16(record.immediate)) & (memory_words - 1)
+
+
+def block_source(pc, records, count=False):
+    """Return the source of the function executing ``records`` from ``pc``.
+
+    The function takes the machine, its registers, memory, code marks and tty
+    output and returns the instruction to go on with.  A store into a word
+    some block was translated from leaves the block right away.  A block
+    branching back to its own start loops inside the function for as long
+    as the ``budget`` of instructions left allows.  With ``count`` every run
+    of the block is counted in the ``counts`` of the machine and every taken
+    branch in its ``taken``.
+    """
+    length = len(records)
+    last = (pc + length - 1) & (memory_words - 1)
+    loop = records[-1].instr in conditions and target(last, records[-1]) == pc
+    indent = "        " if loop else "    "
+    lines = ["def block(m, r, mem, code, out, budget):"]
+    if loop:
+        lines += ["    extra = 0", "    while True:"]
+    if count:
+        lines.append(indent + "m.counts[%d, %d] += 1" % (pc, length))
+    for offset, record in enumerate(records):
+        here = (pc + offset) & (memory_words - 1)
+        following = (here + 1) & (memory_words - 1)
+        instr = record.instr
+        destination = (
+            record.rt
+            if instr in ("addi", "slti", "sltiu", "andi", "ori", "xori", "lw")
+            else record.rd
+        )
+        if instr in register_writers and destination == 0:
+            continue
+        fields = dict(
+            RS="r[%d]" % record.rs if record.rs else "0",
+            RT="r[%d]" % record.rt if record.rt else "0",
+            rs=record.rs,
+            rt=record.rt,
+            rd=record.rd,
+            imm=record.immediate,
+            simm=signed16(record.immediate),
+            words=memory_words - 1,
+            pc=here,
+        )
+        if instr in conditions:
+            condition = conditions[instr].format(**fields)
+            count_taken = count and target(here, record) != following
+            if not loop and count_taken:
+                lines += [
+                    indent + "if %s:" % condition,
+                    indent + "    m.taken[%d] += 1" % here,
+                    indent + "    return %d" % target(here, record),
+                    indent + "return %d" % following,
+                ]
+                continue
+            if not loop:
+                lines.append(
+                    indent
+                    + "return %d if %s else %d"
+                    % (target(here, record), condition, following)
+                )
+                continue
+            lines += [
+                indent + "if not (%s):" % condition,
+                indent + "    m.steps += extra",
+                indent + "    return %d" % following,
+            ]
+            if count_taken:
+                lines.append(indent + "m.taken[%d] += 1" % here)
+            lines += [
+                indent + "if budget < %d:" % length,
+                indent + "    m.steps += extra",
+                indent + "    return %d" % pc,
+                indent + "budget -= %d" % length,
+                indent + "extra += %d" % length,
+            ]
+            continue
+        lines.extend(indent + line.format(**fields) for line in statements[instr])
+        if instr in ("sw", "push"):
+            lines.append(indent + "m.dirty[a >> %d] = 1" % page_shift)
+            skipped = length - offset - 1
+            lines.append(indent + "if code[a]:")
+            if count and skipped:
+                # only the instructions up to the store ran
+                lines += [
+                    indent + "    m.counts[%d, %d] -= 1" % (pc, length),
+                    indent + "    m.counts[%d, %d] += 1" % (pc, offset + 1),
+                ]
+            lines += [
+                indent + "    m.invalidate()",
+                indent
+                + "    m.steps += %s" % ("extra - %d" % skipped if loop else -skipped),
+                indent + "    return %d" % following,
+            ]
+    if records[-1].instr not in terminators:
+        lines.append("    return %d" % ((pc + length) & (memory_words - 1)))
+    return "\n".join(lines) + "\n"
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_block(pc, words, count=False):
+    """Compile the block of ``words`` at ``pc``, shared by every machine."""
+    namespace = {"divide": divide, "kbd": kbd}
+    source = block_source(pc, [predecode(word) for word in words], count)
+    exec(compile(source, "<block>", "exec"), namespace)
+    return namespace["block"]
+
+
+def simulate(words, max_steps=None, keyboard="", seed=None):
+    """Run the program ``words``, return ``(tty output, steps, halted)``."""
+    machine = Machine(words, keyboard, seed)
+    halted = machine.run(max_steps)
+    return machine.tty(), machine.steps, halted
+
+
+if __name__ == "__main__":
+    usage = "%prog image [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option(
+        "-m",
+        "--max-steps",
+        dest="max_steps",
+        type="int",
+        default=10000000,
+        help="Stop after this number of instructions (0: no limit)",
+    )
+    parser.add_option(
+        "-k",
+        "--keyboard",
+        dest="keyboard",
+        type="string",
+        default="",
+        help="Characters read by kbd, 0 is read once they run out",
+    )
+    parser.add_option(
+        "-s",
+        "--seed",
+        dest="seed",
+        type="int",
+        default=None,
+        help="Seed of the numbers returned by rnd",
+    )
+    parser.add_option(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="store_true",
+        default=False,
+        help="Print the number of instructions executed",
+    )
+    parser.add_option(
+        "-r",
+        "--restore",
+        dest="restore",
+        type="string",
+        default=None,
+        help="Go on from the state saved in this snapshot instead of the image",
+    )
+    parser.add_option(
+        "-w",
+        "--snapshot",
+        dest="snapshot",
+        type="string",
+        default=None,
+        help="Save the state of the machine to this file when it stops",
+    )
+    parser.add_option(
+        "-c",
+        "--checkpoint",
+        dest="checkpoint",
+        type="int",
+        default=0,
+        help="Save a snapshot every this number of instructions",
+    )
+    parser.add_option(
+        "-d",
+        "--checkpoint-dir",
+        dest="checkpoint_dir",
+        type="string",
+        default=".",
+        help="Folder of the <instructions>.snap checkpoints",
+    )
+    parser.add_option(
+        "--memory-file",
+        dest="memory_file",
+        type="string",
+        default=None,
+        help="Keep the memory in this file, mapped into memory",
+    )
+    options, args = parser.parse_args()
+    if len(args) != (0 if options.restore else 1):
+        parser.error("Incorrect command line arguments")
+        sys.exit(1)
+
+    try:
+        if options.restore:
+            snapshot = Snapshot.read(options.restore)
+            words = []
+        else:
+            words = disassembler.read_words(args[0])
+    except (IOError, ValueError, KeyError) as e:
+        print(
+            "Unable to read %s: %s" % ((args or [options.restore])[0], e),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    machine = Machine(
+        words, options.keyboard, options.seed, memory_file=options.memory_file
+    )
+    if options.restore:
+        machine.restore(snapshot)
+    if options.checkpoint:
+        os.makedirs(options.checkpoint_dir, exist_ok=True)
+    try:
+        limit = options.max_steps or None
+        halted = False
+        while options.checkpoint and not halted:
+            following = (machine.steps // options.checkpoint + 1) * options.checkpoint
+            if limit is not None and limit <= following:
+                break
+            halted = machine.run(following)
+            if not halted:
+                machine.snapshot().write(
+                    os.path.join(options.checkpoint_dir, "%d.snap" % following)
+                )
+        if not halted:
+            halted = machine.run(limit)
+    except SimulatorError as e:
+        print(machine.tty())
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+    print(machine.tty())
+    if options.snapshot:
+        machine.snapshot().write(options.snapshot)
+    if options.verbose:
+        print("%d instructions executed" % machine.steps, file=sys.stderr)
+    if not halted:
+        print(
+            "stopped after %d instructions without halting" % machine.steps,
+            file=sys.stderr,
+        )
+        sys.exit(2)
+    sys.exit(0)
@@ -1,9 +1,29 @@
 #! /usr/bin/env python3
 
+import io
 import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import contextlib
+import xml.etree.ElementTree as ElementTree
 import subprocess
 import sys
+import codecs
+import signal
+import queue
+import threading
 import optparse
+import concurrent.futures
+
+import assembler
+import disassembler
+import simulator
+import timing
+import history
+import bundle
 
 
 verbose_level = 0
@@ -12,6 +32,107 @@ verbose_level_compile_detail = 3
 verbose_level_test_detail = 2
 verbose_level_test_basic_detail = 1
 
+# line Logisim prints after the tty output once the processor halts
+halt_message = "halted due to halt pin"
+
+# last line of Logisim with the speed option: "<Hz> Hz (<ticks> ticks ..."
+# followed by the milliseconds in English, the rest depends on the build
+speed_re = re.compile(r"([0-9.,]+) Hz \((\d+) ticks(?:[^\d\n]*(\d+))?")
+
+
+# "#name value" or "#name: value" lines of a test source, with the "#" on
+# the first column as test.py always required, see ``read_metadata``
+directive_re = re.compile(r"#(\w+)(?:[\s:](.*))?$")
+
+# directive -> function parsing its value
+directives = {
+    "prints": str,
+    "limit": int,
+    "timeout": float,
+    "seed": int,
+    "tags": lambda value: value.replace(",", " ").split(),
+}
+
+
+def read_metadata(path):
+    """Read the directives of the test source ``path`` in a single pass.
+
+    Returns a dict with the value of the first ``#prints``, ``#limit``,
+    ``#timeout``, ``#seed`` and ``#tags`` line of the source, the
+    ``sha256`` of the source for ``BuildCache`` and the ``problems`` found,
+    such as a ``#limit`` that is not a whole number of ticks.
+    """
+    with open(path, "rb") as file:
+        source = file.read()
+    metadata = {
+        "prints": "",
+        "limit": None,
+        "timeout": None,
+        "seed": None,
+        "tags": [],
+        "sha256": hashlib.sha256(source).hexdigest(),
+        "problems": [],
+    }
+    seen = set()
+    for line in source.decode("utf-8", "replace").splitlines():
+        match = directive_re.match(line.rstrip())
+        if match is None or match.group(1) not in directives:
+            continue
+        name = match.group(1)
+        if name in seen:
+            continue
+        seen.add(name)
+        try:
+            metadata[name] = directives[name]((match.group(2) or "").strip())
+        except ValueError:
+            metadata["problems"].append("valor inválido en %s" % line.strip())
+    return metadata
+
+
+def parse_speed(output):
+    """Return the Hz, ticks and milliseconds of a Logisim run, or None.
+
+    The milliseconds are None when the line does not give them.
+    """
+    match = speed_re.search(output)
+    if match is None:
+        return None
+    hz = match.group(1)
+    # Java formats the decimals with the separator of the locale
+    hz = hz.replace(",", "") if "." in hz else hz.replace(",", ".")
+    milliseconds = match.group(3)
+    return (
+        float(hz),
+        int(match.group(2)),
+        None if milliseconds is None else int(milliseconds),
+    )
+
+
+def read_chunks(stream, chunks):
+    """Put what comes out of ``stream`` in the ``chunks`` queue, b"" at the end."""
+    try:
+        for data in iter(lambda: os.read(stream.fileno(), 65536), b""):
+            chunks.put(data)
+    except (OSError, ValueError):
+        pass
+    chunks.put(b"")
+
+
+def kill(process):
+    """Kill ``process`` and every process it started in its session.
+
+    ``logisim`` is usually a shell script running ``java``, which would
+    outlive the script alone.  Process groups are POSIX only, elsewhere
+    only ``process`` itself is killed.
+    """
+    try:
+        if os.name == "posix":
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
 
 def print_verbose(verbose_level_required, *args):
     if verbose_level >= verbose_level_required:
@@ -19,16 +140,91 @@ def print_verbose(verbose_level_required, *args):
 
 
 class TestCase:
-    def __init__(self, test_name, file, expected_result, expected_speed=None):
+    def __init__(
+        self,
+        test_name,
+        file,
+        expected_result,
+        expected_speed=None,
+        timeout=None,
+        seed=None,
+        tags=(),
+    ):
         self.file = file
         self.expected_result = expected_result
         self.expected_speed = expected_speed
+        self.timeout = timeout
+        self.seed = seed
+        self.tags = list(tags)
         self.test_name = test_name
         self.runned = False
         self.error = False
+        # killed once its output diverged, so the result is only a prefix
+        self.aborted = False
+        # ticks of the run, with its frequency and length when Logisim ran it
+        self.speed = None
+        self.hz = None
+        self.milliseconds = None
+        self.seconds = None
+
+    def diverged(self, output):
+        """True once ``output`` can no longer end in the expected result."""
+        if not self.expected_result or halt_message in output:
+            return False
+        for size in range(min(len(halt_message), len(output)), 0, -1):
+            # the end could be the start of the halt message
+            if output.endswith(halt_message[:size]):
+                output = output[:-size]
+                break
+        return not self.expected_result.startswith(output.strip())
 
-    def run(self, logisim, circ, template):
-        result = ""
+    def capture(self, process, timeout=None):
+        """Read the output of ``process`` as it comes out.
+
+        The process and the ones it started are killed as soon as its output
+        diverges from the expected result or after ``timeout`` seconds.  The
+        output is read by a thread, so this works on every platform.  Returns
+        the output and the reason the process was killed, or None.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        chunks = queue.Queue()
+        threading.Thread(
+            target=read_chunks, args=(process.stdout, chunks), daemon=True
+        ).start()
+        output = ""
+        reason = None
+        while True:
+            wait = None if end is None else end - time.monotonic()
+            if wait is not None and wait <= 0:
+                reason = "superó el tiempo límite de %.1fs" % timeout
+                break
+            try:
+                data = chunks.get(timeout=wait)
+            except queue.Empty:
+                continue
+            if not data:
+                break
+            output += decoder.decode(data)
+            if self.diverged(output):
+                reason = "la salida no coincide con #prints"
+                break
+        if reason:
+            kill(process)
+        process.wait()
+        process.stdout.close()
+        return output + decoder.decode(b"", True), reason
+
+    def run(self, logisim, circ, template, deadline=None):
+        """Run the test on Logisim, before the ``deadline`` (a ``time.time``)."""
+        timeout = self.timeout
+        if deadline is not None:
+            left = deadline - time.time()
+            timeout = left if timeout is None else min(timeout, left)
+            if left <= 0:
+                print("Error al ejecutar test: ", self.test_name, "tiempo agotado")
+                self.error = True
+                return
         cmd = [
             logisim,
             template,
@@ -44,27 +240,92 @@ class TestCase:
             print_verbose(
                 verbose_level_test_detail, "Ejecutando el test: ", self.test_name
             )
-            result = subprocess.run(cmd, stdout=subprocess.PIPE)
+            # in a session of its own, to kill the JVM along with the script
+            process = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, start_new_session=True
+            )
+            output, reason = self.capture(process, timeout)
             self.runned = True
-            if result.returncode != 0:
-                print("Error al ejecutar test: ", self.test_name)
-                print(result.stdout)
-                print(result.stderr)
+            if reason and self.diverged(output):
+                # a failure, with the output up to the first wrong character
+                print("Test abortado: ", self.test_name, reason)
+                self.aborted = True
+                self.result = output.strip()
+                return
+            if reason or process.returncode != 0:
+                print("Error al ejecutar test: ", self.test_name, reason or "")
+                print(output)
                 self.error = True
                 return
-            output = bytes.decode(result.stdout)
-            r = output.find("halted due to halt pin")
+            r = output.find(halt_message)
             self.result = output[:r].strip()
-            s = output.find("Hz (")
-            e = output.find(" ticks", s)
-            self.speed = output[s + 4 : e]
+            speed = parse_speed(output)
+            if speed is None:
+                print_verbose(
+                    verbose_level_test_detail, "Test sin velocidad: ", self.test_name
+                )
+                return
+            self.hz, self.speed, self.milliseconds = speed
 
-        except subprocess.CalledProcessError as e:
+        except OSError as e:
             print("Error al ejecutar test: ", self.test_name)
-            print(result.stdout)
-            print(result.stderr)
+            print(e)
             self.error = True
 
+    def simulate(self, max_steps=None, model=None):
+        """Run the test on the instruction-set simulator instead of Logisim.
+
+        The speed is the number of ticks ``model`` (a ``timing.TimingModel``)
+        estimates, which has not been calibrated against Logisim.
+        """
+        print_verbose(verbose_level_test_detail, "Simulando el test: ", self.test_name)
+        try:
+            words = disassembler.read_words(self.file)
+            machine = simulator.Machine(words, seed=self.seed, count=True)
+            halted = machine.run(max_steps)
+        except (IOError, ValueError, simulator.SimulatorError) as e:
+            print("Error al ejecutar test: ", self.test_name)
+            print(e)
+            self.error = True
+            return
+        self.runned = True
+        if not halted:
+            print(
+                "Error al ejecutar test: ",
+                self.test_name,
+                "no terminó en %d instrucciones" % max_steps,
+            )
+            self.error = True
+            return
+        self.result = machine.tty().strip()
+        model = model or timing.TimingModel()
+        self.speed = model.ticks(machine, len(words))
+
+    def passed(self):
+        return self.runned and not self.error and self.result == self.expected_result
+
+    def within_limit(self):
+        """True if the ticks are within ``#limit``, None when there is none."""
+        if self.expected_speed is None:
+            return None
+        return self.speed is not None and self.speed <= self.expected_speed
+
+    def report(self):
+        """Return the outcome of the test as a dict for the JSON report."""
+        return {
+            "name": self.test_name,
+            "passed": self.passed(),
+            "error": self.error,
+            "result": getattr(self, "result", None),
+            "expected": self.expected_result,
+            "ticks": self.speed,
+            "limit": self.expected_speed,
+            "within_limit": self.within_limit(),
+            "hz": self.hz,
+            "milliseconds": self.milliseconds,
+            "seconds": self.seconds,
+        }
+
     def print(self):
 
         if self.error:
@@ -85,12 +346,12 @@ class TestCase:
                 "Resultado Obtenido: ",
                 self.result,
             )
-            status = self.speed <= self.expected_speed
+            status = self.within_limit()
             print(
                 "Tiempo:",
                 self.test_name,
                 " ===============================================> ",
-                "OK" if status else "FAIL",
+                "SIN LIMITE" if status is None else "OK" if status else "FAIL",
             )
             print_verbose(
                 verbose_level_test_detail,
@@ -108,96 +369,855 @@ class TestCase:
         )
 
 
+def write_junit(reports, path):
+    """Write the ``TestCase.report`` dicts ``reports`` as JUnit XML for CI servers."""
+    suite = ElementTree.Element("testsuite", name="s-mips", tests=str(len(reports)))
+    failures = errors = 0
+    for report in reports:
+        case = ElementTree.SubElement(
+            suite, "testcase", classname="s-mips", name=report["name"]
+        )
+        if report["seconds"] is not None:
+            case.set("time", "%.3f" % report["seconds"])
+        if report["error"] or report["result"] is None:
+            errors += 1
+            ElementTree.SubElement(case, "error", message="El test no pudo ejecutarse")
+        elif not report["passed"]:
+            failures += 1
+            failure = ElementTree.SubElement(
+                case, "failure", message="Resultado incorrecto"
+            )
+            failure.text = "Esperado: %s\nObtenido: %s" % (
+                report["expected"],
+                report["result"],
+            )
+        elif report["within_limit"] is False:
+            failures += 1
+            failure = ElementTree.SubElement(
+                case, "failure", message="Límite de tiempo superado"
+            )
+            failure.text = "Esperado: %s\nObtenido: %s" % (
+                report["limit"],
+                report["ticks"],
+            )
+        if report["ticks"] is not None:
+            properties = ElementTree.SubElement(case, "properties")
+            ElementTree.SubElement(
+                properties, "property", name="ticks", value=str(report["ticks"])
+            )
+    suite.set("failures", str(failures))
+    suite.set("errors", str(errors))
+    ElementTree.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def merge_reports(paths):
+    """Join the JSON reports of the shards of a run into a single one.
+
+    The wall time of the whole run is the one of the slowest shard, as the
+    shards run at the same time on different nodes.  Raises ValueError
+    unless the reports are the shards 1 to N of the same N and revision,
+    each once, and hold every test discovered exactly once.
+    """
+    merged = None
+    problems = []
+    shards = []
+    for path in paths:
+        with open(path, "r") as file:
+            report = json.load(file)
+        if merged is None:
+            merged = dict(report, tests=[], wall=0.0, shards=[])
+        elif report["revision"] != merged["revision"]:
+            problems.append("revisión %s en %s" % (report["revision"], path))
+        if report.get("discovered") != merged.get("discovered"):
+            problems.append("tests descubiertos distintos en %s" % path)
+        try:
+            index, count = [int(value) for value in report["shard"].split("/")]
+            shards.append((index, count))
+        except (AttributeError, ValueError):
+            problems.append("%s no es el reporte de un shard" % path)
+        merged["tests"].extend(report["tests"])
+        merged["wall"] = max(merged["wall"], report.get("wall") or 0.0)
+        merged["shards"].append(report.get("shard"))
+    counts = {count for index, count in shards}
+    if len(counts) > 1:
+        problems.append("cantidades de shards distintas: %s" % sorted(counts))
+    elif counts:
+        indexes = sorted(index for index, count in shards)
+        if indexes != list(range(1, counts.pop() + 1)):
+            problems.append("shards repetidos o faltantes: %s" % indexes)
+    names = [test["name"] for test in merged["tests"]]
+    repeated = sorted({name for name in names if names.count(name) > 1})
+    if repeated:
+        problems.append("tests repetidos: %s" % ", ".join(repeated))
+    missing = sorted(set(merged.get("discovered") or ()) - set(names))
+    if missing:
+        problems.append("tests faltantes: %s" % ", ".join(missing))
+    if problems:
+        raise ValueError("; ".join(problems))
+    merged.pop("shard", None)
+    merged["tests"].sort(key=lambda test: test["name"])
+    return merged
+
+
+def shard_tests(names, durations, index, count):
+    """Return the ``names`` of the tests of shard ``index`` out of ``count``.
+
+    The shards are packed greedily, longest processing time first: from the
+    longest test to the shortest, each test goes to the shard with the least
+    time so far.  Tests without a recorded duration count as the mean of the
+    known ones.  Ties are broken by name, so every node computes the same
+    shards from the same durations.
+    """
+    known = [durations[name] for name in names if name in durations]
+    default = sum(known) / len(known) if known else 1.0
+    loads = [0.0] * count
+    selected = set()
+    for name in sorted(names, key=lambda name: (-durations.get(name, default), name)):
+        shard = min(range(count), key=lambda i: (loads[i], i))
+        loads[shard] += durations.get(name, default)
+        if shard == index - 1:
+            selected.add(name)
+    print_verbose(
+        verbose_level_test_basic_detail,
+        "Shards estimados: " + ", ".join("%.2fs" % load for load in loads),
+    )
+    return selected
+
+
+def run_case(
+    test, circ, template, logisim, max_steps, timing_model, level, deadline=None
+):
+    """Run ``test``, possibly in a worker process of the suite.
+
+    Everything the test prints is kept apart so the output of tests running
+    at the same time does not mix.  Returns the test, its output and the
+    seconds it took.
+    """
+    global verbose_level
+    verbose_level = level
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        if circ is None:
+            test.simulate(max_steps, timing_model)
+        else:
+            test.run(logisim, circ, template, deadline)
+    test.seconds = time.perf_counter() - start
+    return test, output.getvalue(), test.seconds
+
+
+class BuildCache:
+    """Remembers which memory images are up to date with their source.
+
+    Each program is keyed by a hash of its source, the assembler and optimizer
+    code (``assembler.build_version``) and the image options.  The key is
+    written next to the images in the program's output folder, so a program
+    is only assembled again when one of them changes.
+    """
+
+    stamp = ".build"
+
+    def __init__(self, options=""):
+        self.version = assembler.build_version()
+        self.options = options
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source_digest):
+        """Return the key of a source with the hex ``source_digest``."""
+        digest = hashlib.sha256()
+        digest.update(self.version.encode())
+        digest.update(self.options.encode())
+        digest.update(source_digest.encode())
+        return digest.hexdigest()
+
+    def lookup(self, base_dir, key):
+        try:
+            with open(os.path.join(base_dir, self.stamp), "r") as file:
+                hit = file.read() == key and os.path.exists(
+                    os.path.join(base_dir, "Bank")
+                )
+        except IOError:
+            hit = False
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return hit
+
+    def store(self, base_dir, key):
+        with open(os.path.join(base_dir, self.stamp), "w") as file:
+            file.write(key)
+
+    def print(self):
+        print(
+            "Cache de compilación: %d aciertos, %d fallos" % (self.hits, self.misses)
+        )
+
+
+# a .jar path in the text of a launcher script
+jar_re = re.compile(r"""[^\s"'=:;]+\.jar\b""")
+
+
+def tool_files(command):
+    """Return the files that make up the Logisim run by ``command``.
+
+    ``command`` is usually a launcher script running ``java -jar`` on the
+    Logisim jar, so besides the launcher the jars it names are returned
+    too, looked up as written and then by name next to the launcher (as in
+    ``$(dirname $0)/logisim.jar``).  A jar found another way, such as
+    through a variable, is missed.
+    """
+    launcher = shutil.which(command) or command
+    files = [launcher]
+    if launcher.endswith(".jar"):
+        return files
+    try:
+        with open(launcher, "rb") as file:
+            text = file.read(1 << 20).decode("utf-8", "replace")
+    except IOError:
+        return files
+    folder = os.path.dirname(os.path.abspath(launcher))
+    for name in jar_re.findall(text):
+        for path in [
+            os.path.join(folder, os.path.expanduser(name)),
+            os.path.join(folder, os.path.basename(name)),
+        ]:
+            if os.path.isfile(path):
+                if path not in files:
+                    files.append(path)
+                break
+    return files
+
+
+class ResultCache:
+    """Remembers the output and speed of every memory image that ran.
+
+    Each result is keyed by a hash of the ``Bank`` image and of ``files``,
+    the circuit, the template and the tool running them, so a test only runs
+    again when one of them changes.  Whether the test passes is decided again
+    every time, as the expected results live in comments of the source that
+    do not change the image.  Runs aborted because their output diverged from
+    the expected result are not stored, as their output depends on it.  With
+    ``enabled`` False every lookup misses, but the new results are still
+    stored.
+    """
+
+    stamp = ".result"
+    # changes whenever the format of the results does
+    version = "2"
+
+    def __init__(self, files, settings="", enabled=True):
+        digest = hashlib.sha256()
+        digest.update(self.version.encode())
+        digest.update(settings.encode())
+        try:
+            for path in files:
+                with open(path, "rb") as file:
+                    digest.update(file.read())
+        except IOError as e:
+            print_verbose(verbose_level_all, "Cache de resultados desactivada: ", e)
+            enabled = False
+        self.key_prefix = digest.hexdigest()
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, test):
+        digest = hashlib.sha256()
+        digest.update(self.key_prefix.encode())
+        # the seed of rnd comes from the source, not from the image
+        digest.update(repr(test.seed).encode())
+        with open(test.file, "rb") as file:
+            digest.update(file.read())
+        return digest.hexdigest()
+
+    def path(self, test):
+        return os.path.join(os.path.dirname(test.file), self.stamp)
+
+    def lookup(self, test):
+        """Fill in the result of ``test`` and return True if it is known."""
+        try:
+            with open(self.path(test), "r") as file:
+                cached = json.load(file)
+            hit = self.enabled and cached["key"] == self.key(test)
+        except (IOError, ValueError, KeyError):
+            hit = False
+        if hit:
+            self.hits += 1
+            test.result = cached["result"]
+            test.speed = cached["speed"]
+            test.hz = cached["hz"]
+            test.milliseconds = cached["milliseconds"]
+            test.runned = True
+        else:
+            self.misses += 1
+        return hit
+
+    def store(self, test):
+        if test.error or not test.runned or test.aborted:
+            return
+        try:
+            with open(self.path(test), "w") as file:
+                json.dump(
+                    {
+                        "key": self.key(test),
+                        "result": test.result,
+                        "speed": test.speed,
+                        "hz": test.hz,
+                        "milliseconds": test.milliseconds,
+                    },
+                    file,
+                )
+        except IOError as e:
+            print_verbose(verbose_level_all, "No se pudo guardar el resultado: ", e)
+
+    def print(self):
+        print(
+            "Cache de resultados: %d simulaciones evitadas, %d ejecutadas"
+            % (self.hits, self.misses)
+        )
+
+
+class TestIndex:
+    """Directives of every test source, kept between runs in the output folder.
+
+    An entry is reused for as long as the size and modification time of its
+    source stay the same, so a warm run does not read any unchanged source.
+    """
+
+    file_name = ".index"
+    # changes whenever ``read_metadata`` reads sources differently
+    version = 2
+
+    def __init__(self, base_dir):
+        self.path = os.path.join(base_dir, self.file_name)
+        try:
+            with open(self.path, "r") as file:
+                index = json.load(file)
+            self.entries = index["entries"] if index["version"] == self.version else {}
+        except (IOError, ValueError, KeyError, TypeError):
+            self.entries = {}
+        self.seen = set()
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, path, stat):
+        """Return the ``read_metadata`` of ``path``, whose ``os.stat`` is ``stat``."""
+        self.seen.add(path)
+        entry = self.entries.get(path)
+        if (
+            entry is not None
+            and entry["mtime"] == stat.st_mtime_ns
+            and entry["size"] == stat.st_size
+        ):
+            self.hits += 1
+            return entry["metadata"]
+        self.misses += 1
+        metadata = read_metadata(path)
+        self.entries[path] = {
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "metadata": metadata,
+        }
+        self.changed = True
+        return metadata
+
+    def save(self):
+        """Write the index back, forgetting the sources no longer found."""
+        if not self.changed and self.seen == set(self.entries):
+            return
+        entries = {path: self.entries[path] for path in self.seen}
+        try:
+            with open(self.path, "w") as file:
+                json.dump({"version": self.version, "entries": entries}, file)
+        except IOError as e:
+            print_verbose(verbose_level_all, "No se pudo guardar el índice: ", e)
+
+
 class TestSuite:
-    def __init__(self, dir, base_dir, circ, template):
+    # seconds each test took the last time, in the output folder
+    durations_file = ".durations"
+
+    def __init__(
+        self,
+        dir,
+        base_dir,
+        circ,
+        template,
+        rle=False,
+        jobs=1,
+        optimize=False,
+        max_steps=None,
+        timing_model=None,
+        logisim="logisim",
+        use_cache=True,
+        timeout=None,
+        deadline=None,
+        tags=None,
+        shard=None,
+        durations_path=None,
+        bundle=0,
+    ):
         self.base_dir = base_dir
+        self.bundle = bundle
+        self.shard = shard
+        self.durations_path = durations_path or os.path.join(
+            base_dir, self.durations_file
+        )
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_steps = max_steps
+        self.timing_model = timing_model
+        self.logisim = logisim
+        self.rle = rle
+        self.optimize = optimize
+        self.jobs = jobs
+        # the tests run on the instruction-set simulator when there is no circuit
         self.circ = circ
         self.path = dir
-        self.test = []
+        self.wall = None
         self.template = template
-        for file, path in self.searchAsmFiles():
-            self.compile(file, path)
-            expected = self.extractExpectedResult(path)
-            excepted_time = self.extractExpectedSpeed(path)
-            self.test.append(
-                TestCase(
-                    file,
-                    os.path.join(self.base_dir, file, "Bank"),
-                    expected,
-                    excepted_time,
-                )
+        self.tags = tags
+        self.use_cache = use_cache
+        self.build_cache = BuildCache(
+            " ".join(name for name, on in [("rle", rle), ("O", optimize)] if on)
+        )
+        found = self.discover()
+        self.discovered = sorted(file for file, path, metadata in found)
+        if shard is not None:
+            names = shard_tests(
+                [file for file, path, metadata in found], self.load_durations(), *shard
+            )
+            found = [test for test in found if test[0] in names]
+        self.test = self.load(found)
+        self.result_cache = self.make_result_cache(use_cache)
+
+    def discover(self):
+        """Return the name, path and directives of every selected test.
+
+        Also remembers the size and modification time of their sources in
+        ``self.sources``, to tell which ones change while watching.
+        """
+        index = TestIndex(self.base_dir)
+        found = []
+        self.sources = {}
+        for file, path, stat in self.searchAsmFiles():
+            try:
+                metadata = index.lookup(path, stat)
+            except IOError as e:
+                print("Error al leer: ", path)
+                print(e)
+                continue
+            if self.tags and not set(self.tags) & set(metadata["tags"]):
+                print_verbose(verbose_level_all, "Test no seleccionado: ", file)
+                continue
+            print_verbose(verbose_level_all, "Directivas del test: ", file, metadata)
+            found.append((file, path, metadata))
+            self.sources[path] = (stat.st_mtime_ns, stat.st_size)
+        index.save()
+        print_verbose(
+            verbose_level_test_basic_detail,
+            "Índice de tests: %d aciertos, %d fallos" % (index.hits, index.misses),
+        )
+        return found
+
+    def load(self, found):
+        """Assemble the tests returned by ``discover`` and return their ``TestCase``s."""
+        tests = []
+        pending = []
+        for file, path, metadata in found:
+            job = self.compile(file, path, metadata["sha256"])
+            if job:
+                pending.append(job)
+            timeout = metadata["timeout"]
+            test = TestCase(
+                file,
+                os.path.join(self.base_dir, file, "Bank"),
+                metadata["prints"],
+                metadata["limit"],
+                self.timeout if timeout is None else timeout,
+                metadata["seed"],
+                metadata["tags"],
             )
+            for problem in metadata.get("problems", []):
+                # the test does not run rather than run without its #limit
+                print("Directiva inválida en: ", path, problem)
+                test.error = True
+            tests.append(test)
+        self.build(pending)
+        self.build_cache.print()
+        return tests
+
+    def make_result_cache(self, enabled):
+        """Return the ``ResultCache`` of the tool and circuit running the tests."""
+        if self.circ is None:
+            model = self.timing_model or timing.TimingModel()
+            # the images are decoded with the tables of the assembler
+            settings = json.dumps(
+                [self.max_steps, vars(model), assembler.build_version()],
+                sort_keys=True,
+            )
+            files = [simulator.__file__, timing.__file__, disassembler.__file__]
+        else:
+            settings = ""
+            files = [
+                self.circ,
+                self.template,
+            ] + tool_files(self.logisim)
+        if self.bundle:
+            # bundled tests have no ticks of their own
+            settings += " bundle"
+        return ResultCache(files, settings, enabled)
 
     def searchAsmFiles(self):
-        for root, dirs, files in os.walk(self.path):
+        """Yield the name, path and ``os.stat`` of every .asm file of the tests."""
+        folders = [self.path]
+        while folders:
+            root = folders.pop()
             print_verbose(verbose_level_all, "Buscando archivos .asm en: ", root)
-            for file in files:
-                try:
-                    if file.endswith(".asm"):
-                        print_verbose(verbose_level_all, "Archivo encontrado: ", file)
-                        path = os.path.join(root, file)
-                        yield file[:-4], path
-                except Exception as e:
-                    print("e")
-
-    def compile(self, file, path):
+            try:
+                entries = sorted(os.scandir(root), key=lambda entry: entry.name)
+            except OSError as e:
+                print("Error al buscar tests en: ", root)
+                print(e)
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.name.endswith(".asm"):
+                    print_verbose(verbose_level_all, "Archivo encontrado: ", entry.name)
+                    yield entry.name[:-4], entry.path, entry.stat()
+
+    def compile(self, file, path, source_digest):
+        """Return the build job of ``path``, or None when its images are cached."""
         base_dir = os.path.join(self.base_dir, file)
         print_verbose(verbose_level_all, "Creando directorio: ", base_dir)
         try:
             os.mkdir(base_dir)
         except FileExistsError as e:
             print_verbose(verbose_level_all, "Directorio existente: ", base_dir)
-        print_verbose(verbose_level_all, "Compilando: ", path)
-        status = os.system(f"./assembler.py {path} -o {base_dir}")
-        if status != 0:
-            print("Error al compilar: ", path)
+        key = self.build_cache.key(source_digest)
+        if self.build_cache.lookup(base_dir, key):
+            print_verbose(verbose_level_all, "Compilación en cache: ", path)
+            return None
+        return path, base_dir, key
 
-    def extractExpectedResult(self, path):
+    def build(self, jobs):
+        """Assemble the programs returned by ``compile`` on ``self.jobs`` processes."""
+        if not jobs:
+            return
+        for path, base_dir, key in jobs:
+            print_verbose(verbose_level_all, "Compilando: ", path)
+        results, wall = assembler.assemble_batch(
+            [(path, base_dir) for path, base_dir, key in jobs],
+            self.jobs,
+            rle=self.rle,
+            optimize=self.optimize,
+        )
+        for (path, base_dir, key), (_, error, seconds, report) in zip(jobs, results):
+            if error:
+                print("Error al compilar: ", path)
+                print(error)
+            else:
+                if report:
+                    print("Optimizado: ", path, report)
+                self.build_cache.store(base_dir, key)
+        if verbose_level >= verbose_level_test_basic_detail:
+            assembler.print_batch_summary(results, wall, self.jobs)
 
-        with open(path, "r") as file:
-            content = file.readlines()
+    def load_durations(self):
+        """Return the seconds each test took the last time it ran."""
+        try:
+            with open(self.durations_path, "r") as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {}
 
-        read = False
-        expected = ""
+    def save_durations(self, durations):
+        if self.shard is not None:
+            # the shards split the tests by this file, so it must stay the
+            # same for all of them; --merge --durations records the new times
+            return
+        try:
+            with open(self.durations_path, "w") as file:
+                json.dump(durations, file, indent=1, sort_keys=True)
+        except IOError as e:
+            print_verbose(verbose_level_all, "No se pudo guardar la duración: ", e)
 
-        for line in content:
-            if line.startswith("#prints"):
-                expected = line[8:].strip()
-                break
-        print_verbose(verbose_level_all, "Resultado esperado del test: ")
-        print_verbose(verbose_level_all, expected)
-        return expected
+    def arguments(self, max_steps=None):
+        return (
+            self.circ,
+            self.template,
+            self.logisim,
+            max_steps or self.max_steps,
+            self.timing_model,
+            verbose_level,
+            self.deadline,
+        )
 
-    def extractExpectedSpeed(self, path):
+    def run(self, test):
+        test, output, seconds = run_case(test, *self.arguments())
+        sys.stdout.write(output)
+        return test, seconds
 
-        with open(path, "r") as file:
-            content = file.readlines()
+    def run_all(self, names=None):
+        """Run every test on ``self.jobs`` processes, the slowest ones first.
 
-        read = False
-        expected = ""
+        The tests that never ran go first, then the rest by the time they
+        took last time, so the longest ones do not start at the end.  With
+        ``names`` only the tests so named run.
+        """
+        durations = self.load_durations()
+        pending = []
+        for i, test in enumerate(self.test):
+            if names is not None and test.test_name not in names:
+                continue
+            if test.error:
+                test.print()
+            elif self.result_cache.lookup(test):
+                print_verbose(verbose_level_test_detail, "En cache: ", test.test_name)
+                test.print()
+            else:
+                pending.append(i)
+        order = sorted(
+            pending,
+            key=lambda i: -durations.get(self.test[i].test_name, float("inf")),
+        )
+        start = time.perf_counter()
+        serial = 0.0
+        ran = len(order)
+        if self.bundle and order:
+            order, serial = self.run_bundles(order, durations)
+        for i, test, output, seconds in self.execute(
+            [(i, self.test[i]) for i in order]
+        ):
+            self.test[i] = test
+            durations[test.test_name] = seconds
+            serial += seconds
+            self.result_cache.store(test)
+            sys.stdout.write(output)
+            test.print()
+        wall = self.wall = time.perf_counter() - start
+        self.save_durations(durations)
+        self.result_cache.print()
+        print(
+            "Tests: %d en %.2fs con %s procesos, %.2fs en serie (%.1fx)"
+            % (
+                ran,
+                wall,
+                self.jobs or os.cpu_count(),
+                serial,
+                serial / wall if wall and serial else 1.0,
+            )
+        )
 
-        for line in content:
-            if line.startswith("#limit"):
-                expected = line[7:].strip()
-                break
-        print_verbose(verbose_level_all, "Tiempo esperado del test: ")
-        print_verbose(verbose_level_all, expected)
-        return expected
+    def execute(self, jobs, arguments=None):
+        """Run the ``(key, test)`` pairs of ``jobs`` on ``self.jobs`` processes.
 
-    def run_all(self):
-        for test in self.test:
-            test.run("logisim", self.circ, self.template)
-            test.print()
+        Yields ``(key, test, output, seconds)`` as every test ends, ``test``
+        being the ``TestCase`` after the run.
+        """
+        arguments = arguments or self.arguments()
+        if self.jobs == 1:
+            for key, test in jobs:
+                yield (key,) + run_case(test, *arguments)
+            return
+        with concurrent.futures.ProcessPoolExecutor(self.jobs) as pool:
+            futures = {
+                pool.submit(run_case, test, *arguments): key for key, test in jobs
+            }
+            for future in concurrent.futures.as_completed(futures):
+                yield (futures[future],) + future.result()
 
-    def run_test(self, test_name):
-        for test in self.test:
-            if test.name == test_name:
-                test.run("logisim", self.circ, self.template)
+    def run_bundles(self, order, durations):
+        """Run the tests of ``order`` linked in images of ``self.bundle`` tests.
+
+        Each image pays for a single Logisim launch, and its output is split
+        back into the result of every test by ``bundle.Bundle``.  The tests
+        with ``#limit``, whose ticks a shared run cannot tell, and those that
+        cannot be relocated stay out.  Returns the tests left to run on their
+        own, those and the ones of a bundle that failed, and the seconds spent.
+        """
+        alone = set()
+        programs = []
+        for i in order:
+            test = self.test[i]
+            try:
+                if test.expected_speed is not None:
+                    raise bundle.BundleError("tiene #limit")
+                if "@@" in test.expected_result:
+                    raise bundle.BundleError("#prints contiene una marca")
+                words = disassembler.read_words(test.file)
+                program = bundle.Program.analyse(
+                    test.test_name,
+                    words,
+                    self.max_steps or bundle.default_max_steps,
+                )
+                programs.append((i, program))
+            except (IOError, ValueError, bundle.BundleError) as e:
+                print_verbose(
+                    verbose_level_test_detail, "Test fuera del bundle: ", test.file, e
+                )
+                alone.add(i)
+        jobs = []
+        bundles = {}
+        for start in range(0, len(programs), self.bundle):
+            group = programs[start : start + self.bundle]
+            name = "bundle%d" % len(bundles)
+            folder = os.path.join(self.base_dir, "." + name)
+            try:
+                image = bundle.Bundle([program for i, program in group])
+                os.makedirs(folder, exist_ok=True)
+                assembler.print_instructions(image.words, folder, rle=self.rle)
+            except (IOError, bundle.BundleError) as e:
+                print("Error al armar el bundle: ", name, e)
+                alone.update(i for i, program in group)
+                continue
+            timeouts = [self.test[i].timeout for i, program in group]
+            case = TestCase(
+                name,
+                os.path.join(folder, "Bank"),
+                "",
+                timeout=None if None in timeouts else sum(timeouts),
+            )
+            jobs.append((name, case))
+            bundles[name] = group, image
+        steps = max([image.steps() for group, image in bundles.values()], default=0)
+        serial = 0.0
+        for name, case, output, seconds in self.execute(jobs, self.arguments(steps)):
+            sys.stdout.write(output)
+            serial += seconds
+            group, image = bundles[name]
+            if case.runned and not case.error:
+                results = image.split(case.result)
+            else:
+                results = [None] * len(group)
+            for (i, program), result in zip(group, results):
+                if result is None:
+                    print_verbose(
+                        verbose_level_test_detail,
+                        "Test sin resultado en el bundle: ",
+                        program.name,
+                    )
+                    alone.add(i)
+                    continue
+                test = self.test[i]
+                test.runned = True
+                test.result = result
+                test.seconds = durations[test.test_name] = seconds / len(group)
+                self.result_cache.store(test)
                 test.print()
+        print(
+            "Bundles: %d imágenes con %d tests, %d tests por separado"
+            % (len(jobs), len(order) - len(alone), len(alone))
+        )
+        return [i for i in order if i in alone], serial
+
+    def revision(self):
+        """Name of the circuit and tool the tests ran on, for the history."""
+        return self.result_cache.key_prefix[:12]
+
+    def write_json(self, path):
+        report = {
+            "revision": self.revision(),
+            "tool": "simulator" if self.circ is None else "logisim",
+            "circuit": self.circ,
+            "shard": "%d/%d" % self.shard if self.shard else None,
+            "discovered": self.discovered,
+            "wall": self.wall,
+            "tests": [test.report() for test in self.test],
+        }
+        with open(path, "w") as file:
+            json.dump(report, file, indent=1)
+
+    def write_junit(self, path):
+        write_junit([test.report() for test in self.test], path)
+
+    def record_history(self, path, revision=None):
+        """Append the results of the run to the ``history.History`` at ``path``."""
+        store = history.History(path)
+        try:
+            store.record(
+                revision or self.revision(),
+                "simulator" if self.circ is None else "logisim",
+                [
+                    (
+                        test.test_name,
+                        test.passed(),
+                        test.speed,
+                        test.seconds,
+                        test.error,
+                    )
+                    for test in self.test
+                    if test.runned or test.error
+                ],
+            )
+        finally:
+            store.close()
+
+    def watched_files(self):
+        """Return the size and modification time of the circuit and template."""
+        stats = []
+        for path in [self.circ, self.template] if self.circ else []:
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stats.append(None)
+        return stats
+
+    def watch(self, interval=0.5):
+        """Run the tests again every time their sources or the circuit change.
+
+        The tests folder, the circuit and the template are polled every
+        ``interval`` seconds.  Only the changed sources are assembled again
+        and only their tests run, unless the circuit or the template changed,
+        which runs them all.  Stops with Ctrl-C.
+        """
+        circuit = self.watched_files()
+        print("Esperando cambios (Ctrl-C para terminar)")
+        try:
+            while True:
+                time.sleep(interval)
+                sources = self.sources
+                found = self.discover()
+                changed = {
+                    file
+                    for file, path, metadata in found
+                    if sources.get(path) != self.sources[path]
+                }
+                removed = len(set(sources) - set(self.sources))
+                stats = self.watched_files()
+                if stats == circuit and not changed and not removed:
+                    continue
+                if stats != circuit:
+                    print("Circuito modificado, ejecutando todos los tests")
+                    circuit = stats
+                    changed = None
+                else:
+                    print(
+                        "Tests modificados: %d, eliminados: %d"
+                        % (len(changed), removed)
+                    )
+                # fresh caches, so their counters are those of this round
+                self.build_cache = BuildCache(self.build_cache.options)
+                self.result_cache = self.make_result_cache(self.use_cache)
+                self.test = self.load(found)
+                self.run_all(changed)
+        except KeyboardInterrupt:
+            print("Fin del modo watch")
+
+    def run_test(self, test_name):
+        for i, test in enumerate(self.test):
+            if test.test_name == test_name:
+                self.test[i], seconds = self.run(test)
+                self.test[i].print()
 
 
 if __name__ == "__main__":
-    usage = "usage: %prog tests_dir circuit [options]"
+    usage = "usage: %prog tests_dir [circuit] [options]"
 
     parser = optparse.OptionParser(usage=usage)
     parser.add_option(
@@ -216,6 +1236,169 @@ if __name__ == "__main__":
         default="s-mips-template.circ",
         help="The template .circ file without specific implementation",
     )
+    parser.add_option(
+        "-r",
+        "--rle",
+        dest="rle",
+        action="store_true",
+        default=False,
+        help="Write run-length encoded memory images",
+    )
+    parser.add_option(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type="int",
+        default=1,
+        help="Number of processes used to assemble and run the tests (0: one per CPU)",
+    )
+    parser.add_option(
+        "-O",
+        "--optimize",
+        dest="optimize",
+        action="store_true",
+        default=False,
+        help="Run the peephole optimizer on the tests before running them",
+    )
+    parser.add_option(
+        "-s",
+        "--simulate",
+        dest="simulate",
+        action="store_true",
+        default=False,
+        help="Run the tests on the instruction-set simulator instead of Logisim",
+    )
+    parser.add_option(
+        "-m",
+        "--max-steps",
+        dest="max_steps",
+        type="int",
+        default=10000000,
+        help="Number of instructions after which a simulated test fails (0: no limit)",
+    )
+    parser.add_option(
+        "-c",
+        "--costs",
+        dest="costs",
+        type="string",
+        default=None,
+        help="JSON cost table of the timing model estimating the ticks of "
+        "simulated tests, uncalibrated against Logisim (see timing.py)",
+    )
+    parser.add_option(
+        "-l",
+        "--logisim",
+        dest="logisim",
+        type="string",
+        default="logisim",
+        help="Logisim executable running the tests, such as logisim_stub.py",
+    )
+    parser.add_option(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        default=True,
+        help="Run every test again instead of reusing the results of unchanged ones; "
+        "Logisim is told apart by its launcher and the jars the launcher names, "
+        "use this after upgrading a jar found some other way",
+    )
+    parser.add_option(
+        "--timeout",
+        dest="timeout",
+        type="float",
+        default=0,
+        help="Seconds after which a Logisim test without #timeout is stopped, along "
+        "with the processes it started on POSIX systems (0: never)",
+    )
+    parser.add_option(
+        "--deadline",
+        dest="deadline",
+        type="float",
+        default=0,
+        help="Seconds after which every Logisim test still running is stopped, along "
+        "with the processes it started on POSIX systems (0: never)",
+    )
+    parser.add_option(
+        "--tags",
+        dest="tags",
+        type="string",
+        default=None,
+        help="Comma separated tags, only the tests with one of them in #tags run",
+    )
+    parser.add_option(
+        "--shard",
+        dest="shard",
+        type="string",
+        default=None,
+        help="Run only the i-th of N shards of the tests balanced by duration, as i/N",
+    )
+    parser.add_option(
+        "--durations",
+        dest="durations",
+        type="string",
+        default=None,
+        help="JSON file of the seconds of every test (default: <out>/.durations), "
+        "read to run the longest tests first and to split --shard runs, and "
+        "updated by every run without --shard and by --merge",
+    )
+    parser.add_option(
+        "--merge",
+        dest="merge",
+        action="store_true",
+        default=False,
+        help="Join the JSON reports given instead of the tests into --json/--junit",
+    )
+    parser.add_option(
+        "-w",
+        "--watch",
+        dest="watch",
+        action="store_true",
+        default=False,
+        help="Keep running the tests affected by every change of the sources or circuit",
+    )
+    parser.add_option(
+        "--interval",
+        dest="interval",
+        type="float",
+        default=0.5,
+        help="Seconds between the checks for changes of --watch",
+    )
+    parser.add_option(
+        "-b",
+        "--bundle",
+        dest="bundle",
+        type="int",
+        default=0,
+        help="Link up to this many tests without #limit in each image run (0: never)",
+    )
+    parser.add_option(
+        "--json",
+        dest="json",
+        type="string",
+        default=None,
+        help="Write the results to this JSON file",
+    )
+    parser.add_option(
+        "--junit",
+        dest="junit",
+        type="string",
+        default=None,
+        help="Write the results to this JUnit XML file",
+    )
+    parser.add_option(
+        "--history",
+        dest="history",
+        type="string",
+        default=None,
+        help="History database the results are added to, see history.py",
+    )
+    parser.add_option(
+        "--revision",
+        dest="revision",
+        type="string",
+        default=None,
+        help="Name of the circuit revision in the history (default: its hash)",
+    )
     parser.add_option(
         "-v",
         "--verbose",
@@ -225,25 +1408,113 @@ if __name__ == "__main__":
         help="Verbose debug mode",
     )
     options, args = parser.parse_args()
-    if len(args) != 2:
+    verbose_level = options.verbose
+    if options.merge:
+        if not args:
+            parser.error("Incorrect command line arguments")
+        try:
+            report = merge_reports(args)
+            if options.json:
+                with open(options.json, "w") as file:
+                    json.dump(report, file, indent=1)
+            if options.junit:
+                write_junit(report["tests"], options.junit)
+            if options.durations:
+                try:
+                    with open(options.durations, "r") as file:
+                        durations = json.load(file)
+                except (IOError, ValueError):
+                    durations = {}
+                durations.update(
+                    (test["name"], test["seconds"])
+                    for test in report["tests"]
+                    if test["seconds"] is not None
+                )
+                with open(options.durations, "w") as file:
+                    json.dump(durations, file, indent=1, sort_keys=True)
+        except (IOError, ValueError, KeyError) as e:
+            print("No se pudieron unir los reportes: ", e)
+            sys.exit(1)
+        tests = report["tests"]
+        print(
+            "Tests: %d de %d shards, %d correctos, %.2fs el más lento, %.2fs en serie"
+            % (
+                len(tests),
+                len(args),
+                sum(1 for test in tests if test["passed"]),
+                report["wall"],
+                sum(test["seconds"] or 0.0 for test in tests),
+            )
+        )
+        sys.exit(0)
+
+    if len(args) != (1 if options.simulate else 2):
         parser.error("Incorrect command line arguments")
         sys.exit(1)
 
-    verbose_level = options.verbose
+    shard = None
+    if options.shard:
+        try:
+            index, count = [int(value) for value in options.shard.split("/")]
+        except ValueError:
+            index = count = 0
+        if not 1 <= index <= count:
+            parser.error("--shard must be i/N with 1 <= i <= N")
+        shard = (index, count)
+        if options.watch:
+            parser.error("--watch cannot run a shard")
 
     output_folder = options.output_folder
     template = options.template
     input_dir = args[0]
-    circ = args[1]
+    circ = None if options.simulate else args[1]
 
     try:
         os.mkdir(output_folder)
     except FileExistsError as e:
         print_verbose(verbose_level_all, "Directorio existente: ", output_folder)
 
-    if not os.path.exists(template):
+    if circ is not None and not os.path.exists(template):
         print("El archivo de template no existe")
         sys.exit(1)
 
-    test_suite = TestSuite(input_dir, output_folder, circ, template)
+    timing_model = None
+    if options.costs:
+        try:
+            timing_model = timing.TimingModel.read(options.costs)
+        except (IOError, ValueError, TypeError) as e:
+            print("No se pudo leer la tabla de costos", options.costs, e)
+            sys.exit(1)
+
+    test_suite = TestSuite(
+        input_dir,
+        output_folder,
+        circ,
+        template,
+        options.rle,
+        options.jobs or None,
+        options.optimize,
+        options.max_steps or None,
+        timing_model,
+        options.logisim,
+        options.use_cache,
+        options.timeout or None,
+        time.time() + options.deadline if options.deadline else None,
+        options.tags.replace(",", " ").split() if options.tags else None,
+        shard,
+        options.durations,
+        options.bundle,
+    )
     test_suite.run_all()
+    try:
+        if options.json:
+            test_suite.write_json(options.json)
+        if options.junit:
+            test_suite.write_junit(options.junit)
+        if options.history:
+            test_suite.record_history(options.history, options.revision)
+    except (IOError, history.sqlite3.Error) as e:
+        print("No se pudo guardar el reporte: ", e)
+        sys.exit(1)
+    if options.watch:
+        test_suite.watch(options.interval)
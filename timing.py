@@ -0,0 +1,218 @@
+#! /usr/bin/env python3
+
+import sys
+import json
+import optparse
+
+import disassembler
+import simulator
+
+# Cycles the control unit of s-mips.circ spends on every instruction besides
+# waiting for memory: fetch, decode and execute, plus a memory or a register
+# write-back state for the instructions that need one.  The UnsignedMultiplier
+# and the SignDivider are combinational, so mult/div finish in the execute
+# state like any other ALU operation and only write HI/LO.
+#
+# These counts are read off the circuit, not measured: the model has not been
+# calibrated against runs of Logisim, and logisim_stub.py reports the ticks of
+# this same model, so running the suite with the stub does not check it
+# either.  Compare it with a real run with --reference and fix the table with
+# --costs where they disagree.
+default_cycles = {
+    "nop": 3,
+    "add": 4,
+    "sub": 4,
+    "mult": 3,
+    "mulu": 3,
+    "div": 3,
+    "divu": 3,
+    "slt": 4,
+    "sltu": 4,
+    "and": 4,
+    "or": 4,
+    "nor": 4,
+    "xor": 4,
+    "addi": 4,
+    "slti": 4,
+    "sltiu": 4,
+    "andi": 4,
+    "ori": 4,
+    "xori": 4,
+    "lw": 5,
+    "sw": 4,
+    "push": 4,
+    "pop": 5,
+    "beq": 3,
+    "bne": 3,
+    "blez": 3,
+    "bgtz": 3,
+    "bltz": 3,
+    "j": 3,
+    "jr": 3,
+    "mfhi": 4,
+    "mflo": 4,
+    "halt": 3,
+    "tty": 3,
+    "rnd": 4,
+    "kbd": 4,
+}
+
+# instructions reading or writing the memory besides fetching
+memory_reads = {"lw", "pop"}
+memory_writes = {"sw", "push"}
+
+
+class TimingModel:
+    """Estimates the clock ticks of a simulated program on s-mips.circ.
+
+    ``cycles`` maps every mnemonic to its cycles besides memory accesses.
+    Every access waits for the ``Wait`` counter of the memory to run down
+    from ``read_wait`` or ``write_wait`` (the Read Time and Write Time of
+    the RAM circuit) after the cycle starting it; the fetch of each
+    instruction is a read.  Before the processor starts, the RAM Dispatcher
+    copies the program word by word, waiting ``write_wait`` cycles for each
+    one, and stops at the end mark.  A clock cycle is ``ticks_per_cycle``
+    ticks of the Logisim clock.  The estimate is only as good as these
+    numbers, which have not been checked against Logisim.
+    """
+
+    def __init__(
+        self,
+        cycles=None,
+        read_wait=3,
+        write_wait=2,
+        ticks_per_cycle=2,
+        dispatcher=True,
+    ):
+        self.cycles = dict(default_cycles)
+        self.cycles.update(cycles or {})
+        self.read_wait = read_wait
+        self.write_wait = write_wait
+        self.ticks_per_cycle = ticks_per_cycle
+        self.dispatcher = dispatcher
+
+    @classmethod
+    def read(cls, path):
+        """Load a model from a JSON cost table with the arguments of the class.
+
+        Only the values that change need to be given, for instance
+        ``{"cycles": {"mult": 34, "div": 34}, "read_wait": 1}``.
+        """
+        with open(path, "r") as file:
+            table = json.load(file)
+        unknown = set(table.get("cycles", {})) - set(default_cycles)
+        if unknown:
+            raise ValueError("unknown instructions %s" % ", ".join(sorted(unknown)))
+        return cls(**table)
+
+    def instruction_cycles(self, instr):
+        cycles = self.cycles[instr] + 1 + self.read_wait
+        if instr in memory_reads:
+            cycles += 1 + self.read_wait
+        elif instr in memory_writes:
+            cycles += 1 + self.write_wait
+        return cycles
+
+    def load_cycles(self, program_words):
+        """Cycles the RAM Dispatcher takes to copy ``program_words`` words."""
+        if not self.dispatcher:
+            return 0
+        # a cycle to read every word, the write and one to move to the next,
+        # then the end mark is read and the processor released
+        return program_words * (self.write_wait + 3) + 2
+
+    def run_cycles(self, machine):
+        """Cycles of the instructions run by a ``count`` machine."""
+        memory = machine.memory
+        cycles = 0
+        for pc, times in machine.executions().items():
+            record = simulator.predecode(memory[pc])
+            if record is not None:
+                cycles += times * self.instruction_cycles(record.instr)
+        return cycles
+
+    def ticks(self, machine, program_words):
+        """Ticks to load a program of ``program_words`` words and run it."""
+        cycles = self.load_cycles(program_words) + self.run_cycles(machine)
+        return cycles * self.ticks_per_cycle
+
+
+if __name__ == "__main__":
+    usage = "%prog image [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option(
+        "-c",
+        "--costs",
+        dest="costs",
+        type="string",
+        default=None,
+        help="JSON cost table changing the default timing model",
+    )
+    parser.add_option(
+        "-m",
+        "--max-steps",
+        dest="max_steps",
+        type="int",
+        default=10000000,
+        help="Stop after this number of instructions (0: no limit)",
+    )
+    parser.add_option(
+        "-s",
+        "--seed",
+        dest="seed",
+        type="int",
+        default=None,
+        help="Seed of the numbers returned by rnd",
+    )
+    parser.add_option(
+        "-r",
+        "--reference",
+        dest="reference",
+        type="int",
+        default=None,
+        help="Ticks Logisim reported for the image, to compare the estimate with",
+    )
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Incorrect command line arguments")
+        sys.exit(1)
+
+    try:
+        model = TimingModel.read(options.costs) if options.costs else TimingModel()
+    except (IOError, ValueError, TypeError) as e:
+        print("Unable to read cost table %s: %s" % (options.costs, e), file=sys.stderr)
+        sys.exit(1)
+    try:
+        words = disassembler.read_words(args[0])
+    except (IOError, ValueError) as e:
+        print("Unable to read image %s: %s" % (args[0], e), file=sys.stderr)
+        sys.exit(1)
+
+    machine = simulator.Machine(words, seed=options.seed, count=True)
+    try:
+        halted = machine.run(options.max_steps or None)
+    except simulator.SimulatorError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+    if not halted:
+        print(
+            "stopped after %d instructions without halting" % machine.steps,
+            file=sys.stderr,
+        )
+        sys.exit(2)
+    load = model.load_cycles(len(words))
+    run = model.run_cycles(machine)
+    print("%d instructions" % machine.steps)
+    print("%d cycles loading the program, %d running it" % (load, run))
+    ticks = model.ticks(machine, len(words))
+    print("%d ticks" % ticks)
+    if options.reference:
+        print(
+            "%+d ticks (%+.1f%%) from the %d Logisim reported"
+            % (
+                ticks - options.reference,
+                100.0 * (ticks - options.reference) / options.reference,
+                options.reference,
+            )
+        )
+    sys.exit(0)